@@ -18,7 +18,13 @@ from telegram.ext import Application, MessageHandler, CommandHandler, CallbackQu
 
 import os
 from dotenv import load_dotenv
-from sofia_prompt import get_system_prompt, BOT_NAME
+from sofia_prompt import BOT_NAME
+from hot_reload import HotReloader, load_prompt_module
+from price_catalog import CATALOG_PATH, load_catalog, set_catalog
+from examples_index import ExamplesIndex, format_examples
+from fts_search import find, init_fts
+from slots import slots_from_history
+from webhook import configure_builder, start_webhook, webhook_config
 
 load_dotenv()
 
@@ -30,9 +36,19 @@ DB_PATH = "sofia_conversations.db"
 LOG_PATH = "sofia_bot.log"
 ANTIFLOOD_DELAY = 3
 CONTEXT_SIZE = 8  # Последние 8 сообщений (4 вопроса + 4 ответа)
+FEEDBACK_COMPACTED_VERSION = 1  # PRAGMA user_version базы после перевода старых оценок на ссылки
 
 ADMIN_IDS = [5186134824]
 
+# Горячая перезагрузка промпта (sofia_analyzer пишет новый sofia_prompt.py — бот подхватывает сам)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPT_PATH = os.path.join(BASE_DIR, "sofia_prompt.py")
+BACKUP_DIR = os.path.join(BASE_DIR, "backups")
+PROMPT_WATCH_INTERVAL = 10  # секунд между проверками файла
+# Удачные ответы (оценки GOOD) как примеры в промпт: индекс BM25, дописывается после каждой оценки
+EXAMPLES_INDEX_PATH = os.getenv("EXAMPLES_INDEX_PATH", os.path.join(BASE_DIR, "examples_index.jsonl"))
+FEW_SHOT_K = int(os.getenv("FEW_SHOT_K", "3"))  # 0 — без примеров
+
 client = OpenAI(api_key=OPENAI_API_KEY)
 
 # Состояния пользователей (ожидание комментария)
@@ -45,13 +61,29 @@ def log(message):
     with open(LOG_PATH, "a", encoding="utf-8") as f:
         f.write(line + "\n")
 
+# Откатывать файлы на диске — одному процессу: под shard_supervisor.py это шард 0
+WRITES_FILES = os.getenv("SHARD_INDEX", "") in ("", "0")
+prompt_reloader = HotReloader("sofia_prompt", PROMPT_PATH, load_prompt_module,
+                              backup_dir=BACKUP_DIR, backup_prefix="sofia_prompt_", logger=log,
+                              write_files=WRITES_FILES)
+# Справочник цен (price_catalog.json): цены правятся без правки промпта и без рестарта
+catalog_reloader = HotReloader("price_catalog", CATALOG_PATH, load_catalog,
+                               backup_dir=BACKUP_DIR, backup_prefix="price_catalog_",
+                               on_swap=set_catalog, logger=log, write_files=WRITES_FILES)
+examples_index = ExamplesIndex.load(EXAMPLES_INDEX_PATH)
+
 # ============================================
 # БАЗА ДАННЫХ
 # ============================================
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=60)
     c = conn.cursor()
+    # WAL: шарды (shard_supervisor.py) — разные процессы на одной базе; читатели не ждут запись
+    c.execute('PRAGMA journal_mode=WAL')
+    # Шарды стартуют одновременно: схема и миграции — под блокировкой записи, иначе второй
+    # процесс повторит ALTER TABLE, который первый уже сделал
+    c.execute('BEGIN IMMEDIATE')
     
     c.execute('''CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,9 +111,28 @@ def init_db():
         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
     )''')
     
+    # Миграция: контекст оценки храним ссылкой на диапазон id сообщений, а не копией JSON
+    c.execute('PRAGMA table_info(feedback_v2)')
+    columns = {row[1] for row in c.fetchall()}
+    if "msg_from_id" not in columns:
+        c.execute('ALTER TABLE feedback_v2 ADD COLUMN msg_from_id INTEGER')
+        c.execute('ALTER TABLE feedback_v2 ADD COLUMN msg_to_id INTEGER')
+    
+    # Перевод старых оценок на ссылки — один раз на базу (PRAGMA user_version): строки без совпадения
+    # при каждом старте сканировались бы заново
+    c.execute('PRAGMA user_version')
+    compact = c.fetchone()[0] < FEEDBACK_COMPACTED_VERSION
+    
     conn.commit()
     conn.close()
+    compacted, saved = compact_feedback_contexts() if compact else (0, 0)
+    # Полнотекстовый индекс для /find (сообщения + комментарии экспертов)
+    indexed = init_fts(DB_PATH)
+    if indexed:
+        log(f"🔎 Индекс поиска построен: {', '.join(indexed)}")
     log("📦 База данных инициализирована (feedback_v2)")
+    if compacted:
+        log(f"🗜️ Контекст {compacted} оценок заменён ссылками: −{saved} байт")
 
 def save_message(chat_id, user_id, user_name, role, content, processed=0):
     conn = sqlite3.connect(DB_PATH)
@@ -105,11 +156,26 @@ def get_context_for_feedback(chat_id, limit=CONTEXT_SIZE):
     """Получаем последние N сообщений для feedback"""
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute('SELECT role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT ?', (chat_id, limit))
+    c.execute('SELECT id, role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?', (chat_id, limit))
     rows = c.fetchall()
     conn.close()
     # Возвращаем в хронологическом порядке
-    return [{"role": row[0], "content": row[1], "time": row[2]} for row in reversed(rows)]
+    return [{"id": row[0], "role": row[1], "content": row[2], "time": row[3]} for row in reversed(rows)]
+
+def load_context_range(c, chat_id, msg_from_id, msg_to_id):
+    """Восстанавливаем контекст оценки по диапазону id сообщений"""
+    c.execute('SELECT role, content, timestamp FROM messages WHERE chat_id = ? AND id BETWEEN ? AND ? ORDER BY id',
+              (chat_id, msg_from_id, msg_to_id))
+    return [{"role": row[0], "content": row[1], "time": row[2]} for row in c.fetchall()]
+
+def resolve_feedback_context(c, chat_id, context, msg_from_id, msg_to_id):
+    """Контекст оценки: из диапазона id, а для старых записей — из JSON-копии"""
+    if msg_from_id is not None and not context:
+        return load_context_range(c, chat_id, msg_from_id, msg_to_id)
+    try:
+        return json.loads(context) if context else []
+    except ValueError:
+        return []
 
 def get_unprocessed_messages(chat_id):
     conn = sqlite3.connect(DB_PATH)
@@ -129,6 +195,11 @@ def mark_messages_processed(chat_id):
 def clear_chat_history(chat_id):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
+    # Оценки ссылаются на сообщения по id — перед удалением сохраняем их контекст копией
+    c.execute('SELECT id, msg_from_id, msg_to_id FROM feedback_v2 WHERE chat_id = ? AND msg_from_id IS NOT NULL AND (context IS NULL OR context = '')', (chat_id,))
+    for feedback_id, msg_from_id, msg_to_id in c.fetchall():
+        ctx = load_context_range(c, chat_id, msg_from_id, msg_to_id)
+        c.execute('UPDATE feedback_v2 SET context = ? WHERE id = ?', (json.dumps(ctx, ensure_ascii=False), feedback_id))
     c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
     conn.commit()
     conn.close()
@@ -164,33 +235,82 @@ def is_new_user(user_id):
 # ============================================
 
 def save_feedback_v2(chat_id, user_id, expert_name, context, rating, comment=""):
-    """Сохраняем оценку с контекстом и комментарием"""
+    """Сохраняем оценку: контекст — ссылкой на диапазон id сообщений, плюс комментарий"""
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    context_json = json.dumps(context, ensure_ascii=False)
-    c.execute('''INSERT INTO feedback_v2 (chat_id, user_id, expert_name, context, rating, comment)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (chat_id, user_id, expert_name, context_json, rating, comment))
+    ids = [m["id"] for m in context if m.get("id") is not None]
+    if ids:
+        msg_from_id, msg_to_id, context_json = min(ids), max(ids), ""
+    else:
+        msg_from_id, msg_to_id = None, None
+        context_json = json.dumps(context, ensure_ascii=False)
+    c.execute('''INSERT INTO feedback_v2 (chat_id, user_id, expert_name, context, rating, comment, msg_from_id, msg_to_id)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+              (chat_id, user_id, expert_name, context_json, rating, comment, msg_from_id, msg_to_id))
     conn.commit()
     conn.close()
     log(f"📊 Feedback: {rating} от {expert_name} (комментарий: {len(comment)} симв.)")
+    if rating == "good":
+        added = examples_index.sync(DB_PATH)
+        if added:
+            log(f"📚 Примеров в индексе: {len(examples_index.docs)} (+{added})")
+
+def compact_feedback_contexts():
+    """
+    Переводим старые оценки (JSON-копия контекста) на ссылки по id,
+    если эти сообщения ещё есть в messages. Возвращает (записей, байт сэкономлено).
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT id, chat_id, context FROM feedback_v2 WHERE msg_from_id IS NULL AND context IS NOT NULL AND context != '' ORDER BY chat_id")
+    rows = c.fetchall()
+    
+    compacted, saved = 0, 0
+    history_chat, history, starts = None, [], {}
+    for feedback_id, chat_id, context in rows:
+        try:
+            ctx = json.loads(context)
+        except ValueError:
+            continue
+        if not ctx:
+            continue
+        # История чата — один раз на чат; окно ищем только с позиций, где совпадает первое сообщение
+        if chat_id != history_chat:
+            c.execute('SELECT id, role, content FROM messages WHERE chat_id = ? ORDER BY id', (chat_id,))
+            history_chat, history, starts = chat_id, [(h[0], (h[1], h[2])) for h in c.fetchall()], {}
+            for i, (_, message) in enumerate(history):
+                starts.setdefault(message, []).append(i)
+        wanted = [(m.get("role"), m.get("content")) for m in ctx]
+        for start in starts.get(wanted[0], ()):
+            window = history[start:start + len(wanted)]
+            if [message for _, message in window] == wanted:
+                c.execute("UPDATE feedback_v2 SET context = '', msg_from_id = ?, msg_to_id = ? WHERE id = ?",
+                          (window[0][0], window[-1][0], feedback_id))
+                compacted += 1
+                saved += len(context.encode("utf-8"))
+                break
+    c.execute(f'PRAGMA user_version = {FEEDBACK_COMPACTED_VERSION}')
+    
+    conn.commit()
+    conn.close()
+    return compacted, saved
 
 def export_feedback_json():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute('SELECT context, rating, comment, expert_name, timestamp FROM feedback_v2 ORDER BY timestamp')
+    c.execute('SELECT context, rating, comment, expert_name, timestamp, chat_id, msg_from_id, msg_to_id FROM feedback_v2 ORDER BY timestamp')
     rows = c.fetchall()
-    conn.close()
     
     data = []
     for r in rows:
         data.append({
-            "context": json.loads(r[0]),
+            "context": resolve_feedback_context(c, r[5], r[0], r[6], r[7]),
             "rating": r[1],
             "comment": r[2],
             "expert_name": r[3],
             "timestamp": r[4]
         })
+    conn.close()
     
     filepath = "/opt/sofia-bot/training_data.json"
     with open(filepath, "w", encoding="utf-8") as f:
@@ -200,8 +320,11 @@ def export_feedback_json():
 def export_feedback_csv():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute('SELECT context, rating, comment, expert_name, timestamp FROM feedback_v2 ORDER BY timestamp')
-    rows = c.fetchall()
+    c.execute('SELECT context, rating, comment, expert_name, timestamp, chat_id, msg_from_id, msg_to_id FROM feedback_v2 ORDER BY timestamp')
+    rows = [
+        (json.dumps(resolve_feedback_context(c, r[5], r[0], r[6], r[7]), ensure_ascii=False),) + r[1:5]
+        for r in c.fetchall()
+    ]
     conn.close()
     
     filepath = "/opt/sofia-bot/training_data.csv"
@@ -331,17 +454,28 @@ async def generate_response(chat_id, user_id, user_message, user_name, was_offli
     
     messages = history + [{"role": "user", "content": user_message}]
     
+    # Промпт фиксируем на весь ход — перезагрузка не заденет ответ, который уже генерируется
+    prompt_module, prompt_version = prompt_reloader.snapshot()
+    # Слоты по истории: в промпт идут только строки справочника цен под локацию и бюджет
+    instructions = prompt_module.get_system_prompt(user_name, slots_from_history(messages))
+    # Похожие удачные ответы других диалогов — компактные примеры в конец промпта
+    if FEW_SHOT_K:
+        last_bot = next((m["content"] for m in reversed(history) if m["role"] == "assistant"), "")
+        examples = format_examples(examples_index.search(user_message, last_bot, FEW_SHOT_K, exclude_chat=chat_id))
+        if examples:
+            instructions = f"{instructions}\n\n{examples}"
+    
     def call_openai():
         return client.responses.create(
             model="gpt-5.2",
-            instructions=get_system_prompt(user_name),
+            instructions=instructions,
             input=messages,
             reasoning={"effort": "xhigh"},
             text={"verbosity": "low"},
         )
     
     try:
-        log(f"🔄 GPT запрос для {user_name}...")
+        log(f"🔄 GPT запрос для {user_name} (промпт {prompt_version})...")
         response = await asyncio.to_thread(call_openai)
         log(f"✅ GPT ответил")
         assistant_message = response.output_text
@@ -541,6 +675,51 @@ async def cmd_myid(update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await update.message.reply_text(f"Твой user_id: {user_id}")
 
+async def cmd_find(update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <запрос> — поиск по диалогам и комментариям экспертов"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /find <запрос>\nНапример: /find ипотека сочи")
+        return
+    await update.message.reply_text(await asyncio.to_thread(find, DB_PATH, query))
+
+async def cmd_reload(update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитать sofia_prompt.py и price_catalog.json без рестарта"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    lines = []
+    for reloader in (prompt_reloader, catalog_reloader):
+        changed, message = reloader.reload()
+        lines.append(f"{'🔁' if changed else 'ℹ️'} {message}")
+    await update.message.reply_text("\n".join(lines))
+
+async def watch_prompt():
+    """
+    Следим за файлами промпта и справочника цен и подменяем их между ходами.
+    Заодно дочитываем новые GOOD в индекс примеров: оценку мог поставить эксперт в чате другого шарда.
+    """
+    while True:
+        await asyncio.sleep(PROMPT_WATCH_INTERVAL)
+        for reloader in (prompt_reloader, catalog_reloader):
+            try:
+                reloader.check()
+            except Exception as e:
+                log(f"❌ Ошибка перезагрузки {reloader.name}: {e}")
+        try:
+            added = examples_index.sync(DB_PATH)
+            if added:
+                log(f"📚 Примеров в индексе: {len(examples_index.docs)} (+{added})")
+        except Exception as e:
+            log(f"❌ Ошибка синхронизации примеров: {e}")
+
 # ============================================
 # ЗАПУСК
 # ============================================
@@ -548,8 +727,13 @@ async def cmd_myid(update, context: ContextTypes.DEFAULT_TYPE):
 async def main():
     log("🚀 Запуск Sofia Bot (экспертная система обучения)")
     init_db()
+    prompt_reloader.reload()
+    catalog_reloader.reload()
+    added = examples_index.sync(DB_PATH)
+    log(f"📚 Примеров для промпта: {len(examples_index.docs)} (новых из feedback_v2: {added})")
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    webhook = webhook_config(8081, "/sofia")
+    app = configure_builder(Application.builder().token(TELEGRAM_TOKEN), webhook).build()
     
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("reset", cmd_reset))
@@ -557,6 +741,8 @@ async def main():
     app.add_handler(CommandHandler("export", cmd_export))
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("myid", cmd_myid))
+    app.add_handler(CommandHandler("reload", cmd_reload))
+    app.add_handler(CommandHandler("find", cmd_find))
     
     app.add_handler(CallbackQueryHandler(handle_rating, pattern="^rate_"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -566,7 +752,12 @@ async def main():
     
     await app.initialize()
     await app.start()
-    await app.updater.start_polling(drop_pending_updates=True)
+    if webhook["mode"] == "webhook":
+        server = await start_webhook(app, webhook, log)
+    else:
+        server = None
+        await app.updater.start_polling(drop_pending_updates=True)
+    watcher = asyncio.create_task(watch_prompt())
     
     try:
         while True:
@@ -574,7 +765,11 @@ async def main():
     except KeyboardInterrupt:
         log("🛑 Остановка...")
     
-    await app.updater.stop()
+    watcher.cancel()
+    if server:
+        await server.stop()
+    else:
+        await app.updater.stop()
     await app.stop()
     await app.shutdown()
 
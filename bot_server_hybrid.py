@@ -12,11 +12,20 @@ from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 from sofia_hybrid import process_message, analyze_history, get_current_model_info, MODEL_CONFIGS
+from slots import slot_summary
+from decision_rules import load_rules
+from price_catalog import CATALOG_PATH, load_catalog, set_catalog
+from fts_search import find, init_fts
+from hot_reload import HotReloader, load_prompt_module, make_patterns_loader
+from webhook import configure_builder, run_webhook, webhook_config
+import sofia_hybrid
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 DB_PATH = os.getenv("DB_PATH", "sofia_hybrid.db")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Polling или webhook, параллельность апдейтов, шард (webhook.py)
+WEBHOOK = webhook_config(8082, "/hybrid")
 
 logging.basicConfig(
     format='[%(asctime)s] %(levelname)s: %(message)s',
@@ -25,10 +34,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Горячая перезагрузка: sofia_prompt.py и списки паттернов sofia_hybrid.py
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+RELOAD_INTERVAL = int(os.getenv("RELOAD_INTERVAL", "10"))
+# Откуда брать списки паттернов: sofia_hybrid.py или файл из scripts/mine_patterns.py
+PATTERNS_PATH = os.getenv("PATTERNS_PATH", os.path.join(BASE_DIR, "sofia_hybrid.py"))
+# Размеченные сообщения: каждая версия паттернов проверяется на точность/полноту перед подменой
+PATTERNS_LABELLED = os.getenv("PATTERNS_LABELLED", os.path.join(BASE_DIR, "patterns_labelled.jsonl"))
+PATTERNS_MIN_PRECISION = float(os.getenv("PATTERNS_MIN_PRECISION", "0"))
+PATTERNS_MIN_RECALL = float(os.getenv("PATTERNS_MIN_RECALL", "0"))
+# Правила decide_action (JSON): пороги и инструкции правятся без рестарта
+DECISION_RULES_PATH = sofia_hybrid.DECISION_RULES_PATH
+# Откатывать файлы на диске — одному процессу: под shard_supervisor.py это шард 0
+WRITES_FILES = WEBHOOK["shard"] in ("", "0")
+
+prompt_reloader = HotReloader(
+    "sofia_prompt", os.path.join(BASE_DIR, "sofia_prompt.py"), load_prompt_module,
+    backup_dir=BACKUP_DIR, backup_prefix="sofia_prompt_",
+    on_swap=sofia_hybrid.set_prompt, logger=logger.info, write_files=WRITES_FILES
+)
+patterns_reloader = HotReloader(
+    "patterns", PATTERNS_PATH,
+    make_patterns_loader(PATTERNS_LABELLED, PATTERNS_MIN_PRECISION, PATTERNS_MIN_RECALL, logger=logger.info,
+                         fuzzy=sofia_hybrid.FUZZY_PATTERNS),
+    # Паттерны живут в модуле (.py — sofia_hybrid.py или mined_patterns.py): откат переписал бы его целиком
+    # вместе с кодом, выкаченным после старта. Невалидную версию только не подменяем — файл правит человек
+    on_swap=sofia_hybrid.set_patterns, logger=logger.info,
+    write_files=WRITES_FILES and not PATTERNS_PATH.endswith(".py")
+)
+rules_reloader = HotReloader(
+    "decision_rules", DECISION_RULES_PATH, load_rules,
+    backup_dir=BACKUP_DIR, backup_prefix="decision_rules_",
+    on_swap=sofia_hybrid.set_rules, logger=logger.info, write_files=WRITES_FILES
+)
+# Справочник цен: строки для промпта и локации для слотов берутся из текущей версии
+catalog_reloader = HotReloader(
+    "price_catalog", CATALOG_PATH, load_catalog,
+    backup_dir=BACKUP_DIR, backup_prefix="price_catalog_",
+    on_swap=set_catalog, logger=logger.info, write_files=WRITES_FILES
+)
+RELOADERS = (prompt_reloader, patterns_reloader, rules_reloader, catalog_reloader)
+
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=60)
     c = conn.cursor()
+    # WAL: шарды (shard_supervisor.py) — разные процессы на одной базе; читатели не ждут запись
+    c.execute('PRAGMA journal_mode=WAL')
+    # Шарды стартуют одновременно: схема и миграции — под блокировкой записи, иначе второй
+    # процесс повторит ALTER TABLE, который первый уже сделал
+    c.execute('BEGIN IMMEDIATE')
     
     c.execute('''CREATE TABLE IF NOT EXISTS conversations (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -58,6 +114,23 @@ def init_db():
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
     
+    c.execute('PRAGMA table_info(debug_logs)')
+    columns = {row[1] for row in c.fetchall()}
+    if "prompt_version" not in columns:
+        c.execute('ALTER TABLE debug_logs ADD COLUMN prompt_version TEXT')
+        c.execute('ALTER TABLE debug_logs ADD COLUMN patterns_version TEXT')
+    if "intents" not in columns:
+        c.execute('ALTER TABLE debug_logs ADD COLUMN intents TEXT')  # режим, модель, пороги и вероятности
+    if "rules_version" not in columns:
+        c.execute('ALTER TABLE debug_logs ADD COLUMN rules_version TEXT')  # reason — имя сработавшего правила
+    
+    # Слоты квалификации (slots.py): обновляются по одному сообщению за ход
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_slots (
+        chat_id INTEGER PRIMARY KEY,
+        slots TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
     c.execute('''CREATE TABLE IF NOT EXISTS settings (
         key TEXT PRIMARY KEY,
         value TEXT,
@@ -66,6 +139,10 @@ def init_db():
     
     conn.commit()
     conn.close()
+    # Полнотекстовый индекс для /find: при первом запуске индексируется вся история
+    indexed = init_fts(DB_PATH)
+    if indexed:
+        logger.info(f"FTS index built: {', '.join(indexed)}")
     logger.info("Database initialized")
 
 
@@ -104,13 +181,36 @@ def save_message(chat_id: int, role: str, content: str):
     conn.close()
 
 
+def get_slots(chat_id: int):
+    """Сохранённые слоты чата или None (старый чат — соберутся по истории)"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT slots FROM chat_slots WHERE chat_id = ?', (chat_id,))
+    row = c.fetchone()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def save_slots(chat_id: int, slots: dict):
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO chat_slots (chat_id, slots, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)',
+              (chat_id, json.dumps(slots, ensure_ascii=False)))
+    conn.commit()
+    conn.close()
+
+
 def save_debug(chat_id: int, user_message: str, bot_response: str, debug: dict):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    c.execute('''INSERT INTO debug_logs (chat_id, user_message, bot_response, action, reason, model_mode, stats)
-        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+    c.execute('''INSERT INTO debug_logs (chat_id, user_message, bot_response, action, reason, model_mode, stats,
+        prompt_version, patterns_version, intents, rules_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
         (chat_id, user_message, bot_response, debug.get("action"), debug.get("reason"),
-         debug.get("model_mode"), json.dumps(debug.get("stats", {}), ensure_ascii=False)))
+         debug.get("model_mode"), json.dumps(debug.get("stats", {}), ensure_ascii=False),
+         debug.get("prompt_version"), debug.get("patterns_version"),
+         json.dumps(debug.get("intents", {}), ensure_ascii=False),
+         (debug.get("rule") or {}).get("rules_version")))
     conn.commit()
     conn.close()
 
@@ -139,6 +239,7 @@ def clear_history(chat_id: int):
     c = conn.cursor()
     c.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
     c.execute('DELETE FROM debug_logs WHERE chat_id = ?', (chat_id,))
+    c.execute('DELETE FROM chat_slots WHERE chat_id = ?', (chat_id,))
     conn.commit()
     conn.close()
 
@@ -190,18 +291,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_chat_action(chat_id=chat_id, action="typing")
     
     try:
-        current_mode = get_model_mode()
-        os.environ["MODEL_MODE"] = current_mode
-        import sofia_hybrid
-        sofia_hybrid.MODEL_MODE = current_mode
-        
-        response, debug = process_message(history, user_message, client_name)
+        # Модель — аргументом хода, а не глобалью: параллельные ходы не перетирают друг другу режим
+        turn = (history, user_message, client_name, get_slots(chat_id), get_model_mode())
+        if WEBHOOK["concurrent_updates"] > 1:
+            # В отдельном потоке: пока LLM отвечает одному клиенту, апдейты других чатов обрабатываются.
+            # Версии промпта/паттернов/правил/цен ход берёт одним снимком (sofia_hybrid.turn_snapshot)
+            response, debug = await asyncio.to_thread(process_message, *turn)
+        else:
+            # По одному апдейту: ход целиком в цикле событий, подмены — только между ходами
+            response, debug = process_message(*turn)
         
         save_message(chat_id, "assistant", response)
+        save_slots(chat_id, debug["slots"])
         save_debug(chat_id, user_message, response, debug)
         
         logger.info(f"[{chat_id}] {user_name}: {user_message[:50]}...")
-        logger.info(f"[{chat_id}] → {debug['action']} ({debug['reason']}) | Model: {debug.get('model_mode')} | Q: {debug['allow_questions']} → {debug['response_has_question']}")
+        logger.info(f"[{chat_id}] → {debug['action']} ({debug['reason']}) | Model: {debug.get('model_mode')} | Prompt: {debug.get('prompt_version')} | Patterns: {debug.get('patterns_version')} | Q: {debug['allow_questions']} → {debug['response_has_question']}")
         
         await update.message.reply_text(response)
         
@@ -232,6 +337,8 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - "Без разницы": {stats['neutral_answers']}
 - Раздражение: {'🔴 Да' if stats['irritation_detected'] else '🟢 Нет'}
 
+🧾 Слоты: {slot_summary(get_slots(chat_id))}
+
 🤖 Модель: {current_mode}"""
     
     await update.message.reply_text(status)
@@ -294,6 +401,51 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines))
 
 
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    
+    if ADMIN_CHAT_ID and str(chat_id) != str(ADMIN_CHAT_ID):
+        await update.message.reply_text("⛔ Только администратор может перезагружать промпт")
+        return
+    
+    lines = []
+    for reloader in RELOADERS:
+        changed, message = reloader.reload()
+        lines.append(f"{'🔁' if changed else 'ℹ️'} {message}")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <запрос> — поиск по диалогам: лучшие совпадения с chat_id"""
+    chat_id = update.effective_chat.id
+    
+    # Поиск видит сообщения всех клиентов — без ADMIN_CHAT_ID не доступен никому
+    if not ADMIN_CHAT_ID or str(chat_id) != str(ADMIN_CHAT_ID):
+        await update.message.reply_text("⛔ Только администратор может искать по диалогам (нужен ADMIN_CHAT_ID)")
+        return
+    
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /find <запрос>\nНапример: /find ипотека сочи, /find \"не надо\"")
+        return
+    await update.message.reply_text(await asyncio.to_thread(find, DB_PATH, query))
+
+
+async def watch_files():
+    """Следим за файлами; подмена идёт в цикле событий — между ходами"""
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        for reloader in RELOADERS:
+            try:
+                reloader.check()
+            except Exception as e:
+                logger.error(f"Reload {reloader.name} failed: {e}", exc_info=True)
+
+
+async def start_watcher(app: Application):
+    app.bot_data["watcher"] = asyncio.create_task(watch_files())
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = """🤖 Sofia Hybrid v2.0
 
@@ -303,6 +455,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /debug — Последние решения
 /model — Текущая модель
 /model <режим> — Переключить
+/reload — Перечитать промпт, паттерны, правила и цены
+/find <запрос> — Поиск по диалогам
 
 Режимы: gpt-4o, gpt-5.2, gpt-5.2-reasoning"""
     await update.message.reply_text(help_text)
@@ -317,22 +471,31 @@ def main():
     
     saved_mode = get_setting("model_mode", "gpt-5.2")
     os.environ["MODEL_MODE"] = saved_mode
+    sofia_hybrid.MODEL_MODE = saved_mode
+    
+    for reloader in RELOADERS:
+        reloader.reload()
     
     logger.info(f"🚀 Sofia Hybrid Bot v2.0 starting...")
     logger.info(f"🤖 Model mode: {saved_mode}")
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    app = configure_builder(Application.builder().token(TELEGRAM_TOKEN), WEBHOOK).post_init(start_watcher).build()
     
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("status", status_command))
     app.add_handler(CommandHandler("reset", reset_command))
     app.add_handler(CommandHandler("debug", debug_command))
     app.add_handler(CommandHandler("model", model_command))
+    app.add_handler(CommandHandler("reload", reload_command))
+    app.add_handler(CommandHandler("find", find_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
-    logger.info("✅ Bot ready")
-    app.run_polling()
+    logger.info(f"✅ Bot ready ({WEBHOOK['mode']})")
+    if WEBHOOK["mode"] == "webhook":
+        asyncio.run(run_webhook(app, WEBHOOK, logger.info))
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
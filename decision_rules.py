@@ -0,0 +1,154 @@
+# decision_rules.py — правила decide_action из файла вместо захардкоженной цепочки if
+# Правила (decision_rules.json) идут сверху вниз, срабатывает первое подходящее.
+# Условие — выражение над счётчиками analyze_history и признаками текущего сообщения:
+#   "send_requests >= 2 or (send_requests >= 1 and current_send)"
+# Все условия собираются в одну функцию (compile) один раз на версию файла; к решению
+# прикладывается трасса: какое правило сработало и из какой версии правил.
+
+import ast
+import json
+import string
+
+from hot_reload import ReloadError, source_version
+
+# Признаки, доступные в условиях (собирает sofia_hybrid.decision_features)
+RULE_FEATURES = (
+    # analyze_history
+    "total_messages", "user_messages", "bot_messages", "send_requests", "call_rejections",
+    "call_agreements", "neutral_answers", "irritation_detected", "questions_after_last_send",
+    "last_send_request_index", "call_offered",
+    # текущее сообщение
+    "current_send", "current_irritated", "current_rejection", "current_agreement", "current_neutral",
+    # история + текущее
+    "total_rejections", "total_neutral",
+    # слоты квалификации (slots.py); qualified — известны цель, локация и способ оплаты
+    "known_goal", "known_location", "known_budget", "known_payment", "known_timing", "qualified",
+)
+# Подстановки в инструкции: "Узнай, что не выяснено: {missing_slots}"
+TEMPLATE_FIELDS = ("missing_slots", "slot_summary")
+
+RULE_FIELDS = ("name", "when", "action", "allow_questions", "instruction")
+LITERALS = {"true": True, "false": False, "True": True, "False": False}
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.BinOp, ast.Add, ast.Sub,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Name, ast.Load, ast.Constant,
+)
+
+
+class _Substitute(ast.NodeTransformer):
+    """Имя признака → f["имя"], константа и true/false → значение"""
+
+    def __init__(self, constants: dict):
+        self.constants = constants
+
+    def visit_Name(self, node):
+        if node.id in RULE_FEATURES:
+            return ast.copy_location(
+                ast.Subscript(value=ast.Name(id="f", ctx=ast.Load()), slice=ast.Constant(node.id), ctx=ast.Load()),
+                node)
+        value = LITERALS[node.id] if node.id in LITERALS else self.constants[node.id]
+        return ast.copy_location(ast.Constant(value), node)
+
+
+def compile_condition(when: str, constants: dict) -> str:
+    """Условие правила → проверенное выражение Python над f[...]"""
+    try:
+        tree = ast.parse(when, mode="eval")
+    except SyntaxError as e:
+        raise ReloadError(f"условие {when!r}: {e.msg}")
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ReloadError(f"условие {when!r}: недопустимо {type(node).__name__}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ReloadError(f"условие {when!r}: только числа")
+        if isinstance(node, ast.Name) and node.id not in RULE_FEATURES and node.id not in LITERALS \
+                and node.id not in constants:
+            raise ReloadError(f"условие {when!r}: неизвестное имя {node.id}")
+    return ast.unparse(_Substitute(constants).visit(tree).body)
+
+
+class RuleSet:
+    """
+    Скомпилированные правила одной версии файла.
+    decide(признаки) → решение как у decide_action + "trace" (правило, номер, версия правил).
+    """
+
+    def __init__(self, rules: list, constants: dict, version: str = None):
+        self.rules = rules
+        self.constants = constants
+        self.version = version
+        lines = ["def _first_rule(f):"]
+        for i, rule in enumerate(rules):
+            lines.append(f"    if {compile_condition(rule['when'], constants)}: return {i}")
+        lines.append("    return -1")
+        namespace = {"__builtins__": {}}
+        exec(compile("\n".join(lines), f"<decision_rules {version}>", "exec"), namespace)
+        self._first_rule = namespace["_first_rule"]
+        self.source = "\n".join(lines)
+
+    def first_rule(self, features: dict) -> int:
+        return self._first_rule(features)
+
+    def decide(self, features: dict) -> dict:
+        index = self._first_rule(features)
+        if index < 0:
+            raise ReloadError(f"правила {self.version}: ни одно не сработало")
+        rule = self.rules[index]
+        instruction = rule["instruction"]
+        if "{" in instruction:
+            instruction = instruction.format_map(features)
+        return {
+            "action": rule["action"],
+            "allow_questions": rule["allow_questions"],
+            "reason": rule["name"],
+            "instruction": instruction,
+            "trace": {"rule": rule["name"], "index": index, "rules_version": self.version},
+        }
+
+
+def load_rules(source: str) -> RuleSet:
+    """
+    decision_rules.json → RuleSet (load для HotReloader).
+    {"constants": {"MAX_MESSAGES": 14}, "rules": [{"name", "when", "action", "allow_questions", "instruction"}]}
+    Последнее правило должно срабатывать всегда ("when": "true") — решение есть на любой ход.
+    """
+    try:
+        config = json.loads(source)
+    except json.JSONDecodeError as e:
+        raise ReloadError(f"JSON: {e}")
+    constants = config.get("constants", {})
+    rules = config.get("rules")
+    if not isinstance(constants, dict) or not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in constants.values()):
+        raise ReloadError("constants: ожидается {имя: число}")
+    clashes = set(constants) & (set(RULE_FEATURES) | set(LITERALS))
+    if clashes:
+        raise ReloadError(f"constants: имена заняты признаками: {', '.join(sorted(clashes))}")
+    if not isinstance(rules, list) or not rules:
+        raise ReloadError("rules: ожидается непустой список")
+
+    names = set()
+    for i, rule in enumerate(rules):
+        missing = [field for field in RULE_FIELDS if field not in rule]
+        if missing:
+            raise ReloadError(f"правило {i}: нет полей {', '.join(missing)}")
+        if rule["name"] in names:
+            raise ReloadError(f"правило {rule['name']}: имя повторяется")
+        if not isinstance(rule["allow_questions"], bool):
+            raise ReloadError(f"правило {rule['name']}: allow_questions — true/false")
+        try:
+            fields = {field for _, field, _, _ in string.Formatter().parse(rule["instruction"]) if field is not None}
+        except ValueError as e:
+            raise ReloadError(f"правило {rule['name']}: инструкция: {e}")
+        unknown = fields - set(TEMPLATE_FIELDS) - set(RULE_FEATURES)
+        if unknown:
+            raise ReloadError(f"правило {rule['name']}: неизвестные подстановки {', '.join(sorted(unknown))}")
+        names.add(rule["name"])
+    if rules[-1]["when"].strip().lower() != "true":
+        raise ReloadError(f"последнее правило ({rules[-1]['name']}) должно быть \"when\": \"true\"")
+    return RuleSet(rules, constants, source_version(source))
+
+
+def load_rules_file(path: str) -> RuleSet:
+    with open(path, "r", encoding="utf-8") as f:
+        return load_rules(f.read())
@@ -0,0 +1,210 @@
+# examples_index.py — удачные ответы Софии как примеры для промпта (BM25 в памяти процесса)
+# Эксперты оценивают ответы в feedback_v2; оценки GOOD — готовые образцы тона и хода разговора.
+# Индекс: реплика клиента + предыдущая реплика Софии, нормализованные (text_normalize, со стеммингом),
+# BM25 по постинг-листам. Новые оценки добавляются по одной (sync после каждой оценки),
+# каждая сразу дописывается строкой в файл индекса — при старте индекс читается с диска, а не строится заново.
+
+import heapq
+import json
+import math
+import os
+import sqlite3
+
+from text_normalize import normalize_text
+
+INDEX_VERSION = 1
+STEM = True
+K1 = 1.5
+B = 0.75
+TOP_K = 3
+MIN_TOKEN_LEN = 2
+# Кэш запросов: короткие ответы клиентов ("да", "давайте", "скиньте") повторяются постоянно
+QUERY_CACHE_SIZE = 4096
+# Сколько лучших кандидатов держать на запрос (фильтр по чату и повторам ответа — уже после)
+CANDIDATES = 200
+# Длина реплики в примере для промпта — примеры должны быть короче самого промпта
+EXAMPLE_MAX_CHARS = 200
+EXAMPLES_HEADER = "ПРИМЕРЫ УДАЧНЫХ ОТВЕТОВ (оценены экспертами; бери тон и ход мысли, не копируй дословно):"
+
+
+def tokenize(text: str) -> list:
+    return [t for t in normalize_text(text or "", STEM).split() if len(t) >= MIN_TOKEN_LEN]
+
+
+def term_counts(text: str) -> dict:
+    counts = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+def exchange_from_context(context: list):
+    """
+    Контекст оценки → (реплика Софии до клиента, реплика клиента, ответ Софии) или None.
+    Оцененный ответ — последний ответ Софии в контексте; подряд идущие сообщения клиента склеиваются.
+    """
+    end = max((i for i, m in enumerate(context) if m.get("role") == "assistant"), default=None)
+    if end is None:
+        return None
+    start = end
+    while start > 0 and context[start - 1].get("role") == "user":
+        start -= 1
+    client = "\n".join(m.get("content", "") for m in context[start:end]).strip()
+    if not client:
+        return None
+    before = context[start - 1].get("content", "") if start > 0 else ""
+    return before, client, context[end].get("content", "").strip()
+
+
+def shorten(text: str, limit: int = EXAMPLE_MAX_CHARS) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+class ExamplesIndex:
+    """
+    BM25 по удачным обменам репликами.
+    docs: id оценки → {"chat_id", "before", "client", "reply"}; postings: терм → {id: tf}.
+    IDF считается при запросе, нормировки длин — при первом запросе после добавления;
+    кэш запросов сбрасывается, когда индекс меняется.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.docs = {}
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+        self._norms = None
+        self._cache = {}
+
+    @property
+    def last_id(self) -> int:
+        return max(self.docs, default=0)
+
+    def _index(self, doc_id: int, counts: dict, doc: dict):
+        self.docs[doc_id] = doc
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        length = sum(counts.values())
+        self.lengths[doc_id] = length
+        self.total_length += length
+        self._norms = None
+        self._cache.clear()
+
+    def add(self, doc_id: int, chat_id, before: str, client: str, reply: str) -> bool:
+        """Добавить обмен (и дописать в файл); False — уже в индексе или пустой"""
+        if doc_id in self.docs or not reply:
+            return False
+        counts = term_counts(f"{before}\n{client}")
+        if not counts:
+            return False
+        doc = {"chat_id": chat_id, "before": before, "client": client, "reply": reply}
+        self._index(doc_id, counts, doc)
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                if os.path.getsize(self.path) == 0:
+                    f.write(json.dumps({"version": INDEX_VERSION, "stem": STEM}) + "\n")
+                f.write(json.dumps({"id": doc_id, "terms": counts, **doc}, ensure_ascii=False) + "\n")
+        return True
+
+    @classmethod
+    def load(cls, path: str) -> "ExamplesIndex":
+        """Индекс из файла; файл другой версии или нормализации — начинаем с пустого"""
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        with open(path, "r", encoding="utf-8") as f:
+            header = f.readline()
+            try:
+                meta = json.loads(header) if header.strip() else {}
+            except ValueError:
+                meta = {}
+            if meta == {"version": INDEX_VERSION, "stem": STEM}:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка (процесс остановили на записи)
+                    doc_id, counts = row.pop("id"), row.pop("terms")
+                    index._index(doc_id, counts, row)
+                return index
+        os.replace(path, path + ".old")
+        return index
+
+    def _ranked(self, terms: tuple) -> list:
+        """Лучшие CANDIDATES [(id, оценка)] по убыванию — без фильтров, для кэша"""
+        n = len(self.docs)
+        if self._norms is None:
+            avg_length = self.total_length / n
+            self._norms = {doc_id: K1 * (1 - B + B * length / avg_length) for doc_id, length in self.lengths.items()}
+        norms, scores, boost = self._norms, {}, K1 + 1
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * boost / (tf + norms[doc_id])
+        return heapq.nlargest(CANDIDATES, scores.items(), key=lambda item: item[1])
+
+    def search(self, text: str, before: str = "", k: int = TOP_K, exclude_chat=None) -> list:
+        """Топ-k обменов, похожих на текущий ход: [(оценка, doc)]; повторы одного ответа схлопываются"""
+        if not self.docs:
+            return []
+        terms = tuple(sorted(set(tokenize(f"{before}\n{text}"))))
+        ranked = self._cache.get(terms)
+        if ranked is None:
+            if len(self._cache) >= QUERY_CACHE_SIZE:
+                self._cache.clear()
+            ranked = self._cache[terms] = self._ranked(terms)
+
+        results, replies = [], set()
+        for doc_id, score in ranked:
+            doc = self.docs[doc_id]
+            if exclude_chat is not None and doc["chat_id"] == exclude_chat:
+                continue
+            if doc["reply"] in replies:
+                continue
+            replies.add(doc["reply"])
+            results.append((score, doc))
+            if len(results) == k:
+                break
+        return results
+
+    def sync(self, db_path: str) -> int:
+        """Дочитать из базы бота новые оценки GOOD (id > последнего в индексе). Возвращает, сколько добавлено."""
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        if 'feedback_v2' not in {row[0] for row in c.fetchall()}:
+            conn.close()
+            return 0
+        c.execute('PRAGMA table_info(feedback_v2)')
+        has_ids = 'msg_to_id' in {row[1] for row in c.fetchall()}
+        columns = "id, chat_id, context" + (", msg_from_id, msg_to_id" if has_ids else ", NULL, NULL")
+        c.execute(f"SELECT {columns} FROM feedback_v2 WHERE rating = 'good' AND id > ? ORDER BY id", (self.last_id,))
+        added = 0
+        for feedback_id, chat_id, context, from_id, to_id in c.fetchall():
+            if from_id is not None and not context:
+                c.execute('SELECT role, content FROM messages WHERE chat_id = ? AND id BETWEEN ? AND ? ORDER BY id',
+                          (chat_id, from_id, to_id))
+                ctx = [{"role": role, "content": content} for role, content in c.fetchall()]
+            else:
+                try:
+                    ctx = json.loads(context) if context else []
+                except ValueError:
+                    ctx = []
+            exchange = exchange_from_context(ctx)
+            if exchange and self.add(feedback_id, chat_id, *exchange):
+                added += 1
+        conn.close()
+        return added
+
+
+def format_examples(results: list) -> str:
+    """Найденные обмены → компактный блок few-shot для промпта ("" — примеров нет)"""
+    if not results:
+        return ""
+    blocks = [f"Клиент: {shorten(doc['client'])}\nСофия: {shorten(doc['reply'])}" for _, doc in results]
+    return EXAMPLES_HEADER + "\n" + "\n\n".join(blocks)
@@ -0,0 +1,199 @@
+# fts_search.py — полнотекстовый поиск по диалогам и комментариям экспертов (SQLite FTS5)
+# Раньше диалог искали grep по логам анализатора или выгрузкой таблиц.
+# Теперь у conversations / messages / feedback_v2 есть зеркальные FTS5-таблицы (external content:
+# текст не дублируется, хранится только индекс). Триггеры держат их в синхронизации при любой записи,
+# старые строки индексируются один раз при создании. Ищут /find в ботах, mine_patterns (--find)
+# и анализатор (ANALYZER_FOCUS).
+
+import sqlite3
+import time
+
+from text_normalize import normalize_text
+
+# Таблица → (FTS-таблица, колонка с текстом, колонки для выдачи)
+FTS_SOURCES = {
+    "conversations": ("conversations_fts", "content", ("chat_id", "role", "timestamp")),
+    "messages": ("messages_fts", "content", ("chat_id", "role", "timestamp")),
+    "feedback_v2": ("feedback_fts", "comment", ("chat_id", "rating", "timestamp")),
+}
+# Регистр и диакритика — в unicode61; префиксные индексы — для запросов "ипотек*".
+# ё для unicode61 — отдельная буква, а запрос проходит normalize_text (ё → е): в индекс кладём текст
+# с ё → е (fold_sql в триггерах и при наполнении), иначе "всё", "ещё" не находятся никак
+TOKENIZER = "unicode61 remove_diacritics 2"
+PREFIX = "2 3 4"
+SNIPPET_TOKENS = 12
+FIND_LIMIT = 10
+# Символы синтаксиса FTS5: запрос с ними передаётся как есть ("сочи NEAR рассрочк*", "\"не надо\"")
+FTS_SYNTAX = ('"', '*', '(', ')', ' AND ', ' OR ', ' NOT ', 'NEAR', ':', '^')
+
+
+def fold_sql(value: str) -> str:
+    """SQL-выражение: текст колонки с ё → е (как в normalize_text)"""
+    return f"replace(replace({value}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def fts_available() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+def ensure_fts(conn) -> list:
+    """
+    FTS-зеркала и триггеры для тех таблиц, что есть в базе (идемпотентно).
+    Возвращает таблицы, проиндексированные сейчас (впервые или заново — индекс без свёртки ё).
+    Проверка и создание — в одной транзакции с блокировкой записи: шарды (shard_supervisor.py)
+    стартуют на одной базе одновременно, и второй должен увидеть таблицы первого, а не создавать их заново.
+    """
+    c = conn.cursor()
+    if not conn.in_transaction:
+        c.execute("BEGIN IMMEDIATE")
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'trigger')")
+    existing = dict(c.fetchall())
+    created = []
+    for table, (fts, column, _) in FTS_SOURCES.items():
+        if table not in existing:
+            continue
+        new, old = fold_sql(f"new.{column}"), fold_sql(f"old.{column}")
+        if fts not in existing:
+            c.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', content_rowid='id', "
+                      f"tokenize='{TOKENIZER}', prefix='{PREFIX}')")
+        elif f"{fts}_ai" in existing and "replace(" in existing[f"{fts}_ai"]:
+            continue
+        # Новый индекс или индекс без свёртки ё: триггеры заново, строки — свёрнутыми
+        # ('rebuild' читал бы текст из таблицы как есть)
+        for suffix in ("ai", "ad", "au"):
+            c.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+        c.execute(f"INSERT INTO {fts}({fts}) VALUES ('delete-all')")
+        c.execute(f"INSERT INTO {fts}(rowid, {column}) SELECT id, {fold_sql(column)} FROM {table}")
+        created.append(table)
+        # По одному execute: executescript закоммитил бы транзакцию и снял блокировку
+        c.execute(f"""
+            CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, {new});
+            END""")
+        c.execute(f"""
+            CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, {old});
+            END""")
+        c.execute(f"""
+            CREATE TRIGGER {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, {old});
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, {new});
+            END""")
+    conn.commit()
+    return created
+
+
+def check_folding():
+    """
+    Проверка на старте: индекс и запрос сворачивают текст одинаково ("всё", "Всё", "ещё" находят строку с ё).
+    Расхождение — RuntimeError: иначе такие слова молча не находились бы через /find.
+    """
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, content TEXT)")
+        ensure_fts(conn)
+        conn.execute("INSERT INTO messages (chat_id, content) VALUES (1, 'Всё равно ещё подумаю')")
+        missed = [query for query in ("всё равно", "Всё", "ещё", "еще") if not search(conn, query, tables=("messages",))]
+    finally:
+        conn.close()
+    if missed:
+        raise RuntimeError(f"FTS: не находится {', '.join(missed)} — индекс и запрос нормализуют ё по-разному")
+
+
+def init_fts(db_path: str) -> list:
+    """ensure_fts для init_db ботов; без FTS5 в сборке SQLite — пустой список"""
+    if not fts_available():
+        return []
+    check_folding()
+    # Пока другой шард строит индекс (rebuild большой базы), ждём его, а не падаем на "database is locked"
+    conn = sqlite3.connect(db_path, timeout=120)
+    created = ensure_fts(conn)
+    conn.close()
+    return created
+
+
+def to_fts_query(query: str) -> str:
+    """
+    Текст админа → запрос FTS5: слова через AND, каждое — префиксом основы
+    ("ипотеку сочи" → "ипотек"* AND "сочи"*). В запросе с синтаксисом FTS5 только сворачиваем ё, как в индексе.
+    """
+    if any(mark in query for mark in FTS_SYNTAX):
+        return query.replace("ё", "е").replace("Ё", "Е")
+    words = [word for word in normalize_text(query, True).split() if len(word) >= 2]
+    return " AND ".join(f'"{word}"*' for word in words)
+
+
+def search(conn, query: str, limit: int = FIND_LIMIT, tables=None) -> list:
+    """
+    Лучшие совпадения по всем зеркалам: [{"table", "id", "chat_id", "role"/"rating", "timestamp",
+    "snippet", "rank"}], rank — bm25 (меньше — лучше). Ошибка синтаксиса запроса → sqlite3.OperationalError.
+    """
+    match = to_fts_query(query)
+    if not match:
+        return []
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in c.fetchall()}
+    results = []
+    for table, (fts, column, fields) in FTS_SOURCES.items():
+        if fts not in existing or (tables and table not in tables):
+            continue
+        c.execute(f"PRAGMA table_info({table})")
+        present = {row[1] for row in c.fetchall()}
+        fields = [field for field in fields if field in present]
+        columns = ", ".join(f"t.{field}" for field in fields)
+        c.execute(f"""
+            SELECT t.id, {columns + ", " if columns else ""}snippet({fts}, 0, '«', '»', '…', {SNIPPET_TOKENS}), {fts}.rank
+            FROM {fts} JOIN {table} t ON t.id = {fts}.rowid
+            WHERE {fts} MATCH ? ORDER BY {fts}.rank LIMIT ?
+        """, (match, limit))
+        for row in c.fetchall():
+            item = {"table": table, "id": row[0], "snippet": row[-2], "rank": row[-1]}
+            item.update(zip(fields, row[1:-2]))
+            results.append(item)
+    results.sort(key=lambda item: item["rank"])
+    return results[:limit]
+
+
+def find_chat_ids(db_path: str, query: str, limit: int = 100000) -> set:
+    """chat_id диалогов, где встречается запрос (в сообщениях или комментариях) — для mine_patterns и анализатора"""
+    conn = sqlite3.connect(db_path)
+    ensure_fts(conn)
+    chat_ids = {item["chat_id"] for item in search(conn, query, limit)}
+    conn.close()
+    return chat_ids
+
+
+def format_results(query: str, results: list, elapsed_ms: float) -> str:
+    """Ответ на /find: по строке на совпадение"""
+    if not results:
+        return f"🔎 «{query}»: ничего не найдено ({elapsed_ms:.0f} мс)"
+    lines = [f"🔎 «{query}»: {len(results)} совп. ({elapsed_ms:.0f} мс)"]
+    for i, item in enumerate(results, 1):
+        if item["table"] == "feedback_v2":
+            who = f"💬 оценка {item.get('rating')}"
+        else:
+            who = "👤" if item.get("role") == "user" else "🤖"
+        day = (item.get("timestamp") or "")[:10]
+        lines.append(f"{i}. [{item['chat_id']}] {who}{' ' + day if day else ''}: {item['snippet']}")
+    return "\n".join(lines)
+
+
+def find(db_path: str, query: str, limit: int = FIND_LIMIT) -> str:
+    """/find для ботов: поиск + готовый текст ответа"""
+    conn = sqlite3.connect(db_path)
+    started = time.perf_counter()
+    try:
+        results = search(conn, query, limit)
+    except sqlite3.OperationalError as e:
+        return f"❌ Запрос не разобран: {e}"
+    finally:
+        conn.close()
+    return format_results(query, results, (time.perf_counter() - started) * 1000)
@@ -0,0 +1,139 @@
+# fuzzy_match.py — поиск фраз-паттернов с опечатками
+# "скинте", "отправте", "сикньте", "не хочу звонитт" — точная подстрока их не находит.
+# Индекс удалений (SymSpell) по первым словам паттернов строится один раз на версию списка;
+# на сообщение — несколько поисков в словаре на слово, кандидаты по слову кэшируются.
+# Работает поверх точного regex: сначала точный поиск, нечёткий — только если тот промахнулся.
+
+from functools import lru_cache
+
+# Сколько опечаток прощаем слову паттерна по его длине: короткие ("да", "хз", "пока") — только точно
+FUZZY_EDITS = ((5, 1), (9, 2))
+WORD_CACHE_SIZE = 20000
+
+
+def max_edits(word: str) -> int:
+    edits = 0
+    for length, allowed in FUZZY_EDITS:
+        if len(word) >= length:
+            edits = allowed
+    return edits
+
+
+def deletions(word: str, depth: int) -> set:
+    """Слово и всё, что получается удалением до depth букв"""
+    result = {word}
+    frontier = {word}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        result |= frontier
+    return result
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Расстояние Дамерау–Левенштейна (перестановка соседних букв = 1); больше limit → limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def word_matches(pattern_word: str, word: str, prefix: bool) -> bool:
+    """
+    Слово паттерна против слова сообщения. prefix — у паттерна открытый конец ("звон" → "звонок"):
+    сравниваем с началом слова той же длины (± опечатки), короче паттерна не берём.
+    """
+    edits = max_edits(pattern_word)
+    if not edits:
+        return word.startswith(pattern_word) if prefix else word == pattern_word
+    if not prefix:
+        return edit_distance(pattern_word, word, edits) <= edits
+    length = len(pattern_word)
+    return any(
+        edit_distance(pattern_word, word[:n], edits) <= edits
+        for n in range(length - edits, min(len(word), length + edits) + 1)
+        if n >= length or n == len(word)
+    )
+
+
+class FuzzyMatcher:
+    """
+    Точный regex + нечёткий поиск по словам. search() как у re.Pattern: None — совпадения нет,
+    иначе точное совпадение или паттерн, который нашёлся с опечатками.
+    Фраза ищется по словам с начала слова сообщения: "давайте звон" ловит "давайти звонок".
+    """
+
+    def __init__(self, patterns, exact):
+        self.exact = exact
+        self.phrases = []        # (слова, открыт ли конец последнего слова, паттерн)
+        self.index = {}          # удаление первого слова → номера фраз
+        self.prefix_lengths = set()
+        self.depth = 0
+        self._cache = {}         # слово сообщения → фразы, чьё первое слово с ним совпало
+
+        for pattern in sorted(patterns):
+            words = pattern.split()
+            if not any(max_edits(w) for w in words):
+                continue  # опечатки в нём не прощаются — хватит точного regex
+            open_end = not pattern.endswith(" ")
+            number = len(self.phrases)
+            self.phrases.append((words, open_end, pattern))
+            first = words[0]
+            edits = max_edits(first)
+            self.depth = max(self.depth, edits)
+            if open_end and len(words) == 1:
+                self.prefix_lengths.update(range(len(first), len(first) + edits + 1))
+            for key in deletions(first, edits):
+                self.index.setdefault(key, set()).add(number)
+
+    def _first_word_hits(self, word: str) -> tuple:
+        hits = self._cache.get(word)
+        if hits is not None:
+            return hits
+        keys = {word} | {word[:n] for n in self.prefix_lengths if n < len(word)}
+        candidates = set()
+        for key in keys:
+            # слову паттерна длиной до len(key) + depth прощается не больше max_edits опечаток
+            depth = min(self.depth, max_edits("-" * (len(key) + self.depth)))
+            for deleted in deletions(key, depth):
+                candidates.update(self.index.get(deleted, ()))
+        hits = tuple(sorted(
+            number for number in candidates
+            if word_matches(self.phrases[number][0][0], word,
+                            self.phrases[number][1] and len(self.phrases[number][0]) == 1)
+        ))
+        if len(self._cache) >= WORD_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[word] = hits
+        return hits
+
+    def fuzzy_search(self, text: str):
+        """Только нечёткая часть: паттерн, совпавший с опечатками, или None"""
+        for line in text.split("\n"):
+            words = line.split()
+            for start, word in enumerate(words):
+                for number in self._first_word_hits(word):
+                    phrase, open_end, pattern = self.phrases[number]
+                    rest = words[start + 1:start + len(phrase)]
+                    if len(rest) != len(phrase) - 1:
+                        continue
+                    if all(
+                        word_matches(p, w, open_end and i == len(rest) - 1)
+                        for i, (p, w) in enumerate(zip(phrase[1:], rest))
+                    ):
+                        return pattern
+        return None
+
+    def search(self, text: str):
+        return self.exact.search(text) or self.fuzzy_search(text)
@@ -0,0 +1,325 @@
+# hot_reload.py — горячая перезагрузка промпта и паттернов без рестарта бота
+# Файл перечитывается при изменении (или по команде /reload), новая версия
+# проверяется и подменяется одной операцией — текущий ход доигрывает на старой.
+# Если новая версия невалидна — файл откатывается на работающую версию
+# (на последний бэкап — только если ничего ещё не загружено, то есть при старте).
+# Файл на диске откатывает один процесс (write_files): у шардов shard_supervisor.py — шард 0.
+
+import ast
+import hashlib
+import json
+import os
+import re
+import time
+import types
+
+from fuzzy_match import FuzzyMatcher
+from prompt_patch import validate_prompt_source
+from text_normalize import normalize_pattern, normalize_text
+
+# Файл должен «отлежаться» — не читаем его посреди записи
+SETTLE_SECONDS = 1.0
+
+# Списки паттернов sofia_hybrid.py, которые подменяются на лету
+HYBRID_PATTERN_NAMES = (
+    "SEND_PATTERNS", "CALL_REJECT_PATTERNS", "NEUTRAL_PATTERNS",
+    "IRRITATED_PATTERNS", "CALL_AGREE_PATTERNS",
+)
+
+
+class ReloadError(ValueError):
+    """Новая версия файла не прошла проверку"""
+
+
+def source_version(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:8]
+
+
+def load_prompt_module(source: str):
+    """sofia_prompt.py → отдельный объект модуля (sys.modules не трогаем)"""
+    ok, error = validate_prompt_source(source)
+    if not ok:
+        raise ReloadError(error)
+    module = types.ModuleType("sofia_prompt")
+    exec(compile(source, "sofia_prompt.py", "exec"), module.__dict__)
+    return module
+
+
+def load_hybrid_patterns(source: str) -> dict:
+    """Достаём списки паттернов из sofia_hybrid.py без исполнения модуля"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        raise ReloadError(f"Синтаксическая ошибка: {e}")
+
+    patterns = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if isinstance(target, ast.Name) and target.id in HYBRID_PATTERN_NAMES:
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                raise ReloadError(f"{target.id}: ожидается список строк")
+            if not isinstance(value, list) or not all(isinstance(p, str) and p.strip() for p in value):
+                raise ReloadError(f"{target.id}: ожидается список непустых строк")
+            if any(p != p.lower() for p in value):
+                raise ReloadError(f"{target.id}: паттерны сравниваются с text.lower() — нужны строчные")
+            patterns[target.id] = value
+
+    missing = [name for name in HYBRID_PATTERN_NAMES if name not in patterns]
+    if missing:
+        raise ReloadError(f"Нет списков: {', '.join(missing)}")
+    return patterns
+
+
+def pattern_regex(patterns) -> str:
+    """
+    Список фраз → regex-дерево по общим префиксам: "есть ли хоть одна фраза в тексте"
+    за один проход search вместо any(p in text ...). Фраза, у которой есть более короткий
+    префикс из списка ("скинь" / "скиньте"), не нужна — совпадёт префикс.
+    """
+    trie = {}
+    for phrase in patterns:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node):
+        if '' in node:
+            return ''
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return build(trie) if trie else r'(?!)'
+
+
+def compile_patterns(patterns: dict, fuzzy=()) -> dict:
+    """
+    Списки паттернов → {имя: скомпилированный regex}; собирается один раз на версию.
+    Паттерны нормализуются (text_normalize) — искать нужно в normalize_text(сообщение).
+    Списки из fuzzy дополнительно ловят опечатки (FuzzyMatcher, тот же search()).
+    """
+    compiled = {}
+    for name, values in patterns.items():
+        normalized = {normalize_pattern(p) for p in values} - {""}
+        compiled[name] = re.compile(pattern_regex(normalized))
+        if name in fuzzy:
+            compiled[name] = FuzzyMatcher(normalized, compiled[name])
+    return compiled
+
+
+def parse_fuzzy_names(value: str) -> tuple:
+    """FUZZY_PATTERNS: "SEND,CALL_REJECT" / "SEND_PATTERNS" / "all" → имена списков"""
+    names = []
+    for item in value.split(","):
+        item = item.strip().upper()
+        if item == "ALL":
+            return HYBRID_PATTERN_NAMES
+        if item:
+            name = item if item.endswith("_PATTERNS") else f"{item}_PATTERNS"
+            if name not in HYBRID_PATTERN_NAMES:
+                raise ValueError(f"FUZZY_PATTERNS: неизвестный список {item}")
+            names.append(name)
+    return tuple(names)
+
+
+def load_labelled_messages(path: str) -> list:
+    """
+    Размеченные сообщения для проверки паттернов (JSONL):
+    {"text": "...", "labels": ["IRRITATED_PATTERNS"]} — какие списки должны сработать, [] — никакие
+    """
+    messages = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                messages.append((normalize_text(item["text"]), set(item.get("labels", []))))
+    return messages
+
+
+def evaluate_patterns(matchers: dict, labelled: list) -> dict:
+    """Точность и полнота каждого списка на размеченных сообщениях"""
+    metrics = {}
+    for name, matcher in matchers.items():
+        tp = fp = fn = 0
+        for text, labels in labelled:
+            hit = matcher.search(text) is not None
+            expected = name in labels
+            tp += hit and expected
+            fp += hit and not expected
+            fn += expected and not hit
+        metrics[name] = {
+            "tp": tp, "fp": fp, "fn": fn,
+            "precision": tp / (tp + fp) if tp + fp else 1.0,
+            "recall": tp / (tp + fn) if tp + fn else 1.0,
+        }
+    return metrics
+
+
+def format_metrics(metrics: dict) -> str:
+    return ", ".join(
+        f"{name.replace('_PATTERNS', '')} p={m['precision']:.2f} r={m['recall']:.2f}"
+        for name, m in metrics.items()
+    )
+
+
+def make_patterns_loader(labelled_path: str = None, min_precision: float = 0.0, min_recall: float = 0.0,
+                         logger=print, fuzzy=()):
+    """
+    load для HotReloader паттернов: разбор + проверка на размеченных сообщениях.
+    Список ниже порогов точности/полноты — ReloadError (новая версия не подменяется).
+    """
+    def load(source: str) -> dict:
+        patterns = load_hybrid_patterns(source)
+        if not labelled_path or not os.path.exists(labelled_path):
+            return patterns
+        metrics = evaluate_patterns(compile_patterns(patterns, fuzzy), load_labelled_messages(labelled_path))
+        logger(f"🧪 patterns {source_version(source)}: {format_metrics(metrics)}")
+        failed = [
+            name for name, m in metrics.items()
+            if m["precision"] < min_precision or m["recall"] < min_recall
+        ]
+        if failed:
+            raise ReloadError(f"Ниже порогов (p≥{min_precision}, r≥{min_recall}): {', '.join(failed)}")
+        return patterns
+
+    return load
+
+
+class HotReloader:
+    """
+    Держит загруженную версию файла.
+    load(source) → объект или ReloadError; on_swap(объект, версия) вызывается после подмены.
+    write_files=False — файл только читаем: при откате остаёмся на работающей версии, файл не трогаем
+    (его пишет другой процесс — шарды мешали бы друг другу в {path}.tmp — или это модуль с кодом).
+    """
+
+    def __init__(self, name, path, load, backup_dir=None, backup_prefix=None, on_swap=None, logger=print,
+                 write_files=True):
+        self.name = name
+        self.path = path
+        self.load = load
+        self.backup_dir = backup_dir
+        self.backup_prefix = backup_prefix
+        self.on_swap = on_swap
+        self.log = logger
+        self.write_files = write_files
+        self._state = (None, None)  # (объект, версия) — подменяется целиком
+        self._source = None
+        self._stat = None
+
+    @property
+    def current(self):
+        return self._state[0]
+
+    @property
+    def version(self):
+        return self._state[1]
+
+    def snapshot(self):
+        """(объект, версия) на весь ход — берите в начале хода"""
+        return self._state
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def _file_stat(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _swap(self, obj, source):
+        version = source_version(source)
+        self._state = (obj, version)
+        self._source = source
+        if self.on_swap:
+            self.on_swap(obj, version)
+        return version
+
+    def _write(self, source):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(source)
+        os.replace(tmp_path, self.path)
+
+    def _latest_backup(self):
+        if not self.backup_dir or not self.backup_prefix or not os.path.isdir(self.backup_dir):
+            return None
+        backups = sorted(f for f in os.listdir(self.backup_dir) if f.startswith(self.backup_prefix))
+        return os.path.join(self.backup_dir, backups[-1]) if backups else None
+
+    def rollback(self, reason):
+        """
+        Откат файла на работающую версию. Бэкап — только когда ничего не загружено (старт с битым файлом):
+        бэкап может быть старше работающей версии, и опечатка не должна откатывать прод на неё.
+        """
+        candidates = []
+        if self._source is not None:
+            candidates.append(("работающая версия", self._source))
+        else:
+            backup_path = self._latest_backup()
+            if backup_path:
+                with open(backup_path, "r", encoding="utf-8") as f:
+                    candidates.append((os.path.basename(backup_path), f.read()))
+
+        for label, source in candidates:
+            try:
+                obj = self.load(source)
+            except Exception:
+                continue
+            if self.write_files:
+                self._write(source)
+                self._stat = self._file_stat()
+            if source_version(source) != self.version:
+                self._swap(obj, source)
+            if self.write_files:
+                self.log(f"↩️ {self.name}: откат на {label} ({self.version}) — {reason}")
+            else:
+                self.log(f"↩️ {self.name}: остаёмся на {label} ({self.version}), файл не переписываем — {reason}")
+            return True
+
+        self.log(f"❌ {self.name}: откатывать некуда, остаётся {self.version} — {reason}")
+        return False
+
+    def reload(self, force=False):
+        """Перечитываем файл. Возвращает (подменили ли версию, сообщение)."""
+        try:
+            source = self._read()
+            stat = self._file_stat()
+        except OSError as e:
+            return False, f"{self.name}: файл недоступен: {e}"
+
+        version = source_version(source)
+        self._stat = stat
+        if version == self.version and not force:
+            return False, f"{self.name}: без изменений ({version})"
+
+        try:
+            obj = self.load(source)
+        except Exception as e:
+            reason = f"{type(e).__name__}: {e}"
+            if not self.rollback(reason) and self.version is None:
+                raise ReloadError(f"{self.name}: {reason}")
+            return False, f"{self.name}: новая версия {version} невалидна ({reason}), работает {self.version}"
+
+        old_version = self.version
+        self._swap(obj, source)
+        if old_version is None:
+            self.log(f"📦 {self.name}: загружена версия {version}")
+        else:
+            self.log(f"🔁 {self.name}: {old_version} → {version}")
+        return True, f"{self.name}: {old_version} → {version}"
+
+    def check(self):
+        """Для периодического опроса: перечитываем, только если файл изменился и «отлежался»"""
+        try:
+            stat = self._file_stat()
+        except OSError:
+            return False
+        if stat == self._stat or time.time() - stat[0] / 1e9 < SETTLE_SECONDS:
+            return False
+        changed, _ = self.reload()
+        return changed
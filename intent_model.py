@@ -0,0 +1,145 @@
+# intent_model.py — классификатор намерений клиента рядом со списками паттернов
+# Подстроки не отличают "не знаю" (нейтрально) от "не знаю, сколько можно" (раздражение).
+# Модель: хэшированные символьные n-граммы, слова и пары слов нормализованного текста →
+# логистическая регрессия на каждое намерение (one-vs-rest, сообщение может быть "лучше скиньте" —
+# и просьба, и отказ от созвона). Обучается офлайн (scripts/train_intents.py), файл — десятки КБ.
+
+import array
+import hashlib
+import json
+import math
+import struct
+import zlib
+from functools import lru_cache
+
+from text_normalize import normalize_text
+
+INTENTS = ("send", "call_reject", "call_agree", "neutral", "irritated")
+
+# Намерение → список паттернов sofia_hybrid (разметка и слабые метки — в именах списков)
+INTENT_PATTERNS = {
+    "send": "SEND_PATTERNS",
+    "call_reject": "CALL_REJECT_PATTERNS",
+    "call_agree": "CALL_AGREE_PATTERNS",
+    "neutral": "NEUTRAL_PATTERNS",
+    "irritated": "IRRITATED_PATTERNS",
+}
+
+HASH_BITS = 18
+CHAR_NGRAMS = (2, 3, 4)
+MAX_CHARS = 400  # длинные сообщения режем: намерение видно в начале, а время — линейно от длины
+MAGIC = b"SFIM1"
+DEFAULT_THRESHOLD = 0.5
+
+
+def feature_buckets(text: str, bits: int = HASH_BITS) -> tuple:
+    """
+    Сообщение → номера корзин признаков (без повторов). Вес у всех одинаковый — 1/√число,
+    поэтому длина сообщения не раздувает уверенность. crc32 — стабилен между запусками (hash() — нет).
+    """
+    norm = normalize_text(text[:MAX_CHARS])
+    keys = set()
+    for n in CHAR_NGRAMS:
+        keys.update(norm[i:i + n] for i in range(len(norm) - n + 1))
+    words = norm.split()
+    keys.update("\x01" + w for w in words)
+    keys.update("\x02" + a + " " + b for a, b in zip(words, words[1:]))
+    mask = (1 << bits) - 1
+    return tuple({zlib.crc32(key.encode("utf-8")) & mask for key in keys})
+
+
+def sigmoid(z: float) -> float:
+    if z < -30:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class IntentModel:
+    """
+    weights: корзина → веса по намерениям (порядок intents), bias — по намерениям.
+    thresholds: намерение → порог вероятности; подбираются при обучении, правятся через INTENT_THRESHOLDS.
+    """
+
+    def __init__(self, intents, weights: dict, bias, thresholds: dict = None, bits: int = HASH_BITS,
+                 meta: dict = None):
+        self.intents = tuple(intents)
+        self.weights = weights
+        self.bias = list(bias)
+        self.thresholds = {i: DEFAULT_THRESHOLD for i in self.intents}
+        self.thresholds.update(thresholds or {})
+        self.bits = bits
+        self.meta = meta or {}
+        self.version = None
+        self.scores = lru_cache(maxsize=4096)(self._scores)  # история прогоняется через детекторы каждый ход
+
+    def _scores(self, text: str) -> dict:
+        totals = list(self.bias)
+        buckets = feature_buckets(text, self.bits)
+        if buckets:
+            scale = 1.0 / math.sqrt(len(buckets))
+            for bucket in buckets:
+                row = self.weights.get(bucket)
+                if row:
+                    for k, w in enumerate(row):
+                        totals[k] += w * scale
+        return {intent: sigmoid(z) for intent, z in zip(self.intents, totals)}
+
+    def predict(self, text: str) -> set:
+        return {intent for intent, p in self.scores(text).items() if p >= self.thresholds[intent]}
+
+    def to_bytes(self) -> bytes:
+        """Заголовок JSON + номера корзин (uint32) + веса (float32), всё под zlib"""
+        buckets = sorted(self.weights)
+        header = json.dumps({
+            "intents": self.intents, "bits": self.bits, "bias": self.bias,
+            "thresholds": self.thresholds, "features": len(buckets), "meta": self.meta,
+        }, ensure_ascii=False).encode("utf-8")
+        flat = array.array("f", (w for b in buckets for w in self.weights[b]))
+        payload = MAGIC + struct.pack("<I", len(header)) + header
+        payload += array.array("I", buckets).tobytes() + flat.tobytes()
+        return zlib.compress(payload, 9)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IntentModel":
+        payload = zlib.decompress(data)
+        if not payload.startswith(MAGIC):
+            raise ValueError("Не файл модели намерений")
+        offset = len(MAGIC)
+        (header_size,) = struct.unpack_from("<I", payload, offset)
+        offset += 4
+        header = json.loads(payload[offset:offset + header_size].decode("utf-8"))
+        offset += header_size
+        count, width = header["features"], len(header["intents"])
+        buckets = array.array("I")
+        buckets.frombytes(payload[offset:offset + 4 * count])
+        flat = array.array("f")
+        flat.frombytes(payload[offset + 4 * count:offset + 4 * count * (1 + width)])
+        weights = {b: tuple(flat[i * width:(i + 1) * width]) for i, b in enumerate(buckets)}
+        model = cls(header["intents"], weights, header["bias"], header["thresholds"], header["bits"], header["meta"])
+        model.version = hashlib.sha1(data).hexdigest()[:8]
+        return model
+
+    def save(self, path: str):
+        data = self.to_bytes()
+        with open(path, "wb") as f:
+            f.write(data)
+        self.version = hashlib.sha1(data).hexdigest()[:8]
+        return len(data)
+
+    @classmethod
+    def load(cls, path: str) -> "IntentModel":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+def parse_thresholds(value: str) -> dict:
+    """INTENT_THRESHOLDS: "irritated=0.6,neutral=0.7" → {намерение: порог}"""
+    thresholds = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        intent, _, threshold = item.partition("=")
+        if intent.strip() not in INTENTS:
+            raise ValueError(f"INTENT_THRESHOLDS: неизвестное намерение {intent.strip()}")
+        thresholds[intent.strip()] = float(threshold)
+    return thresholds
@@ -0,0 +1,196 @@
+# price_catalog.py — справочник цен как данные, а не как текст промпта
+# Раньше цены жили свободным текстом в PRICE_CATALOG (sofia_prompt.py) и второй копией
+# в SYSTEM_PROMPT sofia_hybrid и целиком уходили в каждый запрос.
+# Теперь строки (регион, сегмент, диапазон цен, ипотека/рассрочка) лежат в price_catalog.json,
+# индекс по регионам собирается один раз на версию файла, а в промпт идут только строки
+# под известные локацию и бюджет клиента (slots.py) или одна строка-сводка, пока их нет.
+
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+from hot_reload import ReloadError, source_version
+from text_normalize import normalize_text
+
+CATALOG_PATH = os.getenv(
+    "PRICE_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "price_catalog.json"))
+
+GROUPS = ("море", "горы")
+ROW_FIELDS = ("region", "min", "max", "mortgage", "installment")
+NOTE_LABELS = {"mortgage": "Ипотека", "installment": "Рассрочка"}
+# Под бюджет ничего не подошло — показываем столько ближайших по цене строк
+NEAREST_ROWS = 2
+RENDER_CACHE_SIZE = 1024
+
+
+def format_mln(value) -> str:
+    return f"{value:g}"
+
+
+class PriceCatalog:
+    """
+    Справочник одной версии файла: строки, индекс регион → строки, матчеры локаций для слотов.
+    render(слоты) → текст для промпта; результат кэшируется по (локации, бюджет).
+    """
+
+    def __init__(self, regions: dict, rows: list, notes: dict, version: str = None):
+        self.regions = regions
+        self.rows = rows
+        self.notes = notes
+        self.version = version
+        self.by_region = {name: [row for row in rows if row["region"] == name] for name in regions}
+        self.location_matchers = [(name, self._location_regex(name)) for name in regions]
+        self.summary = self._summary()
+        self._rendered = {}
+
+    def _location_regex(self, name: str):
+        """Регион → regex по началу слова в нормализованном тексте (название + синонимы)"""
+        variants = set(self.regions[name].get("aliases", ())) | {normalize_text(name, False).strip()}
+        alternation = "|".join(sorted((re.escape(v) for v in variants), key=len, reverse=True))
+        return re.compile(rf" (?:{alternation})")
+
+    def find_regions(self, norm: str) -> list:
+        """Регионы, упомянутые в нормализованном тексте, в порядке справочника"""
+        return [name for name, regex in self.location_matchers if regex.search(norm)]
+
+    def row_label(self, row: dict) -> str:
+        label = self.regions[row["region"]].get("label", row["region"])
+        return f"{label} {row['segment']}" if row.get("segment") else label
+
+    def format_row(self, row: dict) -> str:
+        """"— Сочи комфорт: 6–12 млн"; ипотека и рассрочка — в общих строках, у строки только исключения"""
+        text = f"— {self.row_label(row)}: {format_mln(row['min'])}–{format_mln(row['max'])} млн"
+        missing = [label for key, label in (("mortgage", "без ипотеки"), ("installment", "без рассрочки")) if not row[key]]
+        return f"{text} ({', '.join(missing)})" if missing else text
+
+    def _notes_lines(self) -> list:
+        return [f"{NOTE_LABELS[key]}: {text}" for key, text in self.notes.items()]
+
+    def _summary(self) -> str:
+        """Одна строка: "Цены: Сочи 6–25 млн, Анапа 9–15 млн, ...; ипотека от 8% годовых, ..." """
+        ranges = []
+        for name, rows in self.by_region.items():
+            if rows:
+                low, high = min(r["min"] for r in rows), max(r["max"] for r in rows)
+                ranges.append(f"{name} {format_mln(low)}–{format_mln(high)} млн")
+        notes = ", ".join(f"{NOTE_LABELS[key].lower()} {text}" for key, text in self.notes.items())
+        return f"Цены: {', '.join(ranges)}" + (f"; {notes}" if notes else "")
+
+    def select(self, locations: tuple, budget: tuple) -> tuple:
+        """
+        Строки под локации и бюджет (min, max в млн; None — граница не задана).
+        Возвращает (строки, подошли_ли_под_бюджет); без совпадений по бюджету — ближайшие по цене.
+        """
+        candidates = [row for name in locations for row in self.by_region.get(name, ())] or self.rows
+        if not budget:
+            return candidates, True
+        low, high = budget
+        fit = [row for row in candidates
+               if (high is None or row["min"] <= high) and (low is None or row["max"] >= low)]
+        if fit:
+            return fit, True
+        distance = lambda row: (row["min"] - high) if high is not None and row["min"] > high else (low or 0) - row["max"]
+        return sorted(candidates, key=distance)[:NEAREST_ROWS], False
+
+    def render(self, slots: dict = None) -> str:
+        """Текст справочника для промпта под слоты клиента"""
+        slots = slots or {}
+        location, budget = slots.get("location"), slots.get("budget")
+        locations = tuple(name for name in location if name in self.by_region) if isinstance(location, list) else ()
+        budget = (budget.get("min"), budget.get("max")) if isinstance(budget, dict) else None
+        key = (locations, budget)
+        if key not in self._rendered:
+            if len(self._rendered) >= RENDER_CACHE_SIZE:
+                self._rendered.clear()
+            if not locations and not budget:
+                text = self.summary
+            else:
+                rows, fits = self.select(locations, budget)
+                lines = [] if fits else ["Под бюджет клиента точных вариантов нет, ближайшие:"]
+                lines += [self.format_row(row) for row in rows] + self._notes_lines()
+                text = "\n".join(lines)
+            self._rendered[key] = text
+        return self._rendered[key]
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def load_catalog(source: str) -> PriceCatalog:
+    """
+    price_catalog.json → PriceCatalog (load для HotReloader).
+    {"notes": {"mortgage": "..", "installment": ".."},
+     "regions": {"Сочи": {"group": "море", "aliases": [..], "label": ".."}},
+     "rows": [{"region", "segment", "min", "max", "mortgage", "installment"}]}
+    """
+    try:
+        config = json.loads(source)
+    except json.JSONDecodeError as e:
+        raise ReloadError(f"JSON: {e}")
+    notes = config.get("notes", {})
+    regions = config.get("regions")
+    rows = config.get("rows")
+    if not isinstance(notes, dict) or set(notes) - set(NOTE_LABELS):
+        raise ReloadError(f"notes: допустимы только {', '.join(NOTE_LABELS)}")
+    if not isinstance(regions, dict) or not regions:
+        raise ReloadError("regions: ожидается непустой словарь {регион: {group, aliases}}")
+    for name, region in regions.items():
+        if not isinstance(region, dict) or region.get("group") not in GROUPS:
+            raise ReloadError(f"регион {name}: group — одно из {', '.join(GROUPS)}")
+        if not all(isinstance(a, str) and a for a in region.get("aliases", ())):
+            raise ReloadError(f"регион {name}: aliases — список непустых строк")
+    if not isinstance(rows, list) or not rows:
+        raise ReloadError("rows: ожидается непустой список")
+
+    for i, row in enumerate(rows):
+        missing = [field for field in ROW_FIELDS if field not in row]
+        if missing:
+            raise ReloadError(f"строка {i}: нет полей {', '.join(missing)}")
+        if row["region"] not in regions:
+            raise ReloadError(f"строка {i}: регион {row['region']!r} не описан в regions")
+        if not (_number(row["min"]) and _number(row["max"]) and 0 < row["min"] <= row["max"]):
+            raise ReloadError(f"строка {i}: min/max — числа в млн, 0 < min <= max")
+        if not isinstance(row["mortgage"], bool) or not isinstance(row["installment"], bool):
+            raise ReloadError(f"строка {i}: mortgage/installment — true/false")
+    return PriceCatalog(regions, rows, notes, source_version(source))
+
+
+def load_catalog_file(path: str) -> PriceCatalog:
+    with open(path, "r", encoding="utf-8") as f:
+        return load_catalog(f.read())
+
+
+_CATALOG = load_catalog_file(CATALOG_PATH)
+
+
+def set_catalog(catalog: PriceCatalog, version: str = None):
+    """Подмена справочника на лету — вызывается между ходами"""
+    global _CATALOG
+    _CATALOG = catalog
+
+
+# Справочник, закреплённый за ходом в этом потоке (pinned_catalog): подмена посреди хода его не задевает
+_PINNED = threading.local()
+
+
+def current_catalog() -> PriceCatalog:
+    return getattr(_PINNED, "catalog", None) or _CATALOG
+
+
+@contextmanager
+def pinned_catalog(catalog: PriceCatalog):
+    """Весь ход (слоты, промпт) видит один справочник, даже если set_catalog придёт во время генерации"""
+    previous = getattr(_PINNED, "catalog", None)
+    _PINNED.catalog = catalog
+    try:
+        yield catalog
+    finally:
+        _PINNED.catalog = previous
+
+
+def catalog_prompt(slots: dict = None) -> str:
+    """Справочник для промпта: строки под локацию и бюджет клиента или сводка в одну строку"""
+    return current_catalog().render(slots)
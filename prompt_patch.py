@@ -0,0 +1,233 @@
+# prompt_patch.py — точечные правки промпта по секциям
+# Вместо генерации всего sofia_prompt.py модель возвращает короткий список правок (JSON),
+# правки применяются локально к секциям get_system_prompt / PRICE_CATALOG.
+
+import difflib
+import json
+import re
+import types
+
+# Блоки-строки в sofia_prompt.py, которые можно править
+PROMPT_BLOCK = "get_system_prompt"
+CATALOG_BLOCK = "PRICE_CATALOG"
+INTRO_SECTION = "ВСТУПЛЕНИЕ"
+
+EDIT_OPS = ("replace", "add", "delete", "add_section")
+
+# Заголовок секции: строка целиком заглавными ("ЖЕЛЕЗНЫЕ ПРАВИЛА", "ШАГ 7. ПОВТОРНАЯ ПОПЫТКА СОЗВОНА")
+HEADER_RE = re.compile(r'[А-ЯЁA-Z][А-ЯЁA-Z0-9 .,:;—\-"«»()/+!?]*')
+PLACEHOLDER_RE = re.compile(r'(?<!\{)\{[^{}]+\}(?!\})')
+
+
+class PatchError(ValueError):
+    """Правку нельзя применить"""
+
+
+def is_header(line: str) -> bool:
+    stripped = line.strip()
+    letters = [ch for ch in stripped if ch.isalpha()]
+    return bool(HEADER_RE.fullmatch(stripped)) and len(letters) >= 3 and not any(ch.islower() for ch in letters)
+
+
+def find_blocks(lines: list) -> dict:
+    """Находим строки тела f-строки get_system_prompt и строки PRICE_CATALOG: имя → (первая, последняя+1)"""
+    openers = {}
+    for i, line in enumerate(lines):
+        if line.startswith(f'{CATALOG_BLOCK} = """'):
+            openers[CATALOG_BLOCK] = i
+        elif line.startswith(f"def {PROMPT_BLOCK}("):
+            for j in range(i + 1, len(lines)):
+                if 'return f"""' in lines[j]:
+                    openers[PROMPT_BLOCK] = j
+                    break
+
+    blocks = {}
+    for name in (PROMPT_BLOCK, CATALOG_BLOCK):
+        if name not in openers:
+            raise PatchError(f"Не найден блок {name}")
+        # Строка с открывающими кавычками (и текст на ней) не правится
+        i = openers[name]
+        end = next((j for j in range(i + 1, len(lines)) if '"""' in lines[j]), None)
+        if end is None:
+            raise PatchError(f"{name}: не найден конец строки")
+        blocks[name] = (i + 1, end)
+    return blocks
+
+
+def list_sections(source: str) -> list:
+    """Секции промпта по порядку: [(имя, первая строка, последняя+1)] в номерах строк файла"""
+    lines = source.split("\n")
+    blocks = find_blocks(lines)
+
+    sections = []
+    start, end = blocks[PROMPT_BLOCK]
+    name, first = INTRO_SECTION, start
+    for i in range(start, end):
+        if is_header(lines[i]):
+            if i > first:
+                sections.append((name, first, i))
+            name, first = lines[i].strip(), i
+    sections.append((name, first, end))
+
+    start, end = blocks[CATALOG_BLOCK]
+    sections.append((CATALOG_BLOCK, start, end))
+    return sections
+
+
+def section_names(source: str) -> list:
+    return [name for name, _, _ in list_sections(source)]
+
+
+def _escape(text: str, name: str) -> list:
+    """Текст правки → строки файла. В f-строке фигурные скобки экранируются."""
+    if '"""' in text:
+        raise PatchError(f"{name}: в тексте правки нельзя использовать \"\"\"")
+    if name != CATALOG_BLOCK:
+        text = text.replace("{", "{{").replace("}", "}}")
+    return text.strip("\n").split("\n")
+
+
+def _find_line(lines: list, first: int, last: int, fragment: str, section: str) -> int:
+    """Единственная строка секции, содержащая фрагмент"""
+    fragment = (fragment or "").strip()
+    if not fragment:
+        raise PatchError(f"{section}: не указан фрагмент строки")
+    found = [i for i in range(first, last) if fragment in lines[i]]
+    if not found:
+        raise PatchError(f"{section}: строка не найдена: {fragment[:60]}")
+    if len(found) > 1:
+        raise PatchError(f"{section}: фрагмент встречается {len(found)} раз: {fragment[:60]}")
+    return found[0]
+
+
+def apply_edit(source: str, edit: dict) -> str:
+    """Применяем одну правку. Изменения не выходят за пределы названной секции."""
+    op = edit.get("op")
+    if op not in EDIT_OPS:
+        raise PatchError(f"Неизвестная операция: {op}")
+
+    lines = source.split("\n")
+    sections = {name: (first, last) for name, first, last in list_sections(source)}
+
+    if op == "add_section":
+        title = (edit.get("title") or "").strip()
+        after = (edit.get("after_section") or "").strip()
+        if not is_header(title):
+            raise PatchError(f"Заголовок новой секции должен быть заглавными: {title[:60]}")
+        if title in sections:
+            raise PatchError(f"Секция уже есть: {title}")
+        if after not in sections or after == CATALOG_BLOCK:
+            raise PatchError(f"Нет секции промпта: {after}")
+        last = sections[after][1]
+        new_lines = [title] + _escape(edit.get("text", ""), title) + [""]
+        return "\n".join(lines[:last] + new_lines + lines[last:])
+
+    section = (edit.get("section") or "").strip()
+    if section not in sections:
+        raise PatchError(f"Нет секции: {section}")
+    first, last = sections[section]
+    # Заголовок секции не трогаем
+    body_first = first + 1 if section not in (INTRO_SECTION, CATALOG_BLOCK) else first
+
+    if op == "replace":
+        i = _find_line(lines, body_first, last, edit.get("old"), section)
+        lines[i:i + 1] = _escape(edit.get("new", ""), section)
+    elif op == "delete":
+        i = _find_line(lines, body_first, last, edit.get("old"), section)
+        del lines[i]
+    else:
+        if edit.get("after"):
+            i = _find_line(lines, body_first, last, edit["after"], section) + 1
+        else:
+            # В конец секции, перед пустыми строками-разделителями
+            i = last
+            while i > body_first and not lines[i - 1].strip():
+                i -= 1
+        lines[i:i] = _escape(edit.get("text", ""), section)
+    return "\n".join(lines)
+
+
+def apply_edits(source: str, edits: list, max_edits: int = 8) -> str:
+    """Применяем список правок по порядку. Любая ошибка — PatchError, файл не трогаем."""
+    if not isinstance(edits, list) or not edits:
+        raise PatchError("Пустой список правок")
+    if len(edits) > max_edits:
+        raise PatchError(f"Слишком много правок: {len(edits)} > {max_edits}")
+
+    result = source
+    for n, edit in enumerate(edits, 1):
+        if not isinstance(edit, dict):
+            raise PatchError(f"Правка {n}: ожидается объект")
+        try:
+            result = apply_edit(result, edit)
+        except PatchError as e:
+            raise PatchError(f"Правка {n}: {e}")
+
+    before = set(PLACEHOLDER_RE.findall(source))
+    after = set(PLACEHOLDER_RE.findall(result))
+    if before != after:
+        raise PatchError(f"Правки изменили подстановки: {sorted(before ^ after)}")
+    return result
+
+
+def stamp_header(source: str, note: str) -> str:
+    """Обновляем строку '# Обновлено: ...' в шапке файла"""
+    lines = source.split("\n")
+    for i, line in enumerate(lines[:5]):
+        if line.startswith("# Обновлено:"):
+            lines[i] = f"# Обновлено: {note}"
+            return "\n".join(lines)
+    return f"# Обновлено: {note}\n" + source
+
+
+def extract_edits(text: str):
+    """Достаём JSON с правками из ответа модели: {"edits": [...]} или просто [...]"""
+    if not text:
+        return None
+    for block in reversed(re.findall(r'```json\s*\n(.*?)```', text, re.DOTALL)):
+        try:
+            data = json.loads(block)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            data = data.get("edits")
+        if isinstance(data, list):
+            return data
+    return None
+
+
+def validate_prompt_source(source: str) -> tuple:
+    """Компилируем, исполняем в отдельном модуле и собираем промпт. Возвращает (ok, сообщение)."""
+    try:
+        code = compile(source, "sofia_prompt.py", "exec")
+    except SyntaxError as e:
+        return False, f"Синтаксическая ошибка: {e}"
+
+    module = types.ModuleType("sofia_prompt_candidate")
+    try:
+        exec(code, module.__dict__)
+    except Exception as e:
+        return False, f"Ошибка при загрузке: {type(e).__name__}: {e}"
+
+    for name in ("get_system_prompt", "get_time_context", "COMPANY"):
+        if not hasattr(module, name):
+            return False, f"Нет {name}"
+
+    try:
+        # Бот передаёт слоты клиента (справочник цен под локацию и бюджет)
+        prompt = module.get_system_prompt("Тест", None)
+    except Exception as e:
+        return False, f"get_system_prompt упал: {type(e).__name__}: {e}"
+    if not isinstance(prompt, str) or "Тест" not in prompt:
+        return False, "get_system_prompt не подставляет имя клиента"
+    return True, "OK"
+
+
+def make_diff(old: str, new: str, context: int = 1) -> str:
+    """Читаемый diff для Telegram и логов"""
+    diff = difflib.unified_diff(
+        old.split("\n"), new.split("\n"),
+        fromfile="sofia_prompt.py (было)", tofile="sofia_prompt.py (стало)",
+        n=context, lineterm=""
+    )
+    return "\n".join(diff)
@@ -7,16 +7,39 @@ Batch обработка диалогов для Sofia Bot
     
     # Эвристики + LLM GPT-5.2 (точно)
     python batch_process.py ./dialogs/ --llm --provider openai --api-key sk-xxx --output dataset.jsonl
+    
+    # LLM-оценка в 8 потоков с лимитами тарифа
+    python batch_process.py ./dialogs/ --llm --concurrency 8 --rpm 500 --tpm 200000
+
+    # Почти-дубли (шаблонные диалоги) — строже порог или без склейки
+    python batch_process.py ./dialogs/ --llm --dedup-threshold 0.9
+    python batch_process.py ./dialogs/ --llm --no-dedup
+
+    # Экспорт Telegram Desktop (JSON): каждый личный чат — отдельный диалог
+    python batch_process.py ~/Downloads/Telegram/result.json --llm
+
+Оценки LLM кэшируются (dataset_scores_cache.jsonl): повторный запуск платит только
+за новые/изменённые диалоги и продолжает упавший прогон с места остановки.
+Почти одинаковые диалоги (один скрипт менеджера, шаблонные приветствия) склеиваются
+до LLM: в модель уходит один представитель, его оценка переносится на остальных.
 """
 
 import argparse
+import hashlib
 import json
+import random
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from dialog_processor import process_file, DialogScore, llm_score_dialog, parse_dialog, decode_rtf, dialog_to_jsonl
+from dialog_processor import (
+    process_files, DialogScore, llm_score_dialog, parse_dialog, decode_rtf, dialog_to_jsonl,
+    LLM_EVALUATION_PROMPT,
+)
 from typing import List, Dict
 
-def print_report(results: List[Dict], llm_used: bool = False):
+def print_report(results: List[Dict], llm_used: bool = False, cache_stats: Dict = None):
     """Печатает красивый отчёт"""
     
     print("\n" + "="*70)
@@ -41,6 +64,11 @@ def print_report(results: List[Dict], llm_used: bool = False):
     print(f"\n📁 Всего диалогов: {total}")
     if llm_used:
         print(f"🤖 LLM-оценено: {llm_evaluated}")
+        if cache_stats:
+            print(f"💾 Кэш оценок: {cache_stats['hits']} из кэша, {cache_stats['misses']} оценено заново")
+        duplicates = sum(1 for r in results if r.get('duplicate_of'))
+        if duplicates:
+            print(f"🧬 Оценка перенесена с представителя: {duplicates} почти-дублей")
     print(f"🎯 Цель достигнута (созвон): {goals_achieved} ({goals_achieved/total*100:.1f}%)")
     
     print(f"\n{'='*70}")
@@ -220,6 +248,406 @@ def save_jsonl(results: List[Dict], output_path: str, min_score: int = 5):
     print(f"\n💾 Сохранено {len(good_dialogs)} диалогов в {output_path}")
     print(f"   (score >= {min_score})")
 
+# ============================================================
+# LLM-ОЦЕНКА ПАРАЛЛЕЛЬНО
+# ============================================================
+
+# Лимиты провайдеров по умолчанию (RPM / TPM) — подстройте под свой тариф
+PROVIDER_LIMITS = {
+    'openai': {'rpm': 500, 'tpm': 200000},
+    'anthropic': {'rpm': 50, 'tpm': 40000},
+}
+LLM_MAX_OUTPUT_TOKENS = 2000
+CHARS_PER_TOKEN = 3  # Грубая оценка: кириллица плотнее латиницы
+LLM_RETRIES = 5
+
+
+class RateLimiter:
+    """
+    Token bucket на запросы (RPM) и токены (TPM).
+    acquire(tokens) ждёт, пока в обоих вёдрах хватит места.
+    """
+    
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+    
+    def acquire(self, tokens: int):
+        tokens = min(tokens, self.tpm)  # Запрос больше ведра всё равно должен пройти
+        while True:
+            with self.lock:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm)
+            time.sleep(max(wait, 0.05))
+    
+    def penalize(self, seconds: float):
+        """После 429 — опустошаем ведро запросов, все воркеры притормаживают"""
+        with self.lock:
+            self._refill()
+            self.requests = min(self.requests, -seconds * self.rpm / 60)
+
+
+def estimate_llm_tokens(dialog_text: str) -> int:
+    prompt_chars = len(LLM_EVALUATION_PROMPT) + len(dialog_text)
+    return prompt_chars // CHARS_PER_TOKEN + LLM_MAX_OUTPUT_TOKENS
+
+
+def retry_after_seconds(error: Exception):
+    """429 от OpenAI/Anthropic: (секунды ожидания или None). Не 429 — False."""
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if status != 429 and 'rate limit' not in str(error).lower() and '429' not in str(error):
+        return False
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def llm_score_with_retry(dialog_text: str, api_key: str, provider: str, model: str,
+                         limiter: RateLimiter) -> Dict:
+    """llm_score_dialog через лимитер, с повторами на 429 (экспоненциальная пауза)"""
+    tokens = estimate_llm_tokens(dialog_text)
+    for attempt in range(LLM_RETRIES + 1):
+        limiter.acquire(tokens)
+        try:
+            return llm_score_dialog(None, api_key, provider, model, dialog_text=dialog_text)
+        except Exception as e:
+            wait = retry_after_seconds(e)
+            if wait is False or attempt == LLM_RETRIES:
+                raise
+            wait = wait or min(60, 2 ** attempt + random.random())
+            limiter.penalize(wait)
+            time.sleep(wait)
+
+
+def apply_llm_result(result_entry: Dict, llm_result: Dict, fallback_score: int, fallback_result: str):
+    """Переносим LLM-оценку в запись результата"""
+    result_entry['score'] = llm_result.get('overall_score', fallback_score)
+    result_entry['result'] = llm_result.get('result', fallback_result)
+    result_entry['goal_achieved'] = llm_result.get('goal_achieved', False)
+    
+    # Оценки по навыкам
+    result_entry['qualification'] = llm_result.get('qualification', {})
+    result_entry['closing'] = llm_result.get('closing', {})
+    result_entry['objection_handling'] = llm_result.get('objection_handling', {})
+    result_entry['communication'] = llm_result.get('communication', {})
+    
+    result_entry['strengths'] = llm_result.get('strengths', [])
+    result_entry['mistakes'] = llm_result.get('mistakes', [])
+    result_entry['summary'] = llm_result.get('summary', '')
+    
+    # Флаги для обучения по навыкам
+    result_entry['good_for_qualification'] = result_entry['qualification'].get('good_for_training', False)
+    result_entry['good_for_closing'] = result_entry['closing'].get('good_for_training', False)
+    result_entry['good_for_objections'] = result_entry['objection_handling'].get('good_for_training', False)
+    
+    # Общий флаг — подходит хотя бы для чего-то
+    result_entry['good_for_training'] = (
+        result_entry['good_for_qualification'] or 
+        result_entry['good_for_closing'] or 
+        result_entry['good_for_objections']
+    )
+    
+    result_entry['llm_evaluated'] = True
+
+
+def format_llm_result(result_entry: Dict) -> str:
+    """Короткая сводка по одному диалогу (печатается целиком — потоки не перемешивают строки)"""
+    goal_icon = "🎯" if result_entry['goal_achieved'] else "❌"
+    qual = result_entry['qualification']
+    close = result_entry['closing']
+    obj = result_entry['objection_handling']
+    
+    qual_score = qual.get('score', '-')
+    qual_ok = "✅" if result_entry['good_for_qualification'] else "❌"
+    close_score = close.get('score', '-')
+    close_ok = "✅" if result_entry['good_for_closing'] else "❌"
+    obj_score = obj.get('score', '-') if obj.get('had_objections') else "—"
+    obj_ok = "✅" if result_entry['good_for_objections'] else ("❌" if obj.get('had_objections') else "—")
+    
+    lines = [
+        f"   🤖 LLM-оценка: {result_entry['file'][:30]}...",
+        f"      📊 {result_entry['score']}/10 | {result_entry['result']} | Цель: {goal_icon}",
+        f"      📋 Квалиф: {qual_score}/10 {qual_ok} | 📞 Закрытие: {close_score}/10 {close_ok} | 🛡️ Возраж: {obj_score} {obj_ok}",
+    ]
+    
+    if result_entry['good_for_training']:
+        skills = []
+        if result_entry['good_for_qualification']: skills.append("квалификация")
+        if result_entry['good_for_closing']: skills.append("закрытие")
+        if result_entry['good_for_objections']: skills.append("возражения")
+        lines.append(f"      ✅ ПОДХОДИТ для: {', '.join(skills)}")
+    else:
+        lines.append(f"      ❌ Не подходит для обучения")
+    
+    if result_entry['summary']:
+        lines.append(f"      💬 {result_entry['summary'][:80]}...")
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# КЭШ ОЦЕНОК (он же чекпоинт)
+# ============================================================
+
+DEFAULT_MODELS = {'openai': 'gpt-5.2', 'anthropic': 'claude-3-haiku-20240307'}
+
+
+def evaluation_prompt_hash() -> str:
+    return hashlib.sha1(LLM_EVALUATION_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+
+class ScoreCache:
+    """
+    LLM-оценки в JSONL: строка на оценку, дописывается сразу после ответа модели.
+    Ключ — (хэш файла, провайдер/модель, хэш промпта оценки): изменился диалог,
+    модель или промпт — оценка считается заново. Упавший прогон продолжается с места остановки.
+    """
+    
+    def __init__(self, path: str, provider: str, model: str):
+        self.path = Path(path)
+        self.model = f"{provider}/{model}"
+        self.prompt_hash = evaluation_prompt_hash()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Недописанная строка после падения
+                    self.entries[entry['key']] = entry['result']
+    
+    def key(self, content_hash: str) -> str:
+        return f"{content_hash}:{self.model}:{self.prompt_hash}"
+    
+    def get(self, content_hash: str):
+        result = self.entries.get(self.key(content_hash))
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+    
+    def put(self, content_hash: str, file_name: str, result: Dict):
+        if result.get('result') == 'ошибка_парсинга':
+            return  # Битый ответ не кэшируем — при следующем запуске оценим заново
+        key = self.key(content_hash)
+        line = json.dumps({'key': key, 'file': file_name, 'result': result}, ensure_ascii=False)
+        with self.lock:
+            self.entries[key] = result
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+    
+    def stats(self) -> Dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# ============================================================
+# ПОЧТИ-ДУБЛИ (MinHash + LSH)
+# ============================================================
+
+DEDUP_THRESHOLD = 0.85  # Жаккар по шинглам, с которого диалоги считаются дублями
+MINHASH_SIZE = 128
+SHINGLE_WORDS = 3
+# Заголовок строки из format_dialog_for_llm: "[дата время] РОЛЬ (имя): "
+DIALOG_LINE_HEADER_RE = re.compile(r'^\[[^\]\n]*\] (МЕНЕДЖЕР|КЛИЕНТ) \([^\n]*?\): ', re.M)
+WORD_RE = re.compile(r'\w+')
+_HASH_SPAN = 1 << 64
+
+
+def dialog_shingles(dialog_text: str) -> frozenset:
+    """
+    Шинглы диалога — 64-битные хэши троек слов.
+    Дата, время и имена из заголовков убираются (у шаблонных диалогов они разные),
+    роль остаётся словом "м"/"к" — реплика менеджера и клиента не смешиваются.
+    """
+    text = DIALOG_LINE_HEADER_RE.sub(lambda m: 'м ' if m.group(1) == 'МЕНЕДЖЕР' else 'к ', dialog_text)
+    words = WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        words = [' '.join(words)] if words else []
+    else:
+        words = [' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    return frozenset(
+        int.from_bytes(hashlib.blake2b(w.encode('utf-8'), digest_size=8).digest(), 'little')
+        for w in words
+    )
+
+
+def minhash_signature(shingles: frozenset, size: int = MINHASH_SIZE):
+    """
+    MinHash одной хэш-функцией (one permutation hashing): хэш шингла раскладывается
+    по size корзинам, в каждой — минимум. Пустые корзины заполняются из ближайшей
+    непустой справа со сдвигом (densification) — иначе у коротких диалогов совпадали бы пустоты.
+    """
+    bins = [None] * size
+    for h in shingles:
+        i = h % size
+        v = h // size
+        if bins[i] is None or v < bins[i]:
+            bins[i] = v
+    if not shingles:
+        return None
+    signature = []
+    for i in range(size):
+        step = 0
+        while bins[(i + step) % size] is None:
+            step += 1
+        signature.append(bins[(i + step) % size] + step * _HASH_SPAN)
+    return tuple(signature)
+
+
+def lsh_bands(threshold: float, size: int = MINHASH_SIZE):
+    """
+    (полос, строк в полосе) для LSH. Порог срабатывания (1/b)^(1/r) берём заметно ниже
+    threshold: лишние пары отсеет точная проверка Жаккара, а пропущенные уже не найдём.
+    """
+    best = (size, 1)
+    for rows in range(1, size + 1):
+        bands = size // rows
+        if (1 / bands) ** (1 / rows) <= threshold - 0.1:
+            best = (bands, rows)
+    return best
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def find_near_duplicates(texts: List[str], threshold: float = DEDUP_THRESHOLD,
+                         size: int = MINHASH_SIZE) -> List[int]:
+    """
+    Для каждого текста — индекс его представителя (себя, если он сам представитель).
+    LSH даёт пары-кандидаты, точный Жаккар по шинглам их подтверждает.
+    Диалог сравнивается только с представителями, поэтому каждый член кластера
+    похож именно на того, чья оценка ему достанется (без цепочек A~B~C).
+    """
+    bands, rows = lsh_bands(threshold, size)
+    buckets = [{} for _ in range(bands)]
+    shingles = [dialog_shingles(t) for t in texts]
+    representative = []
+    for i, sh in enumerate(shingles):
+        signature = minhash_signature(sh, size)
+        rep = i
+        if signature is not None:
+            keys = [signature[b * rows:(b + 1) * rows] for b in range(bands)]
+            seen = set()
+            for band, key in zip(buckets, keys):
+                for j in band.get(key, ()):
+                    if j not in seen:
+                        seen.add(j)
+                        if jaccard(sh, shingles[j]) >= threshold:
+                            rep = j
+                            break
+                if rep != i:
+                    break
+            if rep == i:
+                # В корзины кладём только представителей
+                for band, key in zip(buckets, keys):
+                    band.setdefault(key, []).append(i)
+        representative.append(rep)
+    return representative
+
+
+def run_llm_scoring(candidates: List[Dict], api_key: str, provider: str, model: str,
+                    concurrency: int, limiter: RateLimiter, cache: ScoreCache = None) -> int:
+    """
+    LLM-оценка кандидатов пулом потоков.
+    Каждый воркер пишет в свою запись — порядок результатов не зависит от порядка ответов.
+    """
+    print_lock = threading.Lock()
+    
+    def score_one(item: Dict) -> bool:
+        entry = item['entry']
+        llm_result = cache.get(item['hash']) if cache else None
+        if llm_result is not None:
+            apply_llm_result(entry, llm_result, entry['heuristic_score'], entry['result'])
+            entry['llm_cached'] = True
+            item['llm_result'] = llm_result
+            return True
+        
+        try:
+            llm_result = llm_score_with_retry(item['dialog_text'], api_key, provider, model, limiter)
+        except Exception as e:
+            with print_lock:
+                print(f"   ⚠️ LLM ошибка ({entry['file'][:30]}): {e}")
+            return False
+        if cache:
+            cache.put(item['hash'], entry['file'], llm_result)
+        apply_llm_result(entry, llm_result, entry['heuristic_score'], entry['result'])
+        item['llm_result'] = llm_result
+        with print_lock:
+            print(format_llm_result(entry))
+        return True
+    
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        return sum(pool.map(score_one, candidates))
+
+
+def split_near_duplicates(candidates: List[Dict], threshold: float):
+    """
+    Кандидаты → (в LLM, дубли). Дубль получает item['representative'] — кандидата,
+    чья оценка будет перенесена. Представитель — первый по порядку файлов.
+    """
+    started = time.time()
+    reps = find_near_duplicates([c['dialog_text'] for c in candidates], threshold)
+    clusters = {}
+    for item, rep in zip(candidates, reps):
+        clusters.setdefault(rep, []).append(item)
+    
+    to_score, duplicates = [], []
+    for members in clusters.values():
+        leader = members[0]
+        to_score.append(leader)
+        for m in members[1:]:
+            m['representative'] = leader
+            duplicates.append(m)
+    
+    saved_tokens = sum(estimate_llm_tokens(d['dialog_text']) for d in duplicates)
+    grouped = sum(1 for members in clusters.values() if len(members) > 1)
+    print(f"\n🧬 Почти-дубли (порог {threshold:.2f}): {len(duplicates)} из {len(candidates)} "
+          f"в {grouped} кластерах — в LLM не отправляются ({time.time() - started:.1f} с)")
+    if duplicates:
+        print(f"   💸 Экономия: {len(duplicates)} запросов, ~{saved_tokens} токенов")
+    return to_score, duplicates
+
+
+def propagate_duplicate_scores(duplicates: List[Dict]) -> int:
+    """Переносим оценку представителя на дубли; представитель без оценки — дубль остаётся с эвристикой"""
+    count = 0
+    for item in duplicates:
+        llm_result = item['representative'].get('llm_result')
+        if llm_result is None:
+            continue
+        entry = item['entry']
+        apply_llm_result(entry, llm_result, entry['heuristic_score'], entry['result'])
+        entry['duplicate_of'] = item['representative']['entry']['file']
+        count += 1
+    return count
+
+
 def main():
     parser = argparse.ArgumentParser(description='Batch обработка диалогов')
     parser.add_argument('input', help='Путь к папке с диалогами или файлу')
@@ -234,6 +662,15 @@ def main():
     parser.add_argument('--api-key', help='API ключ (или переменная окружения OPENAI_API_KEY / ANTHROPIC_API_KEY)')
     parser.add_argument('--model', help='Модель (default: gpt-5.2 или claude-3-haiku)')
     parser.add_argument('--llm-threshold', type=int, default=4, help='Минимальный эвристический score для LLM-оценки')
+    parser.add_argument('--concurrency', type=int, default=1, help='Параллельных LLM-запросов')
+    parser.add_argument('--rpm', type=int, help='Лимит запросов в минуту (default: по провайдеру)')
+    parser.add_argument('--tpm', type=int, help='Лимит токенов в минуту (default: по провайдеру)')
+    parser.add_argument('--workers', type=int, default=1, help='Процессов для парсинга и эвристик')
+    parser.add_argument('--cache', help='Кэш LLM-оценок (default: рядом с --output, *_scores_cache.jsonl)')
+    parser.add_argument('--no-cache', action='store_true', help='Оценить всё заново, кэш не читать и не писать')
+    parser.add_argument('--dedup-threshold', type=float, default=DEDUP_THRESHOLD,
+                       help='Сходство (Жаккар по шинглам), с которого диалоги — почти-дубли')
+    parser.add_argument('--no-dedup', action='store_true', help='Не склеивать почти-дубли, оценить каждый диалог')
     
     args = parser.parse_args()
     
@@ -253,28 +690,38 @@ def main():
     input_path = Path(args.input)
     results = []
     
-    # Собираем файлы
+    # Собираем файлы (сортируем — порядок не зависит от файловой системы)
     if input_path.is_file():
         files = [input_path]
     else:
-        files = list(input_path.glob('*.txt')) + list(input_path.glob('*.rtf'))
+        files = sorted(list(input_path.glob('*.txt')) + list(input_path.glob('*.rtf')) + list(input_path.glob('*.json')))
     
     print(f"🔍 Найдено файлов: {len(files)}")
+    limits = PROVIDER_LIMITS[args.provider]
+    rpm = args.rpm or limits['rpm']
+    tpm = args.tpm or limits['tpm']
     if args.llm:
         print(f"🤖 LLM-оценка включена: {args.provider} (threshold >= {args.llm_threshold})")
+        print(f"   Параллельно: {args.concurrency} | Лимиты: {rpm} RPM, {tpm} TPM")
     
-    # Обрабатываем
-    llm_count = 0
-    for i, filepath in enumerate(files, 1):
+    # 1. Парсинг и эвристики (по процессам при --workers > 1)
+    candidates = []
+    jsonl_by_file = {}
+    started = time.time()
+    llm_threshold = args.llm_threshold if args.llm else None
+    compact_results = process_files([str(f) for f in files], args.managers, args.workers,
+                                    args.min_score, llm_threshold)
+    for i, compact in enumerate(compact_results, 1):
+        if 'error' in compact:
+            print(f"   ❌ Ошибка в {compact['file']}: {compact['error']}")
+            continue
         try:
-            messages, score, jsonl_data = process_file(str(filepath), args.managers)
-            
             result_entry = {
-                'file': filepath.name,
-                'messages_count': len(messages),
-                'heuristic_score': score.total,
-                'score': score.total,
-                'result': score.result,
+                'file': compact['file'],
+                'messages_count': compact['messages_count'],
+                'heuristic_score': compact['score'],
+                'score': compact['score'],
+                'result': compact['result'],
                 'goal_achieved': False,
                 'qualification': {},
                 'closing': {},
@@ -290,101 +737,53 @@ def main():
                 'llm_evaluated': False,
                 'jsonl': None
             }
-            
-            # LLM-оценка для кандидатов
-            if args.llm and score.total >= args.llm_threshold:
-                try:
-                    print(f"   🤖 LLM-оценка: {filepath.name[:30]}...")
-                    llm_result = llm_score_dialog(messages, api_key, args.provider, args.model)
-                    
-                    result_entry['score'] = llm_result.get('overall_score', score.total)
-                    result_entry['result'] = llm_result.get('result', score.result)
-                    result_entry['goal_achieved'] = llm_result.get('goal_achieved', False)
-                    
-                    # Оценки по навыкам
-                    result_entry['qualification'] = llm_result.get('qualification', {})
-                    result_entry['closing'] = llm_result.get('closing', {})
-                    result_entry['objection_handling'] = llm_result.get('objection_handling', {})
-                    result_entry['communication'] = llm_result.get('communication', {})
-                    
-                    result_entry['strengths'] = llm_result.get('strengths', [])
-                    result_entry['mistakes'] = llm_result.get('mistakes', [])
-                    result_entry['summary'] = llm_result.get('summary', '')
-                    
-                    # Флаги для обучения по навыкам
-                    result_entry['good_for_qualification'] = result_entry['qualification'].get('good_for_training', False)
-                    result_entry['good_for_closing'] = result_entry['closing'].get('good_for_training', False)
-                    result_entry['good_for_objections'] = result_entry['objection_handling'].get('good_for_training', False)
-                    
-                    # Общий флаг — подходит хотя бы для чего-то
-                    result_entry['good_for_training'] = (
-                        result_entry['good_for_qualification'] or 
-                        result_entry['good_for_closing'] or 
-                        result_entry['good_for_objections']
-                    )
-                    
-                    result_entry['llm_evaluated'] = True
-                    llm_count += 1
-                    
-                    # === ВЫВОД РЕЗУЛЬТАТА СРАЗУ ===
-                    goal_icon = "🎯" if result_entry['goal_achieved'] else "❌"
-                    qual = result_entry['qualification']
-                    close = result_entry['closing']
-                    obj = result_entry['objection_handling']
-                    
-                    qual_score = qual.get('score', '-')
-                    qual_ok = "✅" if result_entry['good_for_qualification'] else "❌"
-                    close_score = close.get('score', '-')
-                    close_ok = "✅" if result_entry['good_for_closing'] else "❌"
-                    obj_score = obj.get('score', '-') if obj.get('had_objections') else "—"
-                    obj_ok = "✅" if result_entry['good_for_objections'] else ("❌" if obj.get('had_objections') else "—")
-                    
-                    print(f"      📊 {result_entry['score']}/10 | {result_entry['result']} | Цель: {goal_icon}")
-                    print(f"      📋 Квалиф: {qual_score}/10 {qual_ok} | 📞 Закрытие: {close_score}/10 {close_ok} | 🛡️ Возраж: {obj_score} {obj_ok}")
-                    
-                    if result_entry['good_for_training']:
-                        skills = []
-                        if result_entry['good_for_qualification']: skills.append("квалификация")
-                        if result_entry['good_for_closing']: skills.append("закрытие")
-                        if result_entry['good_for_objections']: skills.append("возражения")
-                        print(f"      ✅ ПОДХОДИТ для: {', '.join(skills)}")
-                    else:
-                        print(f"      ❌ Не подходит для обучения")
-                    
-                    if result_entry['summary']:
-                        print(f"      💬 {result_entry['summary'][:80]}...")
-                    print()
-                    
-                    # Небольшая пауза чтобы не превысить rate limit
-                    time.sleep(0.5)
-                    
-                except Exception as e:
-                    print(f"   ⚠️ LLM ошибка: {e}")
-            
-            # Добавляем jsonl если score достаточный
-            final_score = result_entry['score']
-            if final_score >= args.min_score:
-                # Для LLM-оценённых проверяем good_for_training
-                if result_entry['llm_evaluated']:
-                    if result_entry.get('good_for_training', False):
-                        result_entry['jsonl'] = jsonl_data
-                else:
-                    result_entry['jsonl'] = jsonl_data
-            
             results.append(result_entry)
+            jsonl_by_file[compact['file']] = compact['jsonl']
+            
+            # Кандидаты на LLM-оценку
+            if compact['dialog_text'] is not None:
+                candidates.append({'entry': result_entry, 'dialog_text': compact['dialog_text'], 'hash': compact['hash']})
             
             # Прогресс
             if i % 10 == 0:
                 print(f"   Обработано: {i}/{len(files)}")
                 
         except Exception as e:
-            print(f"   ❌ Ошибка в {filepath.name}: {e}")
+            print(f"   ❌ Ошибка в {compact['file']}: {e}")
+    print(f"   ⏱️ Парсинг и эвристики: {time.time() - started:.1f} с ({args.workers} процесс.)")
+    
+    # 2. LLM-оценка кандидатов
+    llm_count = 0
+    cache = None
+    if candidates:
+        model = args.model or DEFAULT_MODELS[args.provider]
+        if not args.no_cache:
+            cache_path = args.cache or args.output.replace('.jsonl', '') + '_scores_cache.jsonl'
+            cache = ScoreCache(cache_path, args.provider, model)
+            print(f"💾 Кэш оценок: {cache_path} ({len(cache.entries)} записей)")
+        to_score = candidates
+        duplicates = []
+        if not args.no_dedup:
+            to_score, duplicates = split_near_duplicates(candidates, args.dedup_threshold)
+        print(f"\n🤖 LLM-оценка: {len(to_score)} кандидатов")
+        limiter = RateLimiter(rpm, tpm)
+        started = time.time()
+        llm_count = run_llm_scoring(to_score, api_key, args.provider, model, args.concurrency, limiter, cache)
+        print(f"   ⏱️ LLM-оценка заняла {time.time() - started:.1f} с")
+        llm_count += propagate_duplicate_scores(duplicates)
+    
+    # 3. Датасет: добавляем jsonl если score достаточный
+    for result_entry in results:
+        if result_entry['score'] >= args.min_score:
+            # Для LLM-оценённых проверяем good_for_training
+            if not result_entry['llm_evaluated'] or result_entry.get('good_for_training', False):
+                result_entry['jsonl'] = jsonl_by_file[result_entry['file']]
     
-    # Сортируем по score
+    # Сортируем по score (стабильно — при равных score порядок файлов)
     results = sorted(results, key=lambda x: x['score'], reverse=True)
     
     # Отчёт
-    print_report(results, llm_used=args.llm)
+    print_report(results, llm_used=args.llm, cache_stats=cache.stats() if cache else None)
     
     # Сохраняем
     save_jsonl(results, args.output, args.min_score)
@@ -399,6 +798,8 @@ def main():
     
     if args.llm:
         print(f"\n🤖 LLM-оценено диалогов: {llm_count}")
+        if cache:
+            print(f"💾 Из кэша: {cache.hits} | Новых запросов к модели: {cache.misses}")
 
 if __name__ == '__main__':
     main()
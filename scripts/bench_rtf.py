@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк разбора RTF: потоковый токенизатор (dialog_processor) против старого decode_rtf на regex
+Использование:
+    # Синтетический экспорт (TextEdit/cocoa RTF) на 50 МБ
+    python bench_rtf.py --size-mb 50
+
+    # Свои файлы
+    python bench_rtf.py ~/dialogs/*.rtf
+"""
+
+import argparse
+import random
+import re
+import time
+import tracemalloc
+from pathlib import Path
+
+from dialog_processor import read_rtf_text
+
+
+def legacy_decode_rtf(content: str) -> str:
+    """Старая реализация decode_rtf (до потокового токенизатора) — для сравнения"""
+    content = re.sub(r'\\uc0', '', content)
+
+    def replace_unicode(m):
+        try:
+            code = int(m.group(1))
+            if 0xD800 <= code <= 0xDFFF:  # surrogate (emoji)
+                return '😊'  # заменяем на generic emoji
+            return chr(code)
+        except:
+            return ''
+
+    content = re.sub(r'\\u(\d+)\s?', replace_unicode, content)
+    content = re.sub(r'\{[^}]*\}', '', content)
+    content = re.sub(r'\\[a-z]+\d*\s?', '', content)
+    content = re.sub(r'\\\'[0-9a-f]{2}', '', content)
+    content = re.sub(r'[\{\}]', '', content)
+    content = content.replace('\\', '\n')
+    return content.strip()
+
+
+def legacy_read(path: Path) -> str:
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        return legacy_decode_rtf(f.read())
+
+
+def streaming_read(path: Path) -> str:
+    # Считаем только объём — как если бы текст сразу уходил в парсер
+    return sum(len(piece) for piece in read_rtf_text(path))
+
+
+def rtf_escape(text: str) -> str:
+    """Текст → RTF, как пишет TextEdit: кириллица через \\uN, эмодзи — суррогатной парой"""
+    out = []
+    for ch in text:
+        code = ord(ch)
+        if ch in '\\{}':
+            out.append('\\' + ch)
+        elif ch == '\n':
+            out.append('\\\n')
+        elif code < 128:
+            out.append(ch)
+        elif code > 0xFFFF:
+            code -= 0x10000
+            out.append(f"\\u{0xD800 + (code >> 10)} \\u{0xDC00 + (code & 0x3FF)} ")
+        else:
+            out.append(f"\\u{code} ")
+    return ''.join(out)
+
+
+def make_synthetic_rtf(path: Path, size_mb: float):
+    header = (
+        "{\\rtf1\\ansi\\ansicpg1251\\cocoartf2761\n"
+        "\\cocoatextscaling0\\cocoaplatform0{\\fonttbl\\f0\\fswiss\\fcharset0 Helvetica;}\n"
+        "{\\colortbl;\\red255\\green255\\blue255;}\n"
+        "{\\*\\expandedcolortbl;;}\n"
+        "\\pard\\tx566\\pardirnatural\\partightenfactor0\n\n"
+        "\\f0\\fs24 \\cf0 \\uc0 "
+    )
+    phrases = [
+        "Добрый день! Подскажите, для себя смотрите или как инвестицию?",
+        "Интересует Сочи, бюджет порядка 15 млн",
+        "Давайте созвонимся завтра в 17, покажу варианты на экране 🙂",
+        "Пришлите подборку в whatsapp пожалуйста",
+        "Кстати, есть рассрочка на 24 месяца 👍",
+    ]
+    authors = ["София", "Иван Петров"]
+    random.seed(42)
+    target = int(size_mb * 1024 * 1024)
+    with open(path, 'w', encoding='ascii') as f:
+        f.write(header)
+        written = len(header)
+        n = 0
+        while written < target:
+            line = f"[12.01.2025 {10 + n % 10}:{n % 60:02d}] {authors[n % 2]}: {random.choice(phrases)}\n\n"
+            chunk = rtf_escape(line)
+            f.write(chunk)
+            written += len(chunk)
+            n += 1
+        f.write("}")
+
+
+def measure(fn, path: Path):
+    """Время — отдельным прогоном: tracemalloc сильно замедляет код на Python"""
+    started = time.perf_counter()
+    result = fn(path)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк разбора RTF')
+    parser.add_argument('files', nargs='*', help='RTF-файлы (по умолчанию — синтетический)')
+    parser.add_argument('--size-mb', type=float, default=20, help='Размер синтетического файла')
+    parser.add_argument('--keep', action='store_true', help='Не удалять синтетический файл')
+    args = parser.parse_args()
+
+    files = [Path(f) for f in args.files]
+    synthetic = None
+    if not files:
+        synthetic = Path(f"bench_rtf_{int(args.size_mb)}mb.rtf")
+        print(f"🧪 Генерируем {synthetic} ({args.size_mb} МБ)...")
+        make_synthetic_rtf(synthetic, args.size_mb)
+        files = [synthetic]
+
+    print(f"\n{'Файл':30} {'МБ':>7} {'regex, с':>9} {'поток, с':>9} {'regex, пик МБ':>14} {'поток, пик МБ':>14}")
+    try:
+        for path in files:
+            size_mb = path.stat().st_size / 1024 / 1024
+            old_time, old_peak, old_text = measure(legacy_read, path)
+            new_time, new_peak, new_chars = measure(streaming_read, path)
+            print(f"{path.name[:30]:30} {size_mb:7.1f} {old_time:9.2f} {new_time:9.2f} "
+                  f"{old_peak / 1024 / 1024:14.1f} {new_peak / 1024 / 1024:14.1f}")
+            print(f"   символов: regex {len(old_text)}, поток {new_chars}")
+    finally:
+        if synthetic and not args.keep:
+            synthetic.unlink()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Индекс удачных ответов (examples_index.py) по базе бота + замеры
+- Дочитывает в файл индекса новые оценки GOOD из feedback_v2 (--rebuild — собрать заново)
+- Время: сборка с нуля, загрузка с диска, запрос (p50/p95 на репликах клиентов из базы)
+- Сколько добавляют примеры к промпту: символы и ~токены на ход, доля ходов с примерами
+
+Использование:
+    python build_examples_index.py --db ../sofia_conversations.db
+    python build_examples_index.py --db ../sofia_conversations.db --out /tmp/examples.jsonl --rebuild -k 2
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from examples_index import TOP_K, ExamplesIndex, format_examples
+
+
+def load_turns(db_path: str, limit: int) -> list:
+    """(chat_id, реплика клиента, предыдущая реплика Софии) — последние limit ходов из messages"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('SELECT chat_id, role, content FROM messages ORDER BY chat_id, id')
+    turns, last_bot = [], {}
+    for chat_id, role, content in c.fetchall():
+        if role == "assistant":
+            last_bot[chat_id] = content
+        elif role == "user":
+            turns.append((chat_id, content, last_bot.get(chat_id, "")))
+    conn.close()
+    return turns[-limit:]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Индекс удачных ответов для few-shot + замеры')
+    parser.add_argument('--db', required=True, help='База bot_server.py (sofia_conversations.db)')
+    parser.add_argument('--out', default=str(ROOT_DIR / 'examples_index.jsonl'), help='Файл индекса')
+    parser.add_argument('--rebuild', action='store_true', help='Собрать индекс заново')
+    parser.add_argument('-k', type=int, default=TOP_K, help='Примеров на ход')
+    parser.add_argument('-n', type=int, default=2000, help='Сколько реплик клиентов для замера запросов')
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.exists(args.out):
+        os.remove(args.out)
+
+    started = time.perf_counter()
+    index = ExamplesIndex.load(args.out)
+    load_s = time.perf_counter() - started
+    before = len(index.docs)
+    started = time.perf_counter()
+    added = index.sync(args.db)
+    sync_s = time.perf_counter() - started
+    print(f"📚 Индекс {args.out}: {len(index.docs)} примеров, терминов {len(index.postings)}")
+    print(f"   Загрузка с диска: {load_s * 1000:.1f} мс ({before} примеров)")
+    print(f"   Новых из feedback_v2: {added} за {sync_s * 1000:.1f} мс"
+          + (f" ({sync_s / added * 1000:.2f} мс на пример)" if added else ""))
+
+    # Сборка в памяти с нуля — сколько стоил бы старт без файла
+    started = time.perf_counter()
+    fresh = ExamplesIndex()
+    fresh.sync(args.db)
+    print(f"   Сборка с нуля (без файла): {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    turns = load_turns(args.db, args.n)
+    if not turns or not index.docs:
+        print("❌ Нет реплик клиентов или примеров для замера")
+        return
+
+    latencies, sizes, hits = [], [], 0
+    for chat_id, text, last_bot in turns:
+        started = time.perf_counter()
+        results = index.search(text, last_bot, args.k, exclude_chat=chat_id)
+        latencies.append((time.perf_counter() - started) * 1e6)
+        block = format_examples(results)
+        sizes.append(len(block) + 2 if block else 0)
+        hits += bool(results)
+
+    from sofia_prompt import get_system_prompt
+    prompt_size = len(get_system_prompt("Клиент"))
+    avg_size = sum(sizes) / len(sizes)
+    print(f"\n🔎 Запросов: {len(turns)}, с примерами: {hits} ({hits / len(turns) * 100:.0f}%)")
+    print(f"   Задержка: p50 {percentile(latencies, 0.5):.0f} мкс, p95 {percentile(latencies, 0.95):.0f} мкс, "
+          f"макс {max(latencies):.0f} мкс")
+    print(f"   Примеры в промпте: в среднем {avg_size:.0f} симв. (~{avg_size / 4:.0f} ток.), "
+          f"макс {max(sizes)} — к промпту {prompt_size} симв. (+{avg_size / prompt_size * 100:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
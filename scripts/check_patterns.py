@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Проверка списков паттернов: точный поиск против нечёткого (опечатки, fuzzy_match.py)
+- Точность/полнота каждого списка на размеченных сообщениях (patterns_labelled.jsonl)
+- Сколько реплик клиентов из баз ботов ловит каждый режим и сколько добавляет нечёткий (с примерами)
+- Время на сообщение — чтобы решить, каким детекторам включать FUZZY_PATTERNS
+
+Использование:
+    python check_patterns.py --db ../sofia_hybrid.db ../sofia_conversations.db
+    python check_patterns.py --patterns mined_patterns.py --fuzzy SEND,CALL_REJECT
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from hot_reload import (
+    HYBRID_PATTERN_NAMES, compile_patterns, evaluate_patterns, load_hybrid_patterns, load_labelled_messages,
+    parse_fuzzy_names,
+)
+from mine_patterns import iter_db_dialogs
+from text_normalize import normalize_text
+
+
+def load_client_messages(db_paths) -> list:
+    """Нормализованные реплики клиентов из баз ботов"""
+    messages = []
+    for db_path in db_paths:
+        for dialog in iter_db_dialogs(db_path):
+            messages.extend(normalize_text(m.text) for m in dialog if not m.is_manager)
+    return messages
+
+
+def time_matchers(matchers: dict, messages: list) -> dict:
+    """Микросекунды на сообщение по каждому списку (второй прогон — с прогретым кэшем слов)"""
+    timings = {}
+    for name, matcher in matchers.items():
+        for _ in range(2):
+            started = time.perf_counter()
+            for text in messages:
+                matcher.search(text)
+            timings[name] = (time.perf_counter() - started) / len(messages) * 1e6
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Точный и нечёткий поиск паттернов: полнота и цена')
+    parser.add_argument('--patterns', default=str(ROOT_DIR / 'sofia_hybrid.py'), help='Файл паттернов')
+    parser.add_argument('--labelled', default=str(ROOT_DIR / 'patterns_labelled.jsonl'),
+                        help='Размеченные сообщения')
+    parser.add_argument('--db', nargs='+', default=[], help='Базы ботов — реплики клиентов для охвата и времени')
+    parser.add_argument('--fuzzy', default='all', help='Какие списки сравнивать в нечётком режиме (как FUZZY_PATTERNS)')
+    parser.add_argument('--examples', type=int, default=5, help='Примеров новых срабатываний на список')
+    args = parser.parse_args()
+
+    patterns = load_hybrid_patterns(Path(args.patterns).read_text(encoding='utf-8'))
+    names = parse_fuzzy_names(args.fuzzy) or HYBRID_PATTERN_NAMES
+
+    started = time.perf_counter()
+    exact = compile_patterns(patterns)
+    fuzzy = compile_patterns(patterns, names)
+    print(f"🔧 Сборка матчеров: {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    if Path(args.labelled).exists():
+        labelled = load_labelled_messages(args.labelled)
+        exact_metrics = evaluate_patterns(exact, labelled)
+        fuzzy_metrics = evaluate_patterns(fuzzy, labelled)
+        print(f"\n🧪 {args.labelled} ({len(labelled)} сообщений)")
+        print(f"   {'Список':<22} {'точный p/r':>12} {'нечёткий p/r':>14}")
+        for name in names:
+            e, f = exact_metrics[name], fuzzy_metrics[name]
+            print(f"   {name:<22} {e['precision']:>5.2f}/{e['recall']:<5.2f} "
+                  f"{f['precision']:>7.2f}/{f['recall']:<5.2f}")
+
+    messages = load_client_messages(args.db)
+    if not messages:
+        return
+
+    exact_times = time_matchers({name: exact[name] for name in names}, messages)
+    fuzzy_times = time_matchers({name: fuzzy[name] for name in names}, messages)
+    print(f"\n📊 Реплики клиентов: {len(messages)}")
+    print(f"   {'Список':<22} {'точный':>8} {'+нечёткий':>10} {'мкс точн.':>10} {'мкс нечётк.':>12}")
+    for name in names:
+        exact_hits = {text for text in messages if exact[name].search(text)}
+        added = [text for text in dict.fromkeys(messages) if text not in exact_hits and fuzzy[name].search(text)]
+        print(f"   {name:<22} {len(exact_hits):>8} {len(added):>10} "
+              f"{exact_times[name]:>10.1f} {fuzzy_times[name]:>12.1f}")
+        for text in added[:args.examples]:
+            print(f"      + {text.strip()[:70]}  ← {fuzzy[name].fuzzy_search(text).strip()}")
+
+
+if __name__ == '__main__':
+    main()
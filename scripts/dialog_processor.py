@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
 """
 Обработка диалогов для Sofia Bot
-- Парсинг из TXT/RTF
+- Парсинг из TXT/RTF и экспорта Telegram (result.json)
 - Автоматическая оценка качества
 - Конвертация в JSONL для fine-tuning
 """
 
+import os
 import re
+import sys
+import codecs
 import json
+import hashlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
 from typing import List, Dict, Tuple
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from text_normalize import normalize_lines, normalize_pattern, normalize_text
+
 @dataclass
 class Message:
     date: str
@@ -32,154 +42,717 @@ class DialogScore:
 # ПАРСИНГ
 # ============================================================
 
+# Группы-«назначения» RTF, текст которых не выводится (таблицы шрифтов, цветов, метаданные...)
+RTF_SKIP_DESTINATIONS = {
+    'fonttbl', 'colortbl', 'expandedcolortbl', 'stylesheet', 'info', 'listtable',
+    'listoverridetable', 'revtbl', 'rsidtbl', 'generator', 'pict', 'object', 'header',
+    'footer', 'headerl', 'headerr', 'footerl', 'footerr', 'xmlnstbl', 'themedata',
+    'colorschememapping', 'latentstyles', 'datastore', 'fldinst',
+}
+# Управляющие слова → текст
+RTF_NEWLINE_WORDS = {'par', 'line', 'sect', 'page', 'row', 'cell'}
+RTF_CHAR_WORDS = {
+    'tab': '\t', 'emdash': '—', 'endash': '–', 'emspace': ' ', 'enspace': ' ',
+    'bullet': '•', 'lquote': '‘', 'rquote': '’', 'ldblquote': '“', 'rdblquote': '”',
+}
+RTF_DEFAULT_CODEPAGE = 1251
+RTF_READ_CHUNK = 1 << 16
+
+# Токены: текст вперемешку с \uN | \слово[число][пробел] | \'xx | \символ | { } | переводы строк исходника
+RTF_TOKEN_RE = re.compile(
+    r"((?:\\u-?\d{1,6} ?|[^\\{}\r\n])+)"
+    r"|\\([a-zA-Z]{1,32})(-?\d{0,10}) ?"
+    r"|\\'([0-9a-fA-F]{0,2})"
+    r"|\\([^a-zA-Z'])"
+    r"|\\$"
+    r"|([{}])"
+    r"|[\r\n]+"
+)
+RTF_UNICODE_RE = re.compile(r"\\u(-?\d{1,6}) ?")
+RTF_SURROGATE_RE = re.compile('[\ud800-\udfff]')
+
+
+def _rtf_unicode_char(m) -> str:
+    code = int(m.group(1))
+    return chr(code + 0x10000 if code < 0 else code)
+
+
+def iter_rtf_text(chunks):
+    """
+    Однопроходный потоковый разбор RTF: на вход — куски исходника (str),
+    на выход — куски текста по мере чтения.
+    - группы и назначения (fonttbl, colortbl, \\*...) — пропускаются целиком
+    - \\uN (в т.ч. отрицательные) с пропуском \\ucN замен, суррогатные пары склеиваются в эмодзи
+    - \\'xx — байты в кодировке документа (\\ansicpgN, по умолчанию cp1251)
+    """
+    codepage = f"cp{RTF_DEFAULT_CODEPAGE}"
+    stack = []            # (skip, uc) внешних групп
+    skip = False          # внутри пропускаемой группы
+    uc = 1                # сколько замен идёт после \uN
+    fallback = 0          # сколько замен ещё пропустить
+    group_start = False   # первый токен группы (назначение?)
+    pending = bytearray()  # \'xx подряд — декодируем вместе
+    out = []
+    held = ''             # первая половина суррогатной пары в конце прошлого куска
+    buf = ''
+
+    def flush_bytes():
+        if pending:
+            if not skip:
+                out.append(pending.decode(codepage, errors='replace'))
+            pending.clear()
+
+    def text_run(run: str) -> str:
+        """Текст с \\uN → строка. При \\uc0 (TextEdit) — одной заменой без цикла по символам."""
+        nonlocal fallback
+        if fallback:
+            cut = 0
+            while fallback and cut < len(run) and run[cut] != '\\':
+                cut += 1
+                fallback -= 1
+            run = run[cut:]
+        if uc == 0 or '\\' not in run:
+            return RTF_UNICODE_RE.sub(_rtf_unicode_char, run)
+        # \ucN > 0: после каждого \uN пропускаем N символов-замен
+        parts = []
+        last = 0
+        for m in RTF_UNICODE_RE.finditer(run):
+            if m.start() < last:
+                continue
+            parts.append(run[last:m.start()])
+            parts.append(_rtf_unicode_char(m))
+            last = m.end()
+            rest = uc
+            while rest and last < len(run) and run[last] != '\\':
+                last += 1
+                rest -= 1
+            fallback = rest if last == len(run) else 0
+        parts.append(run[last:])
+        return ''.join(parts)
+
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buf += chunk
+        pos = 0
+        for m in RTF_TOKEN_RE.finditer(buf):
+            run, word, arg, hexbyte, symbol, brace = m.groups()
+            # Токен у края буфера может быть неполным — дочитываем следующий кусок
+            if not final and m.end() == len(buf):
+                if run is None:
+                    break
+                # Текст режется где угодно, кроме середины последнего \uN
+                cut = run.rfind('\\')
+                if cut == 0:
+                    break
+                if cut > 0:
+                    run = run[:cut]
+                pos = m.start() + len(run)
+            else:
+                pos = m.end()
+
+            if hexbyte is not None:
+                if fallback:
+                    fallback -= 1
+                elif len(hexbyte) == 2:
+                    pending.append(int(hexbyte, 16))
+                group_start = False
+                continue
+            flush_bytes()
+
+            if run is not None:
+                group_start = False
+                text = text_run(run)
+                if text and not skip:
+                    out.append(text)
+            elif brace == '{':
+                stack.append((skip, uc))
+                group_start = True
+                fallback = 0
+            elif brace == '}':
+                if stack:
+                    skip, uc = stack.pop()
+                group_start = False
+                fallback = 0
+            elif word is not None:
+                fallback = 0
+                if group_start and word in RTF_SKIP_DESTINATIONS:
+                    skip = True
+                group_start = False
+                if arg in ('', '-'):
+                    arg = None
+                if word == 'uc' and arg is not None:
+                    uc = int(arg)
+                elif word == 'ansicpg' and arg is not None:
+                    codepage = f"cp{arg}"
+                elif skip:
+                    pass
+                elif word in RTF_NEWLINE_WORDS:
+                    out.append('\n')
+                elif word in RTF_CHAR_WORDS:
+                    out.append(RTF_CHAR_WORDS[word])
+            elif symbol is not None:
+                fallback = 0
+                if symbol == '*' and group_start:
+                    skip = True
+                elif skip:
+                    pass
+                elif symbol in '\\{}':
+                    out.append(symbol)
+                elif symbol in '\r\n':
+                    out.append('\n')  # "\" + перевод строки = абзац (так пишет TextEdit)
+                elif symbol == '~':
+                    out.append('\xa0')
+                elif symbol == '_':
+                    out.append('-')
+                group_start = group_start and symbol == '*'
+            # Переводы строк исходника RTF текстом не являются
+
+        buf = buf[pos:]
+        if final:
+            flush_bytes()
+        text = held + ''.join(out)
+        out.clear()
+        held = ''
+        if text and not final and '\ud800' <= text[-1] <= '\udbff':
+            text, held = text[:-1], text[-1]
+        if RTF_SURROGATE_RE.search(text):
+            # Склеиваем суррогатные пары в эмодзи, непарные половинки выбрасываем
+            text = text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'ignore')
+        if text:
+            yield text
+
+
+def read_source_chunks(path, hasher=None, chunk_size: int = RTF_READ_CHUNK):
+    """Файл кусками (utf-8, битые байты пропускаются); hasher — считаем хэш на лету"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with open(path, 'rb') as f:
+        for raw in iter(lambda: f.read(chunk_size), b''):
+            if hasher is not None:
+                hasher.update(raw)
+            text = decoder.decode(raw)
+            if text:
+                yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def read_rtf_text(path, chunk_size: int = RTF_READ_CHUNK):
+    """Потоковое чтение RTF-файла: отдаёт текст кусками"""
+    yield from iter_rtf_text(read_source_chunks(path, chunk_size=chunk_size))
+
+
 def decode_rtf(content: str) -> str:
     """Декодирует RTF с unicode в обычный текст"""
-    content = re.sub(r'\\uc0', '', content)
-    
-    def replace_unicode(m):
-        try:
-            code = int(m.group(1))
-            if 0xD800 <= code <= 0xDFFF:  # surrogate (emoji)
-                return '😊'  # заменяем на generic emoji
-            return chr(code)
-        except:
-            return ''
-    
-    content = re.sub(r'\\u(\d+)\s?', replace_unicode, content)
-    content = re.sub(r'\{[^}]*\}', '', content)
-    content = re.sub(r'\\[a-z]+\d*\s?', '', content)
-    content = re.sub(r'\\\'[0-9a-f]{2}', '', content)
-    content = re.sub(r'[\{\}]', '', content)
-    content = content.replace('\\', '\n')
-    return content.strip()
+    return ''.join(iter_rtf_text([content])).strip()
 
-def parse_dialog(text: str, manager_names: List[str] = None) -> List[Message]:
+
+def iter_text_lines(chunks):
+    """Куски текста → строки (без '\\n' и '\\r')"""
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if rest:
+        yield rest.rstrip('\r')
+
+
+def iter_dialog_lines(path, hasher=None):
+    """Строки диалога из .txt/.rtf — по мере чтения файла"""
+    chunks = read_source_chunks(path, hasher)
+    if Path(path).suffix.lower() == '.rtf':
+        chunks = iter_rtf_text(chunks)
+    return iter_text_lines(chunks)
+
+
+DEFAULT_MANAGER_NAMES = ['София', 'Sofia', 'Сергей', 'Виктория', 'Оксана', 'Юлия', 'Игорь']
+
+# Начало сообщения: [дата время] Автор: текст
+MESSAGE_HEADER_RE = re.compile(r'\[([^\]]+)\s+(\d{1,2}:\d{2})\]\s*([^:]+):\s*(.*)')
+
+
+def iter_messages(lines, manager_names: List[str] = None):
     """
-    Парсит диалог из текста.
-    Формат: [дата время] Автор: текст
+    Построчный парсер: отдаёт Message, как только сообщение закончилось.
+    Сообщение продолжается на следующих строках и заканчивается пустой строкой
+    или строкой, начинающейся с '[' (обычно это следующее сообщение).
+    Память не зависит от размера файла — держим только текущее сообщение.
     """
     if manager_names is None:
-        manager_names = ['София', 'Sofia', 'Сергей', 'Виктория', 'Оксана', 'Юлия', 'Игорь']
+        manager_names = DEFAULT_MANAGER_NAMES
+    names = [name.lower() for name in manager_names]
     
-    # Паттерн для сообщений
-    pattern = r'\[([^\]]+)\s+(\d{1,2}:\d{2})\]\s*([^:]+):\s*(.+?)(?=\n\n|\n\[|$)'
-    
-    messages = []
-    for match in re.finditer(pattern, text, re.DOTALL):
-        date, time, author, msg_text = match.groups()
-        author = author.strip()
-        msg_text = msg_text.strip()
-        
-        # Определяем, менеджер это или клиент
-        is_manager = any(name.lower() in author.lower() for name in manager_names)
-        
+    def finish(date, time, author, parts):
+        msg_text = '\n'.join(parts).strip()
         if msg_text and len(msg_text) > 1:
-            messages.append(Message(
+            author = author.strip()
+            # Определяем, менеджер это или клиент
+            author_lower = author.lower()
+            return Message(
                 date=date.strip(),
                 time=time.strip(),
                 author=author,
                 text=msg_text,
-                is_manager=is_manager
-            ))
+                is_manager=any(name in author_lower for name in names)
+            )
+        return None
+    
+    current = None  # (дата, время, автор, [строки текста])
+    for line in lines:
+        if current is not None and not line.startswith('['):
+            if line.strip():
+                current[3].append(line)
+            elif current[3]:
+                # Пустая строка — конец сообщения (если текст уже начался)
+                msg = finish(*current)
+                current = None
+                if msg:
+                    yield msg
+            continue
+        
+        match = MESSAGE_HEADER_RE.match(line.lstrip())
+        if current is not None:
+            msg = finish(*current)
+            current = None
+            if msg:
+                yield msg
+        if match:
+            date, time, author, msg_text = match.groups()
+            current = (date, time, author, [msg_text] if msg_text.strip() else [])
     
-    return messages
+    if current is not None:
+        msg = finish(*current)
+        if msg:
+            yield msg
+
+
+def parse_dialog(text: str, manager_names: List[str] = None) -> List[Message]:
+    """
+    Парсит диалог из текста.
+    Формат: [дата время] Автор: текст
+    """
+    return list(iter_messages(text.split('\n'), manager_names))
+
+
+def parse_dialog_file(path, manager_names: List[str] = None, hasher=None):
+    """Сообщения из файла по мере чтения (txt/rtf)"""
+    return iter_messages(iter_dialog_lines(path, hasher), manager_names)
+
+# ============================================================
+# ЭКСПОРТ TELEGRAM DESKTOP (result.json)
+# ============================================================
+
+# Какие чаты экспорта считаем диалогами с клиентами
+TELEGRAM_CHAT_TYPES = ('personal_chat',)
+
+
+class _JsonStream:
+    """
+    Потоковое чтение большого JSON: контейнеры обходим вручную,
+    мелкие значения (сообщение, строка, число) — json.raw_decode из буфера.
+    Весь файл в память не загружается.
+    """
+    
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+    
+    def _more(self) -> bool:
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+    
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Неожиданный конец JSON")
+    
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"Ожидался '{ch}' на позиции {self.pos}: {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+    
+    def value(self):
+        """Следующее значение целиком"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._more():
+                    continue
+                raise
+            # Число у края буфера может продолжаться в следующем куске
+            if end == len(self.buf) and not self.eof and self._more():
+                continue
+            self.pos = end
+            return value
+    
+    def keys(self):
+        """Обход объекта: отдаёт ключи, значение вызывающий читает сам (value() или спуск)"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect('}')
+            return
+    
+    def items(self):
+        """Обход массива: отдаёт управление перед каждым элементом"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+def telegram_text(text) -> str:
+    """text в экспорте — строка или список из строк и {"type": ..., "text": ...}"""
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return ''
+
+
+def telegram_message(raw: Dict, names: List[str]):
+    """Сообщение экспорта → Message (служебные и пустые — None)"""
+    if raw.get('type') != 'message':
+        return None
+    msg_text = telegram_text(raw.get('text')).strip()
+    if not msg_text or len(msg_text) < 2:
+        return None
+    author = (raw.get('from') or '').strip() or str(raw.get('from_id', ''))
+    # "2025-01-12T14:05:00" → дата и время как в текстовых выгрузках
+    stamp = raw.get('date', '')
+    day, _, clock = stamp.partition('T')
+    if len(day) == 10:
+        day = f"{day[8:10]}.{day[5:7]}.{day[0:4]}"
+    author_lower = author.lower()
+    return Message(
+        date=day,
+        time=clock[:5],
+        author=author,
+        text=msg_text,
+        is_manager=any(name in author_lower for name in names)
+    )
+
+
+def _read_telegram_chat(stream: _JsonStream, names: List[str]) -> Dict:
+    """Один чат: метаданные + сообщения (поштучно, без загрузки массива целиком)"""
+    chat = {'name': '', 'type': '', 'id': None, 'messages': []}
+    for key in stream.keys():
+        if key == 'messages':
+            for _ in stream.items():
+                msg = telegram_message(stream.value(), names)
+                if msg:
+                    chat['messages'].append(msg)
+        else:
+            value = stream.value()
+            if key in ('name', 'type', 'id'):
+                chat[key] = value
+    return chat
+
+
+def iter_telegram_chats(path, manager_names: List[str] = None, chat_types=TELEGRAM_CHAT_TYPES, hasher=None):
+    """
+    Потоковый разбор result.json (Telegram Desktop → Экспорт данных, формат JSON).
+    Отдаёт по чату: {'name', 'type', 'id', 'messages': [Message, ...]}.
+    Поддерживает полный экспорт (chats.list) и экспорт одного чата.
+    """
+    if manager_names is None:
+        manager_names = DEFAULT_MANAGER_NAMES
+    names = [name.lower() for name in manager_names]
+    stream = _JsonStream(read_source_chunks(path, hasher))
+    
+    def wanted(chat):
+        return chat['messages'] and (not chat_types or chat['type'] in chat_types)
+    
+    single = {'name': '', 'type': '', 'id': None, 'messages': []}
+    for key in stream.keys():
+        if key == 'chats':
+            for chats_key in stream.keys():
+                if chats_key != 'list':
+                    stream.value()
+                    continue
+                for _ in stream.items():
+                    chat = _read_telegram_chat(stream, names)
+                    if wanted(chat):
+                        yield chat
+        elif key == 'messages':
+            # Экспорт одного чата: сообщения на верхнем уровне
+            for _ in stream.items():
+                msg = telegram_message(stream.value(), names)
+                if msg:
+                    single['messages'].append(msg)
+        else:
+            value = stream.value()
+            if key in ('name', 'type', 'id'):
+                single[key] = value
+    
+    if wanted(single):
+        yield single
+
+
+def messages_hash(messages: List[Message]) -> str:
+    """Хэш содержимого диалога (для кэша оценок, когда нет отдельного файла)"""
+    hasher = hashlib.sha1()
+    for m in messages:
+        hasher.update(f"{m.date} {m.time}\x1f{m.author}\x1f{m.text}\x1e".encode('utf-8'))
+    return hasher.hexdigest()
+
 
 # ============================================================
 # АВТОМАТИЧЕСКАЯ ОЦЕНКА
 # ============================================================
 
-def score_dialog(messages: List[Message]) -> DialogScore:
+# Маркеры (подстроки нормализованного текста, см. text_normalize).
+# Маркер с пунктуацией ('да,') ищется по сырому тексту в нижнем регистре: нормализация стёрла бы запятую,
+# а голое "Да" клиента (ответ на "Удобно сейчас пообщаться?") — не согласие на созвон
+MARKER_SETS = {
+    'call': ['созвонимся', 'встреча', 'телемост', 'zoom', 'видеопрезентация',
+             'во сколько удобно', 'когда удобно', 'договорились'],
+    'agreement': ['давайте', 'хорошо', 'договорились', 'да,', 'ок', 'в 17', 'в 15', 'после 13'],
+    'send': ['whatsapp', 'telegram', 'отправлю', 'пришлю подборку'],
+    'refusal': ['не интересно', 'не актуально', 'передумал', 'отказ'],
+    'goal': ['инвестиц', 'для себя', 'для жизни', 'аренд', 'пассивный доход'],
+    'geo': ['сочи', 'крым', 'анапа', 'алтай', 'поляна', 'ольгинка'],
+    'live': ['порядка', 'примерно', 'около', 'кстати', 'как раз', 'крутой', 'классный', 'супер'],
+    'irritation': ['я же сказал', 'уже говорил', 'повторяю', 'вы меня не слышите'],
+}
+MARKER_SCOPES = ('any', 'manager', 'client')
+
+# Вектор признаков диалога: фиксированный порядок, array('d')
+FEATURE_NAMES = tuple(
+    [f"{name}_{scope}" for name in MARKER_SETS for scope in MARKER_SCOPES] + [
+        'messages', 'manager_messages', 'client_messages',
+        'manager_words', 'client_words',
+        'manager_questions', 'repeated_questions',
+    ]
+)
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_NAMES)}
+
+def trie_regex(words) -> str:
+    """Список строк → regex-дерево по общим префиксам ('о(?:коло|к)'): длинное совпадение первым"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = True
+    
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            return f"(?:{body})?"
+        return body
+    
+    return build(trie)
+
+
+def _build_marker_matcher():
     """
-    Автоматически оценивает качество диалога.
-    Возвращает score 0-10 и детали.
+    Один regex-дерево на все наборы маркеров, совпадения берутся самые длинные.
+    Маркеры внутри найденного ('ок' в 'около', 'во сколько удобно') засчитываются через таблицу.
+    Отличие от проверки каждого маркера через `in` — только для маркеров, склеенных
+    без пробела с другим маркером ("хорошок"): такое в переписке не встречается.
+    Маркеры нормализуются так же, как текст; маркеры с пунктуацией — в _build_raw_marker_matcher.
+    """
+    normalized = {name: {normalize_pattern(m) for m in ms if not is_raw_marker(m)} - {''}
+                  for name, ms in MARKER_SETS.items()}
+    markers = sorted(set().union(*normalized.values()))
+    marker_sets = {m: [name for name, ms in normalized.items() if m in ms] for m in markers}
+    pattern = re.compile(trie_regex(markers))
+    # найденный маркер → [(набор, маркер)] для него и всех маркеров внутри него
+    hits = {m: [(name, p) for p in markers if p in m for name in marker_sets[p]] for m in markers}
+    # то же в номерах: (номер набора в MARKER_SETS, маркер) — для заполнения вектора
+    set_index = {name: i for i, name in enumerate(MARKER_SETS)}
+    slots = {m: [(set_index[name], p) for name, p in hits[m]] for m in markers}
+    return pattern, hits, slots
+
+
+def is_raw_marker(marker: str) -> bool:
+    return re.search(r"[^\w\s]", marker) is not None
+
+
+def _build_raw_marker_matcher():
+    """Маркеры с пунктуацией: regex по тексту в нижнем регистре (как до нормализации) + те же таблицы"""
+    set_index = {name: i for i, name in enumerate(MARKER_SETS)}
+    hits, slots = {}, {}
+    for name, ms in MARKER_SETS.items():
+        for m in ms:
+            if is_raw_marker(m):
+                hits.setdefault(m, []).append((name, m))
+                slots.setdefault(m, []).append((set_index[name], m))
+    pattern = re.compile('|'.join(re.escape(m) for m in sorted(hits, key=len, reverse=True)) or r'(?!)')
+    return pattern, hits, slots
+
+
+MARKER_RE, MARKER_HITS, MARKER_SLOTS = _build_marker_matcher()
+RAW_MARKER_RE, RAW_MARKER_HITS, RAW_MARKER_SLOTS = _build_raw_marker_matcher()
+
+
+def match_markers(text: str) -> set:
+    """Все маркеры в тексте за один проход: {(набор, маркер)}"""
+    return (_expand_markers(MARKER_RE.findall(normalize_text(text)))
+            | _expand_markers(RAW_MARKER_RE.findall(text.lower()), RAW_MARKER_HITS))
+
+
+def _expand_markers(found, table=MARKER_HITS) -> set:
+    hits = set()
+    for marker in set(found):
+        hits.update(table[marker])
+    return hits
+
+
+def extract_features(messages: List[Message]) -> array:
+    """
+    Вектор признаков диалога (FEATURE_NAMES).
+    Текст каждой стороны нормализуется одним блоком и прогоняется через общий matcher
+    ровно один раз (сообщения разделены '\n' — маркер не склеивается из двух реплик).
+    Маркерные признаки — число разных маркеров набора (во всём диалоге / у менеджера / у клиента).
+    """
+    manager_texts = [m.text for m in messages if m.is_manager]
+    client_texts = [m.text for m in messages if not m.is_manager]
+    manager_lower = '\n'.join(manager_texts).lower()
+    client_lower = '\n'.join(client_texts).lower()
+    manager_found = MARKER_RE.findall(normalize_lines(manager_texts))
+    client_found = MARKER_RE.findall(normalize_lines(client_texts))
+    manager_raw = RAW_MARKER_RE.findall(manager_lower)
+    client_raw = RAW_MARKER_RE.findall(client_lower)
+    manager_questions = [t for t in manager_texts if '?' in t]
+    
+    vec = array('d', bytes(8 * len(FEATURE_NAMES)))
+    # Маркерные признаки лежат подряд: набор × (any, manager, client)
+    scopes = ((manager_found + client_found, manager_raw + client_raw), (manager_found, manager_raw),
+              (client_found, client_raw))
+    for scope, (found, raw) in enumerate(scopes):
+        for set_idx, _ in _expand_markers(found, MARKER_SLOTS) | _expand_markers(raw, RAW_MARKER_SLOTS):
+            vec[set_idx * 3 + scope] += 1
+    vec[FEATURE_INDEX['messages']] = len(messages)
+    vec[FEATURE_INDEX['manager_messages']] = len(manager_texts)
+    vec[FEATURE_INDEX['client_messages']] = len(client_texts)
+    vec[FEATURE_INDEX['manager_words']] = len(manager_lower.split())
+    vec[FEATURE_INDEX['client_words']] = len(client_lower.split())
+    vec[FEATURE_INDEX['manager_questions']] = len(manager_questions)
+    vec[FEATURE_INDEX['repeated_questions']] = len(manager_questions) - len(set(manager_questions))
+    return vec
+
+
+def features_dict(vec) -> Dict[str, float]:
+    """Вектор → {имя: значение} (для аналитики и выгрузок)"""
+    return dict(zip(FEATURE_NAMES, vec))
+
+
+def score_features(vec) -> DialogScore:
+    """
+    Эвристическая оценка 0-10 по вектору признаков.
     """
+    f = FEATURE_INDEX
     score = 0
     issues = []
     positives = []
     details = {}
     
-    # Объединяем весь текст
-    full_text = ' '.join(m.text.lower() for m in messages)
-    manager_texts = [m.text for m in messages if m.is_manager]
-    client_texts = [m.text for m in messages if not m.is_manager]
-    
     # 1. РЕЗУЛЬТАТ (0-3 балла)
     result = "неопределён"
     
-    # Созвон назначен
-    call_markers = ['созвонимся', 'встреча', 'телемост', 'zoom', 'видеопрезентация', 
-                    'во сколько удобно', 'когда удобно', 'договорились']
-    if any(m in full_text for m in call_markers):
-        # Проверяем что клиент согласился
-        agreement_markers = ['давайте', 'хорошо', 'договорились', 'да,', 'ок', 'в 17', 'в 15', 'после 13']
-        client_agreed = any(m in ' '.join(t.lower() for t in client_texts) for m in agreement_markers)
-        if client_agreed:
+    # Созвон назначен — и клиент согласился
+    if vec[f['call_any']]:
+        if vec[f['agreement_client']]:
             score += 3
             result = "созвон"
             positives.append("✅ Созвон назначен")
             details['call_scheduled'] = 3
     
     # Подборка отправлена
-    elif any(m in full_text for m in ['whatsapp', 'telegram', 'отправлю', 'пришлю подборку']):
+    elif vec[f['send_any']]:
         score += 1
         result = "подборка"
         positives.append("📋 Отправка подборки")
         details['materials_sent'] = 1
     
     # Отказ
-    elif any(m in full_text for m in ['не интересно', 'не актуально', 'передумал', 'отказ']):
+    elif vec[f['refusal_any']]:
         result = "отказ"
         issues.append("❌ Клиент отказался")
         details['rejection'] = -1
     
     # 2. ГЛУБИНА КВАЛИФИКАЦИИ (0-2 балла)
     qualification_done = 0
-    if any(m in full_text for m in ['инвестиц', 'для себя', 'для жизни', 'аренд', 'пассивный доход']):
+    if vec[f['goal_any']]:
         qualification_done += 1
         positives.append("✅ Выяснена цель")
-    if any(m in full_text for m in ['сочи', 'крым', 'анапа', 'алтай', 'поляна', 'ольгинка']):
+    if vec[f['geo_any']]:
         qualification_done += 1
         positives.append("✅ Выяснена локация")
     
     score += min(qualification_done, 2)
     details['qualification'] = min(qualification_done, 2)
     
-    # 3. ЖИВОСТЬ РЕЧИ (0-2 балла)
-    live_speech = 0
-    live_markers = ['порядка', 'примерно', 'около', 'кстати', 'как раз', 'крутой', 'классный', 'супер']
-    manager_full = ' '.join(t.lower() for t in manager_texts)
-    
-    for marker in live_markers:
-        if marker in manager_full:
-            live_speech += 0.5
-    
-    live_speech = min(int(live_speech), 2)
+    # 3. ЖИВОСТЬ РЕЧИ (0-2 балла): по 0.5 за каждый разный маркер у менеджера
+    live_speech = min(int(vec[f['live_manager']] * 0.5), 2)
     score += live_speech
     details['live_speech'] = live_speech
     if live_speech >= 1:
         positives.append("✅ Живая речь")
     
     # 4. ДЛИНА ДИАЛОГА (0-1 балл)
-    if len(messages) >= 10:
+    messages_count = int(vec[f['messages']])
+    if messages_count >= 10:
         score += 1
         details['dialog_length'] = 1
-        positives.append(f"✅ Диалог {len(messages)} сообщений")
+        positives.append(f"✅ Диалог {messages_count} сообщений")
     else:
         details['dialog_length'] = 0
-        issues.append(f"⚠️ Короткий диалог ({len(messages)} сообщений)")
+        issues.append(f"⚠️ Короткий диалог ({messages_count} сообщений)")
     
     # 5. НЕГАТИВНЫЕ СИГНАЛЫ (-2 балла максимум)
     negative = 0
     
     # Клиент раздражён
-    irritation_markers = ['я же сказал', 'уже говорил', 'повторяю', 'вы меня не слышите']
-    if any(m in ' '.join(t.lower() for t in client_texts) for m in irritation_markers):
+    if vec[f['irritation_client']]:
         negative += 2
         issues.append("❌ Клиент раздражён")
     
     # Повторы вопросов (одинаковые фразы)
-    manager_questions = [t for t in manager_texts if '?' in t]
-    if len(manager_questions) != len(set(manager_questions)):
+    if vec[f['repeated_questions']]:
         negative += 1
         issues.append("⚠️ Повторяющиеся вопросы")
     
@@ -197,6 +770,14 @@ def score_dialog(messages: List[Message]) -> DialogScore:
         details=details
     )
 
+
+def score_dialog(messages: List[Message]) -> DialogScore:
+    """
+    Автоматически оценивает качество диалога.
+    Возвращает score 0-10 и детали.
+    """
+    return score_features(extract_features(messages))
+
 # ============================================================
 # LLM-ОЦЕНКА (точная, платная)
 # ============================================================
@@ -317,13 +898,14 @@ def format_dialog_for_llm(messages: List[Message], max_messages: int = 50) -> st
     
     return "\n".join(lines)
 
-def llm_score_dialog_openai(messages: List[Message], api_key: str, model: str = "gpt-4o-mini") -> Dict:
+def llm_score_dialog_openai(messages: List[Message], api_key: str, model: str = "gpt-4o-mini",
+                            dialog_text: str = None) -> Dict:
     """Оценка через OpenAI API"""
     import openai
     
     client = openai.OpenAI(api_key=api_key)
     
-    dialog_text = format_dialog_for_llm(messages)
+    dialog_text = dialog_text or format_dialog_for_llm(messages)
     
     response = client.chat.completions.create(
         model=model,
@@ -363,13 +945,14 @@ def llm_score_dialog_openai(messages: List[Message], api_key: str, model: str =
             "summary": f"Raw: {result_text[:150]}"
         }
 
-def llm_score_dialog_anthropic(messages: List[Message], api_key: str, model: str = "claude-3-haiku-20240307") -> Dict:
+def llm_score_dialog_anthropic(messages: List[Message], api_key: str, model: str = "claude-3-haiku-20240307",
+                               dialog_text: str = None) -> Dict:
     """Оценка через Anthropic API"""
     import anthropic
     
     client = anthropic.Anthropic(api_key=api_key)
     
-    dialog_text = format_dialog_for_llm(messages)
+    dialog_text = dialog_text or format_dialog_for_llm(messages)
     
     response = client.messages.create(
         model=model,
@@ -405,19 +988,21 @@ def llm_score_dialog_anthropic(messages: List[Message], api_key: str, model: str
             "summary": f"Raw: {result_text[:150]}"
         }
 
-def llm_score_dialog(messages: List[Message], api_key: str, provider: str = "openai", model: str = None) -> Dict:
+def llm_score_dialog(messages: List[Message], api_key: str, provider: str = "openai", model: str = None,
+                     dialog_text: str = None) -> Dict:
     """
     Универсальная функция оценки через LLM.
     
     provider: "openai" или "anthropic"
     model: название модели (если None, используется дефолтная)
+    dialog_text: готовый текст из format_dialog_for_llm (тогда messages не нужны)
     """
     if provider == "openai":
         model = model or "gpt-5.2"
-        return llm_score_dialog_openai(messages, api_key, model)
+        return llm_score_dialog_openai(messages, api_key, model, dialog_text)
     elif provider == "anthropic":
         model = model or "claude-3-haiku-20240307"
-        return llm_score_dialog_anthropic(messages, api_key, model)
+        return llm_score_dialog_anthropic(messages, api_key, model, dialog_text)
     else:
         raise ValueError(f"Unknown provider: {provider}")
 
@@ -454,16 +1039,8 @@ def process_file(filepath: str, manager_names: List[str] = None) -> Tuple[List[M
     """
     path = Path(filepath)
     
-    # Читаем файл
-    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-        content = f.read()
-    
-    # Декодируем если RTF
-    if path.suffix.lower() == '.rtf':
-        content = decode_rtf(content)
-    
-    # Парсим
-    messages = parse_dialog(content, manager_names)
+    # Читаем и парсим построчно (RTF — потоковым разбором)
+    messages = list(parse_dialog_file(path, manager_names))
     
     # Оцениваем
     score = score_dialog(messages)
@@ -473,29 +1050,107 @@ def process_file(filepath: str, manager_names: List[str] = None) -> Tuple[List[M
     
     return messages, score, jsonl_data
 
-def process_directory(dirpath: str, min_score: int = 5) -> List[Dict]:
+def compact_result(name: str, content_hash: str, messages: List[Message],
+                   min_score: int = 5, llm_threshold: int = None) -> Dict:
+    """
+    Компактный результат вместо списка Message (для пула процессов и кэша оценок).
+    jsonl — только если он может понадобиться (score >= min_score или кандидат на LLM),
+    dialog_text (готовый текст для LLM) — только для кандидатов.
+    """
+    score = score_dialog(messages)
+    is_candidate = llm_threshold is not None and score.total >= llm_threshold
+    return {
+        'file': name,
+        'hash': content_hash,
+        'messages_count': len(messages),
+        'score': score.total,
+        'result': score.result,
+        'positives': score.positives,
+        'issues': score.issues,
+        'jsonl': dialog_to_jsonl(messages) if is_candidate or score.total >= min_score else None,
+        'dialog_text': format_dialog_for_llm(messages) if is_candidate else None,
+    }
+
+
+def process_file_compact(filepath: str, manager_names: List[str] = None,
+                         min_score: int = 5, llm_threshold: int = None) -> Dict:
+    """
+    process_file для пула процессов: вместо списка Message возвращает compact_result.
+    Ошибка парсинга не роняет пул: возвращается {'file', 'error'}.
+    """
+    path = Path(filepath)
+    try:
+        hasher = hashlib.sha1()
+        messages = list(parse_dialog_file(path, manager_names, hasher))
+        return compact_result(path.name, hasher.hexdigest(), messages, min_score, llm_threshold)
+    except Exception as e:
+        return {'file': path.name, 'error': f"{type(e).__name__}: {e}"}
+
+
+def process_telegram_export(filepath: str, manager_names: List[str] = None,
+                            min_score: int = 5, llm_threshold: int = None,
+                            chat_types=TELEGRAM_CHAT_TYPES):
+    """
+    result.json Telegram → compact_result по каждому чату, по мере чтения экспорта.
+    Имя диалога — "result.json#<id чата> <имя>", хэш — по содержимому чата.
+    """
+    path = Path(filepath)
+    try:
+        for chat in iter_telegram_chats(path, manager_names, chat_types):
+            name = f"{path.name}#{chat['id']} {chat['name'] or ''}".strip()
+            yield compact_result(name, messages_hash(chat['messages']), chat['messages'],
+                                 min_score, llm_threshold)
+    except Exception as e:
+        yield {'file': path.name, 'error': f"{type(e).__name__}: {e}"}
+
+
+def process_files(filepaths: List[str], manager_names: List[str] = None, workers: int = 1,
+                  min_score: int = 5, llm_threshold: int = None):
+    """
+    Парсинг + эвристики по списку файлов, workers > 1 — по процессам.
+    Отдаёт компактные результаты в порядке filepaths; экспорты Telegram (.json) —
+    потоково в этом процессе, после текстовых файлов.
+    """
+    args = (manager_names, min_score, llm_threshold)
+    exports = [f for f in filepaths if str(f).lower().endswith('.json')]
+    filepaths = [f for f in filepaths if not str(f).lower().endswith('.json')]
+    workers = min(workers, os.cpu_count() or 1)  # Больше процессов, чем ядер, только мешает
+    if workers <= 1 or len(filepaths) < 2:
+        for filepath in filepaths:
+            yield process_file_compact(filepath, *args)
+    else:
+        # Крупные пачки — меньше накладных расходов на пересылку между процессами
+        chunksize = max(1, len(filepaths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(process_file_compact, filepaths,
+                                *[[a] * len(filepaths) for a in args], chunksize=chunksize)
+    
+    for export in exports:
+        yield from process_telegram_export(export, *args)
+
+
+def process_directory(dirpath: str, min_score: int = 5, workers: int = 1) -> List[Dict]:
     """
     Обрабатывает все диалоги в директории.
     Возвращает только диалоги с score >= min_score.
     """
-    results = []
     dir_path = Path(dirpath)
+    filepaths = sorted(str(p) for p in dir_path.glob('*') if p.suffix.lower() in ['.txt', '.rtf', '.json'])
     
-    for filepath in dir_path.glob('*'):
-        if filepath.suffix.lower() in ['.txt', '.rtf']:
-            try:
-                messages, score, jsonl_data = process_file(str(filepath))
-                results.append({
-                    'file': filepath.name,
-                    'messages_count': len(messages),
-                    'score': score.total,
-                    'result': score.result,
-                    'positives': score.positives,
-                    'issues': score.issues,
-                    'jsonl': jsonl_data if score.total >= min_score else None
-                })
-            except Exception as e:
-                print(f"Error processing {filepath}: {e}")
+    results = []
+    for r in process_files(filepaths, workers=workers, min_score=min_score):
+        if 'error' in r:
+            print(f"Error processing {r['file']}: {r['error']}")
+            continue
+        results.append({
+            'file': r['file'],
+            'messages_count': r['messages_count'],
+            'score': r['score'],
+            'result': r['result'],
+            'positives': r['positives'],
+            'issues': r['issues'],
+            'jsonl': r['jsonl'] if r['score'] >= min_score else None
+        })
     
     return sorted(results, key=lambda x: x['score'], reverse=True)
 
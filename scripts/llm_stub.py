@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Локальная замена OpenAI для офлайн-прогонов (replay_prompt.py)
+- Кассета: записанные ответы модели (JSONL), ключ — хэш запроса вместе с системным промптом
+- CassetteClient: подменяет OpenAI-клиент в процессе (responses / chat.completions);
+  промах — CassetteMiss (или запись с настоящей модели), а не выдуманный ответ
+- HTTP-заглушка с OpenAI-совместимым API: /v1/responses, /v1/chat/completions
+
+Использование:
+    # Поднять заглушку на кассете
+    python llm_stub.py --cassette replay.jsonl --port 8787
+    # Потом: OPENAI_BASE_URL=http://127.0.0.1:8787/v1 python replay_prompt.py ...
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+# Ответ HTTP-заглушки при промахе кассеты (нагрузочные стенды): с вопросом — чтобы проверялась
+# страховка "без вопросов". Регрессия (CassetteClient) его не использует: чужой ответ — не оценка кандидата
+DEFAULT_REPLY = "Поняла вас 🙂 Смотрите для себя или как инвестицию?"
+
+
+class CassetteMiss(LookupError):
+    """Для запроса нет ответа, записанного под этот промпт"""
+
+
+def dialog_key(params: dict) -> str:
+    """Модель + диалог, без системного промпта: по нему видно, что ответ есть, но под другой промпт"""
+    payload = {
+        "model": params.get("model"),
+        "input": params.get("input"),
+        "messages": params.get("messages"),
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def request_key(params: dict) -> str:
+    """
+    Ключ запроса: диалог + системный промпт (instructions). Правка промпта — промах:
+    ответ, записанный под старый промпт, ничего не говорит о кандидате.
+    """
+    raw = f"{dialog_key(params)}:{instructions_hash(params)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def instructions_hash(params: dict) -> str:
+    return hashlib.sha1((params.get("instructions") or "").encode("utf-8")).hexdigest()[:8]
+
+
+class Cassette:
+    """
+    Записанные ответы: {"key", "dialog", "text", "latency_ms", "instructions"} по строке на ответ.
+    Строки старого формата (без "dialog", ключ без промпта) только помечают диалог как записанный.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = Path(path) if path else None
+        self.entries = {}
+        self.dialogs = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # промахи, для которых есть ответ под другой промпт
+        self._lock = threading.Lock()
+        if self.path and self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        if "dialog" in entry:
+                            self.entries[entry["key"]] = entry
+                            self.dialogs.add(entry["dialog"])
+                        else:
+                            self.dialogs.add(entry["key"])
+
+    def lookup(self, params: dict):
+        entry = self.entries.get(request_key(params))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                if dialog_key(params) in self.dialogs:
+                    self.stale += 1
+                return None
+            self.hits += 1
+        return entry
+
+    def record(self, params: dict, text: str, latency_ms: float):
+        entry = {
+            "key": request_key(params),
+            "dialog": dialog_key(params),
+            "text": text,
+            "latency_ms": round(latency_ms, 1),
+            "instructions": instructions_hash(params),
+        }
+        with self._lock:
+            self.entries[entry["key"]] = entry
+            self.dialogs.add(entry["dialog"])
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class CassetteClient:
+    """
+    Подмена OpenAI-клиента: отвечает из кассеты.
+    record_client — настоящий (или локальный) клиент: промахи идут в него и дописываются в кассету.
+    Без него промах — CassetteMiss (или fallback_text, если задан явно).
+    """
+
+    def __init__(self, cassette: Cassette, fallback_text: str = None,
+                 record_client=None, simulate_latency: bool = False):
+        self.cassette = cassette
+        self.fallback_text = fallback_text
+        self.record_client = record_client
+        self.simulate_latency = simulate_latency
+        self.responses = SimpleNamespace(create=self._create_response)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+
+    def _complete(self, kind: str, params: dict) -> str:
+        entry = self.cassette.lookup(params)
+        if entry is not None:
+            if self.simulate_latency:
+                time.sleep(entry.get("latency_ms", 0) / 1000)
+            return entry["text"]
+
+        if self.record_client is None:
+            if self.fallback_text is None:
+                raise CassetteMiss(f"нет ответа под этот промпт ({instructions_hash(params)})")
+            return self.fallback_text
+
+        started = time.perf_counter()
+        if kind == "responses":
+            text = self.record_client.responses.create(**params).output_text
+        else:
+            text = self.record_client.chat.completions.create(**params).choices[0].message.content
+        self.cassette.record(params, text, (time.perf_counter() - started) * 1000)
+        return text
+
+    def _create_response(self, **params):
+        return SimpleNamespace(output_text=self._complete("responses", params))
+
+    def _create_chat(self, **params):
+        text = self._complete("chat", params)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+# ============================================================
+# HTTP-ЗАГЛУШКА (OpenAI-совместимая)
+# ============================================================
+
+def make_handler(cassette: Cassette, fallback_text: str, simulate_latency: bool):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/health"):
+                self._send(200, {"status": "ok", "entries": len(cassette.entries),
+                                 "hits": cassette.hits, "misses": cassette.misses})
+            else:
+                self._send(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+
+            entry = cassette.lookup(params)
+            if entry is not None and simulate_latency:
+                time.sleep(entry.get("latency_ms", 0) / 1000)
+            text = entry["text"] if entry is not None else fallback_text
+            now = int(time.time())
+
+            if self.path.endswith("/responses"):
+                self._send(200, {
+                    "id": f"resp_{uuid.uuid4().hex}",
+                    "object": "response",
+                    "created_at": now,
+                    "status": "completed",
+                    "model": params.get("model"),
+                    "output": [{
+                        "id": f"msg_{uuid.uuid4().hex}",
+                        "type": "message",
+                        "role": "assistant",
+                        "status": "completed",
+                        "content": [{"type": "output_text", "text": text, "annotations": []}],
+                    }],
+                    "parallel_tool_calls": False,
+                    "tool_choice": "auto",
+                    "tools": [],
+                    "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+                })
+            elif self.path.endswith("/chat/completions"):
+                self._send(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": now,
+                    "model": params.get("model"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                })
+            else:
+                self._send(404, {"error": {"message": f"unknown endpoint {self.path}"}})
+
+    return StubHandler
+
+
+def serve(cassette_path: str = None, host: str = "127.0.0.1", port: int = 8787,
+          fallback_text: str = DEFAULT_REPLY, simulate_latency: bool = False) -> ThreadingHTTPServer:
+    """Запускает заглушку в фоновом потоке, возвращает сервер (server.shutdown() для остановки)"""
+    cassette = Cassette(cassette_path)
+    server = ThreadingHTTPServer((host, port), make_handler(cassette, fallback_text, simulate_latency))
+    server.cassette = cassette
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI-совместимая заглушка на кассете')
+    parser.add_argument('--cassette', help='JSONL с записанными ответами')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--fallback', default=DEFAULT_REPLY, help='Ответ при промахе кассеты')
+    parser.add_argument('--simulate-latency', action='store_true', help='Отвечать с записанной задержкой')
+    args = parser.parse_args()
+
+    server = serve(args.cassette, args.host, args.port, args.fallback, args.simulate_latency)
+    print(f"🧪 LLM-заглушка: http://{args.host}:{args.port}/v1 (ответов в кассете: {len(server.cassette.entries)})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Поиск паттернов детекторов sofia_hybrid по реальным диалогам
+- Источники: экспорты диалогов (txt/rtf/Telegram JSON) и базы ботов (sofia_hybrid.db, sofia_conversations.db)
+- Считает n-граммы (1–3 слова) реплик клиента — потоково, память ограничена (lossy counting)
+- Сравнивает реплики перед событием (отказ от созвона, раздражение, уход, просьба прислать)
+  с остальными репликами клиента: lift и support
+- Пишет файл паттернов в формате sofia_hybrid.py — его можно читать глазами, править
+  и грузить как есть (hot_reload.load_hybrid_patterns, replay_prompt.py --patterns, PATTERNS_PATH у бота)
+
+Использование:
+    python mine_patterns.py ~/dialogs/ ~/Downloads/Telegram/result.json --db ../sofia_hybrid.db -o mined_patterns.py
+
+    # Строже: больше подтверждений, выше lift
+    python mine_patterns.py ~/dialogs/ --min-support 10 --min-lift 3
+
+    # Только диалоги баз, где встречается запрос (полнотекстовый индекс fts_search.py)
+    python mine_patterns.py --db ../sofia_conversations.db --find "рассрочка"
+"""
+
+import argparse
+import json
+import math
+import re
+import sqlite3
+import sys
+import time
+from datetime import date
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from dialog_processor import (
+    DEFAULT_MANAGER_NAMES, MARKER_SETS, Message, iter_telegram_chats, parse_dialog_file, score_dialog,
+)
+from fts_search import find_chat_ids
+from hot_reload import HYBRID_PATTERN_NAMES, load_hybrid_patterns
+from text_normalize import normalize_lines, normalize_pattern
+
+MAX_NGRAM = 3
+
+# Служебные слова (в нормализованном виде): n-грамма только из них — не паттерн
+STOP_WORDS = {
+    'и', 'в', 'во', 'на', 'с', 'со', 'а', 'но', 'по', 'к', 'у', 'о', 'от', 'до', 'за', 'из', 'же', 'ли',
+    'бы', 'то', 'это', 'что', 'как', 'так', 'вот', 'я', 'мы', 'вы', 'он', 'она', 'они', 'мне', 'вам',
+    'нам', 'меня', 'вас', 'там', 'тут', 'уже', 'еще', 'для', 'при', 'или', 'да',
+}
+
+# События в диалоге. Реплика клиента помечается, если стоит перед событием (см. label_turns)
+CALL_OFFER_RE = re.compile(r'созвон|звонок|звонк|позвон|видеопрезентац|презентаци|телемост|zoom|зум')
+APOLOGY_RE = re.compile(r'извин|прошу прощения|простите|не хотел[аи]? вас')
+SEND_RE = re.compile('|'.join(re.escape(m) for m in MARKER_SETS['send'] + ['отправляю', 'подборк', 'ссылк', 'http']))
+
+# Список для просмотра: в файл пишется закомментированным, детекторы его не грузят
+DROPOUT_REVIEW = 'DROPOUT_REVIEW'
+
+# Метка события → список паттернов, куда идут кандидаты
+LABEL_TARGETS = {
+    'refusal': 'CALL_REJECT_PATTERNS',  # ответ на предложение созвона в диалоге без созвона
+    'irritation': 'IRRITATED_PATTERNS',  # реплика, после которой менеджер извиняется
+    # Последняя реплика клиента перед уходом (диалог без созвона) — не раздражение: там и обычные
+    # "скиньте", а в IRRITATED_PATTERNS они увели бы просьбы прислать варианты в "без вопросов"
+    'dropout': DROPOUT_REVIEW,
+    'send': 'SEND_PATTERNS',             # реплика, после которой менеджер отправляет материалы
+}
+
+
+# ============================================================
+# ПОТОКОВЫЙ ПОДСЧЁТ
+# ============================================================
+
+class LossyCounter:
+    """
+    Lossy counting (Manku–Motwani): частоты с ошибкой не больше epsilon * N
+    при памяти O(1/epsilon * log(epsilon * N)). Редкое вычищается раз в 1/epsilon добавлений.
+    """
+
+    def __init__(self, epsilon: float):
+        self.width = max(1, math.ceil(1 / epsilon))
+        self.counts = {}  # ключ → [count, delta]
+        self.added = 0
+        self.bucket = 1
+
+    def add(self, key):
+        entry = self.counts.get(key)
+        if entry is None:
+            self.counts[key] = [1, self.bucket - 1]
+        else:
+            entry[0] += 1
+        self.added += 1
+        if self.added % self.width == 0:
+            self._prune()
+            self.bucket += 1
+
+    def _prune(self):
+        dead = [k for k, (count, delta) in self.counts.items() if count + delta <= self.bucket]
+        for k in dead:
+            del self.counts[k]
+
+    def count(self, key) -> int:
+        """Нижняя оценка"""
+        entry = self.counts.get(key)
+        return entry[0] if entry else 0
+
+    def upper(self, key) -> int:
+        """Верхняя оценка: для невыживших ключей — текущая граница вычистки"""
+        entry = self.counts.get(key)
+        return entry[0] + entry[1] if entry else self.bucket - 1
+
+
+def turn_ngrams(text: str) -> set:
+    """n-граммы нормализованной реплики (каждая один раз); через границу сообщений не идут"""
+    grams = set()
+    for line in text.split('\n'):
+        words = line.split()
+        for n in range(1, MAX_NGRAM + 1):
+            for i in range(len(words) - n + 1):
+                key = tuple(words[i:i + n])
+                if all(w in STOP_WORDS or w.isdigit() for w in key):
+                    continue
+                if n == 1 and len(key[0]) < 3:
+                    continue
+                grams.add(key)
+    return grams
+
+
+# ============================================================
+# ИСТОЧНИКИ
+# ============================================================
+
+def merge_turns(messages: List[Message]) -> List[Tuple[bool, str]]:
+    """
+    Подряд идущие сообщения одной стороны — одна реплика: (менеджер ли, нормализованный текст).
+    Нормализация та же, что у детекторов, — найденные фразы совпадут с тем, что они видят.
+    """
+    turns = []
+    for is_manager, group in groupby(messages, key=lambda m: m.is_manager):
+        text = normalize_lines([m.text for m in group if m.text])
+        if text.strip():
+            turns.append((is_manager, text))
+    return turns
+
+
+def iter_file_dialogs(paths: List[str], manager_names: List[str]) -> Iterator[List[Message]]:
+    for raw in paths:
+        path = Path(raw)
+        files = [path] if path.is_file() else sorted(
+            list(path.glob('*.txt')) + list(path.glob('*.rtf')) + list(path.glob('*.json')))
+        for f in files:
+            try:
+                if f.suffix.lower() == '.json':
+                    for chat in iter_telegram_chats(f, manager_names):
+                        yield chat['messages']
+                else:
+                    yield list(parse_dialog_file(f, manager_names))
+            except Exception as e:
+                print(f"   ⚠️ {f.name}: {e}")
+
+
+def iter_db_dialogs(db_path: str, chat_ids: set = None) -> Iterator[List[Message]]:
+    """Диалоги из базы бота по одному (курсор, без загрузки таблицы целиком); chat_ids — только эти чаты"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in c.fetchall()}
+    table = "conversations" if "conversations" in tables else "messages" if "messages" in tables else None
+    if table is None:
+        conn.close()
+        raise ValueError(f"В {db_path} нет таблиц conversations/messages")
+    c.execute(f"SELECT chat_id, role, content FROM {table} ORDER BY chat_id, id")
+    for chat_id, rows in groupby(c, key=lambda row: row[0]):
+        if chat_ids is not None and chat_id not in chat_ids:
+            continue
+        messages = [Message('', '', role, content, role != 'user') for _, role, content in rows
+                    if content and content != '/start']
+        if messages:
+            yield messages
+    conn.close()
+
+
+# ============================================================
+# РАЗМЕТКА СОБЫТИЙ
+# ============================================================
+
+def label_turns(turns: List[Tuple[bool, str]], result: str, window: int = 1) -> Dict[int, set]:
+    """
+    Номер реплики клиента → метки событий.
+    window — сколько реплик клиента перед событием помечать (включая ближайшую).
+    """
+    labels = {}
+    client_idx = [i for i, (is_manager, _) in enumerate(turns) if not is_manager]
+
+    def mark(before: int, label: str):
+        """Помечаем до window реплик клиента, стоящих до позиции before"""
+        for i in [i for i in client_idx if i < before][-window:]:
+            labels.setdefault(i, set()).add(label)
+
+    no_call = result != 'созвон'
+    for i, (is_manager, text) in enumerate(turns):
+        if not is_manager:
+            continue
+        if APOLOGY_RE.search(text):
+            mark(i, 'irritation')
+        if SEND_RE.search(text):
+            mark(i, 'send')
+        if no_call and CALL_OFFER_RE.search(text) and i + 1 < len(turns):
+            # Ответ на предложение созвона: ближайшая реплика клиента после него
+            mark(i + 2, 'refusal')
+
+    # Клиент ушёл: диалог без созвона закончился неотвеченной репликой менеджера
+    if no_call and client_idx and turns[-1][0]:
+        mark(len(turns), 'dropout')
+    return labels
+
+
+# ============================================================
+# МАЙНИНГ
+# ============================================================
+
+class PatternMiner:
+    def __init__(self, existing: Dict[str, List[str]], epsilon: float = 1e-4, window: int = 1):
+        self.existing = existing
+        self.window = window
+        self.baseline = LossyCounter(epsilon)
+        self.by_label = {label: LossyCounter(epsilon) for label in LABEL_TARGETS}
+        self.turns = 0
+        self.label_turns = {label: 0 for label in LABEL_TARGETS}
+        self.dialogs = 0
+        # Текущие паттерны считаем точно — их немного
+        self.existing_hits = {p: [0, {label: 0 for label in LABEL_TARGETS}]
+                              for patterns in existing.values() for p in patterns}
+        self.normalized = {p: normalize_pattern(p) for p in self.existing_hits}
+
+    def add_dialog(self, messages: List[Message]):
+        turns = merge_turns(messages)
+        if not any(not is_manager for is_manager, _ in turns):
+            return
+        self.dialogs += 1
+        labels = label_turns(turns, score_dialog(messages).result, self.window)
+        for i, (is_manager, text) in enumerate(turns):
+            if is_manager:
+                continue
+            turn_labels = labels.get(i, ())
+            self.turns += 1
+            for label in turn_labels:
+                self.label_turns[label] += 1
+            for key in turn_ngrams(text):
+                self.baseline.add(key)
+                for label in turn_labels:
+                    self.by_label[label].add(key)
+            for p, hits in self.existing_hits.items():
+                if self.normalized[p] and self.normalized[p] in text:
+                    hits[0] += 1
+                    for label in turn_labels:
+                        hits[1][label] += 1
+
+    def lift(self, label_count: int, label: str, baseline_count: int) -> float:
+        if not label_count or not self.label_turns[label]:
+            return 0.0
+        return (label_count / self.label_turns[label]) / (max(baseline_count, 1) / self.turns)
+
+    def pmi(self, key: tuple) -> float:
+        """Устойчивость словосочетания: log2 P(фраза) / ∏ P(слово). Для одного слова — 0."""
+        if len(key) == 1:
+            return 0.0
+        joint = max(self.baseline.count(key), 1) / self.turns
+        independent = 1.0
+        for w in key:
+            independent *= max(self.baseline.upper((w,)), 1) / self.turns
+        return math.log2(joint / independent)
+
+    def candidates(self, label: str, min_support: int, min_lift: float, min_pmi: float) -> List[Dict]:
+        """Кандидаты по событию: lift по верхней оценке фона (консервативно), сортировка по lift и support"""
+        counter = self.by_label[label]
+        target = [self.normalized[p] for p in self.existing.get(LABEL_TARGETS[label], []) if self.normalized[p]]
+        found = []
+        for key in counter.counts:
+            support = counter.count(key)
+            if support < min_support:
+                continue
+            lift = self.lift(support, label, self.baseline.upper(key))
+            if lift < min_lift:
+                continue
+            pmi = self.pmi(key)
+            if len(key) > 1 and pmi < min_pmi:
+                continue
+            form = ' '.join(key)
+            found.append({
+                'pattern': form,
+                'support': support,
+                'baseline': self.baseline.upper(key),
+                'lift': lift,
+                'pmi': pmi,
+                'label': label,
+                'covered': any(p in f" {form} " for p in target),
+            })
+        # При равных lift и support длиннее — раньше: словосочетание точнее обрывка
+        found.sort(key=lambda c: (-c['lift'], -c['support'], -len(c['pattern'])))
+        return found
+
+    def existing_stats(self, name: str, pattern: str) -> Dict:
+        total, per_label = self.existing_hits[pattern]
+        labels = [label for label, target in LABEL_TARGETS.items() if target == name]
+        support = sum(per_label[label] for label in labels)
+        lift = max((self.lift(per_label[label], label, total) for label in labels), default=None)
+        return {'total': total, 'support': support, 'lift': lift, 'has_label': bool(labels)}
+
+
+# ============================================================
+# ФАЙЛ ПАТТЕРНОВ
+# ============================================================
+
+def render_patterns(miner: PatternMiner, selected: Dict[str, List[Dict]], sources: List[str]) -> str:
+    lines = [
+        "# mined_patterns.py — паттерны детекторов sofia_hybrid, собранные scripts/mine_patterns.py",
+        f"# {date.today().isoformat()}: диалогов {miner.dialogs}, реплик клиента {miner.turns}; "
+        + ", ".join(f"{label} {n}" for label, n in miner.label_turns.items()),
+        f"# Источники: {', '.join(sources)}",
+        "#",
+        "# Формат как в sofia_hybrid.py: файл можно грузить как есть",
+        "#   python scripts/replay_prompt.py ... --patterns mined_patterns.py",
+        "#   PATTERNS_PATH=mined_patterns.py (бот перечитает на лету)",
+        "# Перед выкладкой просмотрите: лишнее удалить, «# new» — кандидаты из данных.",
+        "# hits — реплик клиента с фразой, event — из них перед событием, lift — во сколько раз чаще перед событием",
+        "",
+    ]
+    for name in HYBRID_PATTERN_NAMES:
+        lines.append(f"{name} = [")
+        for p in miner.existing[name]:
+            stats = miner.existing_stats(name, p)
+            note = f"hits {stats['total']}"
+            if stats['has_label']:
+                note += f", event {stats['support']}, lift {stats['lift']:.1f}"
+            if not stats['total']:
+                note += " — не встречается"
+            lines.append(f"    {json.dumps(p, ensure_ascii=False)},  # {note}")
+        new = selected.get(name, [])
+        if new:
+            lines.append("    # --- кандидаты из данных ---")
+        for c in new:
+            lines.append(f"    {json.dumps(c['pattern'], ensure_ascii=False)},  # new {c['label']}: event {c['support']}, hits {c['baseline']}, "
+                         f"lift {c['lift']:.1f}, pmi {c['pmi']:.1f}")
+        lines.append("]")
+        lines.append("")
+    review = selected.get(DROPOUT_REVIEW, [])
+    if review:
+        lines.append("# --- только для просмотра (детекторы не грузят): последние реплики клиентов перед уходом ---")
+        lines.append("# Подходящее — вручную в нужный список выше")
+        for c in review:
+            lines.append(f"# {json.dumps(c['pattern'], ensure_ascii=False)}  — event {c['support']}, hits {c['baseline']}, "
+                         f"lift {c['lift']:.1f}, pmi {c['pmi']:.1f}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def select_candidates(miner: PatternMiner, args) -> Dict[str, List[Dict]]:
+    """
+    Лучшие непокрытые кандидаты по каждому списку. Лишние:
+    - фраза, внутри которой уже есть выбранная (с lift не ниже) — детектор и так её поймает;
+    - обрывок выбранной фразы, который почти не встречается отдельно от неё;
+    - соседний кусок той же длинной фразы (общие слова, те же счётчики).
+    """
+    selected = {}
+    for label, name in LABEL_TARGETS.items():
+        chosen = selected.setdefault(name, [])
+        added = 0
+        for c in miner.candidates(label, args.min_support, args.min_lift, args.min_pmi):
+            if added >= args.top:
+                break
+            if c['covered'] or any(
+                other['pattern'] in c['pattern']
+                or (c['pattern'] in other['pattern'] and c['baseline'] <= other['baseline'] * 1.1)
+                or ((c['support'], c['baseline']) == (other['support'], other['baseline'])
+                    and set(c['pattern'].split()) & set(other['pattern'].split()))
+                for other in chosen
+            ):
+                continue
+            chosen.append(c)
+            added += 1
+    return selected
+
+
+def print_summary(miner: PatternMiner, selected: Dict[str, List[Dict]]):
+    print(f"\n📊 Диалогов: {miner.dialogs} | Реплик клиента: {miner.turns}")
+    for label, n in miner.label_turns.items():
+        print(f"   {label:12} {n:6} реплик перед событием → {LABEL_TARGETS[label]}")
+    print(f"   В памяти n-грамм: фон {len(miner.baseline.counts)}, "
+          f"события {sum(len(c.counts) for c in miner.by_label.values())}")
+
+    for name, candidates in selected.items():
+        if not candidates:
+            continue
+        review = " (только просмотр, в детекторы не идёт)" if name == DROPOUT_REVIEW else ""
+        print(f"\n🔎 {name}: {len(candidates)} кандидатов{review}")
+        for c in candidates:
+            print(f"   {c['pattern'][:40]:40} lift {c['lift']:5.1f} | event {c['support']:4} | hits {c['baseline']:5}")
+
+    unused = [p for patterns in miner.existing.values() for p in patterns if not miner.existing_hits[p][0]]
+    if unused:
+        print(f"\n💤 Текущие паттерны, которых нет в данных: {len(unused)}")
+        print("   " + ", ".join(unused))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Поиск паттернов детекторов по диалогам')
+    parser.add_argument('inputs', nargs='*', help='Папки/файлы с диалогами (txt, rtf, Telegram JSON)')
+    parser.add_argument('--db', nargs='+', default=[], help='Базы ботов (sofia_hybrid.db, sofia_conversations.db)')
+    parser.add_argument('--managers', nargs='+', default=DEFAULT_MANAGER_NAMES, help='Имена менеджеров')
+    parser.add_argument('--patterns', default=str(ROOT_DIR / 'sofia_hybrid.py'),
+                        help='Откуда брать текущие паттерны (sofia_hybrid.py или прошлый mined_patterns.py)')
+    parser.add_argument('--output', '-o', default='mined_patterns.py', help='Файл паттернов')
+    parser.add_argument('--window', type=int, default=1, help='Сколько реплик клиента перед событием учитывать')
+    parser.add_argument('--min-support', type=int, default=5, help='Минимум реплик перед событием с фразой')
+    parser.add_argument('--min-lift', type=float, default=2.0, help='Минимальный lift')
+    parser.add_argument('--min-pmi', type=float, default=1.0, help='Минимальный PMI для словосочетаний')
+    parser.add_argument('--top', type=int, default=15, help='Кандидатов на событие')
+    parser.add_argument('--find', help='Запрос FTS: из баз только диалоги, где он встречается (в репликах или комментариях)')
+    parser.add_argument('--epsilon', type=float, default=1e-4,
+                        help='Точность подсчёта (ошибка ≤ epsilon × число n-грамм); меньше — больше памяти')
+    args = parser.parse_args()
+
+    if not args.inputs and not args.db:
+        parser.error('нужны папки с диалогами и/или --db')
+
+    existing = load_hybrid_patterns(Path(args.patterns).read_text(encoding='utf-8'))
+    miner = PatternMiner(existing, args.epsilon, args.window)
+
+    started = time.time()
+    sources = [('файлы', iter_file_dialogs(args.inputs, args.managers))] if args.inputs else []
+    for db in args.db:
+        chat_ids = find_chat_ids(db, args.find) if args.find else None
+        if chat_ids is not None:
+            print(f"🔎 {db}: «{args.find}» — диалогов {len(chat_ids)}")
+        sources.append((db, iter_db_dialogs(db, chat_ids)))
+    for label, dialogs in sources:
+        print(f"📂 {label}...")
+        for read, messages in enumerate(dialogs, 1):
+            miner.add_dialog(messages)
+            if read % 1000 == 0:
+                print(f"   Прочитано: {read}, в майнинге: {miner.dialogs}")
+    print(f"   ⏱️ {time.time() - started:.1f} с")
+
+    if not miner.turns:
+        print("❌ Нет реплик клиента")
+        return
+
+    selected = select_candidates(miner, args)
+    print_summary(miner, selected)
+
+    source = render_patterns(miner, selected, [str(p) for p in args.inputs] + args.db)
+    load_hybrid_patterns(source)  # файл должен грузиться детекторами как есть
+    Path(args.output).write_text(source, encoding='utf-8')
+    print(f"\n💾 Паттерны: {args.output} (проверка: python scripts/replay_prompt.py ... --patterns {args.output})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Офлайн-регрессия промпта: прогон сохранённых диалогов через process_message
+Использование:
+    # Кассета (полностью офлайн)
+    python replay_prompt.py --db sofia_hybrid.db --prompt candidate_prompt.py --cassette replay.jsonl -n 50
+
+    # Локальный OpenAI-совместимый сервер (llm_stub.py, Ollama, vLLM...)
+    python replay_prompt.py --db sofia_hybrid.db --prompt candidate_prompt.py --base-url http://127.0.0.1:8787/v1
+
+    # Записать кассету с настоящей модели (онлайн, один раз)
+    python replay_prompt.py --db sofia_hybrid.db --prompt candidate_prompt.py --cassette replay.jsonl --record
+
+Отчёт: расхождения решений decide_action, нарушения правил вопросов, задержки по ходам.
+Ход без ответа в кассете под этот промпт — "неизвестно": в нарушения не идёт, но гейт не проходит
+(--max-unknown), пока ответы не записаны (--record).
+Код возврата 1 — кандидат не прошёл пороги (для гейта перед деплоем промпта).
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from llm_stub import Cassette, CassetteClient, CassetteMiss
+
+# Вопрос — только последним: после последнего "?" допустимы лишь пробелы, эмодзи, скобки
+QUESTION_LAST_RE = re.compile(r'\?[^\w?]*$')
+
+
+# ============================================================
+# ДАННЫЕ
+# ============================================================
+
+def load_conversations(db_path: str, limit: int) -> List[Dict]:
+    """
+    Последние N диалогов из базы бота.
+    sofia_hybrid.db — таблица conversations (+ debug_logs с решениями),
+    sofia_conversations.db — таблица messages.
+    """
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in c.fetchall()}
+
+    if "conversations" in tables:
+        table, name_sql = "conversations", "SELECT chat_id, client_name FROM chat_meta"
+    elif "messages" in tables:
+        table, name_sql = "messages", "SELECT chat_id, MAX(user_name) FROM messages WHERE role = 'user' GROUP BY chat_id"
+    else:
+        conn.close()
+        raise ValueError(f"В {db_path} нет таблиц conversations/messages")
+
+    c.execute(f"SELECT chat_id FROM {table} WHERE role = 'user' GROUP BY chat_id ORDER BY MAX(id) DESC LIMIT ?", (limit,))
+    chat_ids = [row[0] for row in c.fetchall()]
+
+    names = {}
+    try:
+        c.execute(name_sql)
+        names = {row[0]: row[1] for row in c.fetchall()}
+    except sqlite3.Error:
+        pass
+
+    recorded = {}
+    if "debug_logs" in tables:
+        c.execute("SELECT chat_id, user_message, action, reason FROM debug_logs ORDER BY id")
+        for chat_id, user_message, action, reason in c.fetchall():
+            recorded.setdefault(chat_id, []).append((user_message, action, reason))
+
+    conversations = []
+    for chat_id in chat_ids:
+        c.execute(f"SELECT role, content FROM {table} WHERE chat_id = ? ORDER BY id", (chat_id,))
+        messages = [{"role": role, "content": content} for role, content in c.fetchall()
+                    if content and content != "/start"]
+        conversations.append({
+            "chat_id": chat_id,
+            "client_name": names.get(chat_id) or "Клиент",
+            "messages": messages,
+            "recorded": recorded.get(chat_id, []),
+        })
+    conn.close()
+    return conversations
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+# ============================================================
+# ПРОГОН
+# ============================================================
+
+def baseline_decisions(hybrid, conversations: List[Dict]) -> Dict:
+    """Решения текущего кода и паттернов (без LLM) — база для сравнения"""
+    decisions = {}
+    for conv in conversations:
+        history = []
+        for i, msg in enumerate(conv["messages"]):
+            if msg["role"] == "user":
+                slots = hybrid.current_slots(history, msg["content"])
+                action = hybrid.decide_action(hybrid.analyze_history(history), msg["content"], slots=slots)
+                decisions[(conv["chat_id"], i)] = (action["action"], action["reason"])
+            history.append(msg)
+    return decisions
+
+
+def replay_conversation(hybrid, conv: Dict) -> List[Dict]:
+    """Диалог ход за ходом: история — сохранённые реплики, ответ — от кандидата"""
+    turns = []
+    history = []
+    recorded = list(conv["recorded"])
+
+    for i, msg in enumerate(conv["messages"]):
+        if msg["role"] != "user":
+            history.append(msg)
+            continue
+
+        started = time.perf_counter()
+        slots = hybrid.current_slots(history, msg["content"])
+        action = hybrid.decide_action(hybrid.analyze_history(history), msg["content"], slots=slots)
+        code_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        error = None
+        unknown = False
+        try:
+            response, debug = hybrid.process_message(history, msg["content"], conv["client_name"])
+        except Exception as e:
+            response, debug = "", {"action": action["action"], "reason": action["reason"],
+                                   "allow_questions": action["allow_questions"]}
+            # Промах кассеты — ответа кандидата нет: оценить нечего, но это и не ошибка кандидата
+            unknown = isinstance(e, CassetteMiss)
+            if not unknown:
+                error = f"{type(e).__name__}: {e}"
+        turn_ms = (time.perf_counter() - started) * 1000
+
+        # Записанное решение бота для этой реплики (debug_logs), по порядку
+        recorded_decision = None
+        for j, (user_message, rec_action, rec_reason) in enumerate(recorded):
+            if user_message == msg["content"]:
+                recorded_decision = (rec_action, rec_reason)
+                del recorded[:j + 1]
+                break
+
+        violations = []
+        if error:
+            violations.append("error")
+        if debug.get("question_stripped"):
+            violations.append("question_when_forbidden")
+        if response.count("?") > 1:
+            violations.append("multiple_questions")
+        if "?" in response and not QUESTION_LAST_RE.search(response):
+            violations.append("question_not_last")
+
+        turns.append({
+            "chat_id": conv["chat_id"],
+            "index": i,
+            "user_message": msg["content"],
+            "action": debug.get("action"),
+            "reason": debug.get("reason"),
+            "allow_questions": debug.get("allow_questions"),
+            "recorded": recorded_decision,
+            "response": response,
+            "unknown": unknown,
+            "violations": violations,
+            "error": error,
+            "code_ms": round(code_ms, 3),
+            "turn_ms": round(turn_ms, 1),
+        })
+        history.append(msg)
+    return turns
+
+
+def run_replay(args) -> Dict:
+    os.environ.setdefault("OPENAI_API_KEY", "offline-replay")
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    if args.model_mode:
+        os.environ["MODEL_MODE"] = args.model_mode
+
+    import sofia_hybrid as hybrid
+    from hot_reload import load_hybrid_patterns, load_prompt_module, source_version
+
+    conversations = load_conversations(args.db, args.n)
+    baseline = baseline_decisions(hybrid, conversations)
+
+    prompt_source = Path(args.prompt).read_text(encoding="utf-8")
+    hybrid.set_prompt(load_prompt_module(prompt_source), source_version(prompt_source))
+    if args.patterns:
+        patterns_source = Path(args.patterns).read_text(encoding="utf-8")
+        hybrid.set_patterns(load_hybrid_patterns(patterns_source), source_version(patterns_source))
+    if args.rules:
+        from decision_rules import load_rules_file
+        hybrid.set_rules(load_rules_file(args.rules))
+
+    cassette = None
+    if args.cassette or not args.base_url:
+        cassette = Cassette(args.cassette)
+        record_client = hybrid.client if args.record else None
+        hybrid.client = CassetteClient(cassette, record_client=record_client,
+                                       simulate_latency=args.simulate_latency)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        per_conv = list(pool.map(lambda conv: replay_conversation(hybrid, conv), conversations))
+    wall_s = time.perf_counter() - started
+    turns = [t for conv_turns in per_conv for t in conv_turns]
+
+    for t in turns:
+        t["baseline"] = baseline.get((t["chat_id"], t["index"]))
+
+    return {
+        "prompt_version": hybrid.PROMPT_VERSION,
+        "patterns_version": hybrid.PATTERNS_VERSION,
+        "rules_version": hybrid._RULES.version,
+        "conversations": len(conversations),
+        "turns": turns,
+        "wall_s": round(wall_s, 2),
+        "cassette": {
+            "hits": cassette.hits, "misses": cassette.misses, "stale": cassette.stale,
+        } if cassette else None,
+    }
+
+
+# ============================================================
+# ОТЧЁТ
+# ============================================================
+
+def summarize(result: Dict) -> Dict:
+    turns = result["turns"]
+    decision_diffs = [t for t in turns if t["baseline"] and t["baseline"] != (t["action"], t["reason"])]
+    recorded_diffs = [t for t in turns if t["recorded"] and tuple(t["recorded"]) != (t["action"], t["reason"])]
+    violations = {}
+    for t in turns:
+        for v in t["violations"]:
+            violations[v] = violations.get(v, 0) + 1
+    violated_turns = sum(1 for t in turns if t["violations"])
+    # Доля нарушений — среди ходов, где ответ кандидата есть
+    known = sum(1 for t in turns if not t["unknown"])
+    turn_ms = [t["turn_ms"] for t in turns]
+    code_ms = [t["code_ms"] for t in turns]
+
+    return {
+        "turns": len(turns),
+        "decision_diffs": len(decision_diffs),
+        "recorded_diffs": len(recorded_diffs),
+        "unknown": len(turns) - known,
+        "violations": violations,
+        "violation_rate": violated_turns / known if known else 0,
+        "latency_ms": {
+            "turn_p50": percentile(turn_ms, 0.5), "turn_p95": percentile(turn_ms, 0.95),
+            "turn_max": max(turn_ms) if turn_ms else 0,
+            "code_p50": percentile(code_ms, 0.5), "code_p95": percentile(code_ms, 0.95),
+        },
+        "_decision_diffs": decision_diffs,
+        "_recorded_diffs": recorded_diffs,
+    }
+
+
+def print_report(result: Dict, summary: Dict):
+    print("\n" + "=" * 70)
+    print("🧪 REPLAY ПРОМПТА")
+    print("=" * 70)
+    print(f"📝 Промпт: {result['prompt_version']} | Паттерны: {result['patterns_version'] or 'текущие'}")
+    print(f"💬 Диалогов: {result['conversations']} | Ходов: {summary['turns']} | Время: {result['wall_s']} с")
+    if result["cassette"]:
+        cas = result["cassette"]
+        print(f"📼 Кассета: {cas['hits']} попаданий, {cas['misses']} промахов"
+              f" (из них записано под другой промпт: {cas['stale']})")
+
+    lat = summary["latency_ms"]
+    print(f"\n⏱️ Ход: p50 {lat['turn_p50']:.1f} мс, p95 {lat['turn_p95']:.1f} мс, max {lat['turn_max']:.1f} мс")
+    print(f"   Код (analyze+decide): p50 {lat['code_p50']:.3f} мс, p95 {lat['code_p95']:.3f} мс")
+
+    print(f"\n🔀 Решения изменились (против текущих паттернов): {summary['decision_diffs']}")
+    for t in summary["_decision_diffs"][:20]:
+        print(f"   [{t['chat_id']}] {t['user_message'][:40]!r}: {t['baseline'][0]} ({t['baseline'][1]}) → {t['action']} ({t['reason']})")
+    print(f"🔀 Расхождения с записанными решениями (debug_logs): {summary['recorded_diffs']}")
+    for t in summary["_recorded_diffs"][:20]:
+        print(f"   [{t['chat_id']}] {t['user_message'][:40]!r}: {t['recorded'][0]} ({t['recorded'][1]}) → {t['action']} ({t['reason']})")
+
+    print(f"\n❓ Нарушения правил вопросов: {summary['violation_rate'] * 100:.1f}% ходов с ответом")
+    if summary["unknown"]:
+        print(f"❔ Неизвестно (промах кассеты): {summary['unknown']} из {summary['turns']} ходов")
+    for name, count in sorted(summary["violations"].items(), key=lambda x: -x[1]):
+        print(f"   {name:28} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-регрессия промпта на сохранённых диалогах')
+    parser.add_argument('--db', required=True, help='База бота (sofia_hybrid.db или sofia_conversations.db)')
+    parser.add_argument('--prompt', required=True, help='Кандидат sofia_prompt.py')
+    parser.add_argument('--patterns', help='Кандидат sofia_hybrid.py (берутся только списки паттернов)')
+    parser.add_argument('--rules', help='Кандидат decision_rules.json (правила decide_action)')
+    parser.add_argument('-n', type=int, default=50, help='Сколько последних диалогов прогнать')
+    parser.add_argument('--workers', type=int, default=8, help='Диалогов параллельно')
+    parser.add_argument('--cassette', help='JSONL с записанными ответами модели')
+    parser.add_argument('--record', action='store_true', help='Промахи кассеты отправлять в модель и записывать')
+    parser.add_argument('--base-url', help='OpenAI-совместимый локальный сервер вместо кассеты')
+    parser.add_argument('--simulate-latency', action='store_true', help='Кассета отвечает с записанной задержкой')
+    parser.add_argument('--model-mode', help='MODEL_MODE для sofia_hybrid (по умолчанию из окружения)')
+    parser.add_argument('--report', help='Сохранить отчёт в JSON')
+    parser.add_argument('--max-violation-rate', type=float, default=0.1, help='Порог доли ходов с нарушениями')
+    parser.add_argument('--max-decision-diffs', type=int, default=0, help='Порог изменённых решений')
+    parser.add_argument('--max-unknown', type=int, default=0,
+                        help='Сколько ходов без ответа в кассете допустимо (промах — ответ кандидата неизвестен)')
+    args = parser.parse_args()
+
+    result = run_replay(args)
+    summary = summarize(result)
+    print_report(result, summary)
+
+    if args.report:
+        report = {k: v for k, v in summary.items() if not k.startswith("_")}
+        report.update({k: v for k, v in result.items() if k != "turns"})
+        report["turns"] = result["turns"]
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n📋 Отчёт сохранён в {args.report}")
+
+    failed = (summary["violation_rate"] > args.max_violation_rate
+              or summary["decision_diffs"] > args.max_decision_diffs
+              or summary["violations"].get("error", 0) > 0)
+    missed = summary["unknown"] > args.max_unknown
+    if missed:
+        print(f"\n❌ Промах кассеты: {summary['unknown']} ходов без ответа под этот промпт — "
+              f"кандидат не проверен (--record или --base-url)")
+    print(f"\n{'❌ КАНДИДАТ НЕ ПРОШЁЛ' if failed or missed else '✅ КАНДИДАТ ПРОШЁЛ'}")
+    sys.exit(1 if failed or missed else 0)
+
+
+if __name__ == '__main__':
+    main()
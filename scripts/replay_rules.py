@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Массовый прогон правил decide_action по сохранённым диалогам — без LLM
+- Признаки каждого хода клиента считаются один раз, на них проверяются все файлы правил
+- Отчёт по каждому файлу: сколько раз сработало каждое правило, расхождения с первым файлом
+  (текущими правилами) и с решениями, записанными ботом в debug_logs
+- Для настройки порогов и A/B правил до выкладки: бот подхватит файл на лету (DECISION_RULES_PATH)
+
+Использование:
+    python replay_rules.py --db ../sofia_hybrid.db --rules ../decision_rules.json candidate_rules.json
+    python replay_rules.py --db ../sofia_conversations.db --rules ../decision_rules.json candidate.json -n 500 --diffs 20
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from decision_rules import load_rules_file
+from replay_prompt import load_conversations
+
+
+def collect_turns(hybrid, conversations):
+    """(диалог, номер сообщения, текст, признаки, записанное решение) на каждый ход клиента"""
+    turns = []
+    for conv in conversations:
+        history = []
+        slots = None
+        recorded = list(conv["recorded"])
+        for i, msg in enumerate(conv["messages"]):
+            if msg["role"] == "user":
+                slots = hybrid.current_slots(history, msg["content"], slots)  # по одному сообщению, как в боте
+                features = hybrid.decision_features(hybrid.analyze_history(history), msg["content"], slots)
+                decision = None
+                for j, (user_message, action, reason) in enumerate(recorded):
+                    if user_message == msg["content"]:
+                        decision = (action, reason)
+                        del recorded[:j + 1]
+                        break
+                turns.append((conv["chat_id"], i, msg["content"], features, decision))
+            history.append(msg)
+    return turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон правил decide_action по сохранённым диалогам')
+    parser.add_argument('--db', required=True, help='База бота (sofia_hybrid.db или sofia_conversations.db)')
+    parser.add_argument('--rules', nargs='+', default=[str(ROOT_DIR / 'decision_rules.json')],
+                        help='Файлы правил; первый — база для сравнения')
+    parser.add_argument('-n', type=int, default=1000, help='Сколько последних диалогов')
+    parser.add_argument('--patterns', help='Файл паттернов для детекторов (как PATTERNS_PATH)')
+    parser.add_argument('--diffs', type=int, default=10, help='Примеров расхождений на файл')
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "offline-replay")
+    import sofia_hybrid as hybrid
+    from hot_reload import load_hybrid_patterns, source_version
+
+    if args.patterns:
+        source = Path(args.patterns).read_text(encoding="utf-8")
+        hybrid.set_patterns(load_hybrid_patterns(source), source_version(source))
+
+    rule_sets = [(path, load_rules_file(path)) for path in args.rules]
+    conversations = load_conversations(args.db, args.n)
+
+    started = time.perf_counter()
+    turns = collect_turns(hybrid, conversations)
+    features_s = time.perf_counter() - started
+    if not turns:
+        print("❌ Нет ходов клиента")
+        return
+    print(f"📂 Диалогов: {len(conversations)}, ходов клиента: {len(turns)}, "
+          f"признаки: {features_s / len(turns) * 1e6:.0f} мкс на ход")
+
+    decisions = []
+    for path, rules in rule_sets:
+        started = time.perf_counter()
+        indices = [rules.first_rule(features) for _, _, _, features, _ in turns]
+        eval_us = (time.perf_counter() - started) / len(turns) * 1e6
+        decisions.append([(rules.rules[i]["action"], rules.rules[i]["name"]) for i in indices])
+
+        print(f"\n{'=' * 60}")
+        print(f"📜 {path} ({rules.version}) — {eval_us:.2f} мкс на ход")
+        print(f"{'=' * 60}")
+        fired = Counter(name for _, name in decisions[-1])
+        for rule in rules.rules:
+            count = fired.get(rule["name"], 0)
+            print(f"   {rule['name']:<26} {count:>6} ({count / len(turns) * 100:5.1f}%)  → {rule['action']}")
+
+        recorded = [(d, t[4]) for d, t in zip(decisions[-1], turns) if t[4]]
+        if recorded:
+            same = sum(d[1] == r[1] for d, r in recorded)
+            print(f"   Совпадает с debug_logs: {same}/{len(recorded)}")
+
+        if len(decisions) > 1:
+            changed = [(t, base, d) for t, base, d in zip(turns, decisions[0], decisions[-1]) if base != d]
+            print(f"   Расхождений с {args.rules[0]}: {len(changed)} ({len(changed) / len(turns) * 100:.1f}%)")
+            for pair, count in Counter((base[1], d[1]) for _, base, d in changed).most_common():
+                print(f"      {pair[0]} → {pair[1]}: {count}")
+            for (chat_id, i, text, _, _), base, d in changed[:args.diffs]:
+                print(f"      [{chat_id}#{i}] {text[:60]!r}: {base[1]} → {d[1]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Обучение классификатора намерений клиента (intent_model.py) — офлайн
+- Разметка: patterns_labelled.jsonl (ручная, главный вес), оценки feedback_v2 с комментарием
+  ("клиент раздражён", "просил скинуть"...), реплики клиентов из баз и архивов диалогов —
+  слабые метки по текущим спискам паттернов (и, с --events, по событиям диалога как в mine_patterns)
+- Логистическая регрессия на каждое намерение (AdaGrad), пороги подбираются по F1 на отложенной части
+- Отчёт: точность/полнота модели и списков паттернов на отложенных размеченных вручную, размер файла, мкс на сообщение
+
+Использование:
+    python train_intents.py --db ../sofia_hybrid.db ../sofia_conversations.db ~/dialogs/ -o ../intent_model.bin
+    # Включить в боте: INTENT_MODE=both (модель ИЛИ паттерны) или INTENT_MODE=model
+"""
+
+import argparse
+import json
+import math
+import random
+import sqlite3
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from dialog_processor import DEFAULT_MANAGER_NAMES, score_dialog
+from hot_reload import compile_patterns, load_hybrid_patterns
+from intent_model import HASH_BITS, INTENT_PATTERNS, INTENTS, IntentModel, feature_buckets, sigmoid
+from mine_patterns import iter_db_dialogs, iter_file_dialogs, label_turns, merge_turns
+from text_normalize import normalize_text
+
+# Вес примера в обучении по источнику разметки
+GOLD_WEIGHT = 5.0
+FEEDBACK_WEIGHT = 3.0
+WEAK_WEIGHT = 1.0
+
+# Событие диалога (mine_patterns.label_turns) → намерение; уход клиента (dropout) — не намерение
+EVENT_INTENTS = {'refusal': 'call_reject', 'irritation': 'irritated', 'send': 'send'}
+
+# Комментарий эксперта к оценке → намерение последней реплики клиента в оценённом отрезке
+COMMENT_INTENTS = {
+    'irritated': ('раздраж', 'злит', 'бесит', 'недоволен', 'недовольн', 'агрес', 'достали'),
+    'send': ('просил скин', 'просила скин', 'просил присл', 'просила присл', 'просит скин', 'просит присл'),
+    'call_reject': ('отказался от созвон', 'отказалась от созвон', 'не хочет созвон', 'не хочет звон',
+                    'отказ от созвон', 'отказ от звонк'),
+    'call_agree': ('согласился на созвон', 'согласилась на созвон', 'согласен на созвон', 'согласие на созвон'),
+    'neutral': ('без разницы', 'всё равно', 'все равно', 'нейтральн'),
+}
+
+WEIGHT_PRUNE = 1e-3
+THRESHOLD_GRID = [i / 20 for i in range(4, 19)]  # 0.20 … 0.90
+
+
+# ============================================================
+# ДАННЫЕ
+# ============================================================
+
+class Examples:
+    """Нормализованный текст → пример; одинаковые реплики склеиваются, ручная разметка главнее"""
+
+    def __init__(self):
+        self.items: Dict[str, Dict] = {}
+        self.by_source: Dict[str, int] = {}
+
+    def add(self, text: str, labels: set, weight: float, source: str):
+        key = normalize_text(text[:2000])
+        if not key.strip():
+            return
+        self.by_source[source] = self.by_source.get(source, 0) + 1
+        item = self.items.get(key)
+        if item is None:
+            self.items[key] = {'text': text, 'labels': set(labels), 'weight': weight, 'source': source}
+        elif source == 'gold':
+            item.update(labels=set(labels), weight=weight, source=source)
+        elif item['source'] != 'gold':
+            item['labels'] |= labels
+            item['weight'] = max(item['weight'], weight)
+
+    def split(self, holdout: float):
+        """Детерминированно по хэшу текста — отложенная часть не меняется между запусками"""
+        train, test = [], []
+        for key, item in self.items.items():
+            bucket = zlib.crc32(key.encode('utf-8')) % 1000
+            (test if bucket < holdout * 1000 else train).append(item)
+        return train, test
+
+
+def load_gold(path: str, examples: Examples):
+    names = {name: intent for intent, name in INTENT_PATTERNS.items()}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                labels = {names[name] for name in item.get('labels', []) if name in names}
+                examples.add(item['text'], labels, GOLD_WEIGHT, 'gold')
+
+
+def comment_intents(comment: str) -> set:
+    comment = (comment or '').lower()
+    return {intent for intent, markers in COMMENT_INTENTS.items() if any(m in comment for m in markers)}
+
+
+def load_feedback(db_path: str, examples: Examples):
+    """feedback_v2 с комментарием → метка последней реплики клиента в оценённом отрезке"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in c.fetchall()}
+    if 'feedback_v2' not in tables or 'messages' not in tables:
+        conn.close()
+        return
+    c.execute('PRAGMA table_info(feedback_v2)')
+    if 'msg_to_id' not in {row[1] for row in c.fetchall()}:
+        conn.close()
+        return
+    c.execute("SELECT comment, chat_id, msg_from_id, msg_to_id FROM feedback_v2 "
+              "WHERE comment != '' AND msg_to_id IS NOT NULL")
+    for comment, chat_id, from_id, to_id in c.fetchall():
+        labels = comment_intents(comment)
+        if not labels:
+            continue
+        row = c.execute("SELECT content FROM messages WHERE chat_id = ? AND role = 'user' AND id BETWEEN ? AND ? "
+                        "ORDER BY id DESC LIMIT 1", (chat_id, from_id or 0, to_id)).fetchone()
+        if row and row[0]:
+            examples.add(row[0], labels, FEEDBACK_WEIGHT, 'feedback')
+    conn.close()
+
+
+def load_dialogs(dialogs, matchers: dict, examples: Examples, use_events: bool):
+    """Реплики клиентов: слабые метки по спискам паттернов (+ события диалога)"""
+    for messages in dialogs:
+        turns = merge_turns(messages)
+        events = label_turns(turns, score_dialog(messages).result) if use_events else {}
+        for i, (is_manager, text) in enumerate(turns):
+            if is_manager:
+                continue
+            text = text.replace('\n', ' ')
+            # Паттерны скомпилированы по нормализованным фразам — ищем в normalize_text, как в детекторах
+            norm = normalize_text(text)
+            labels = {intent for intent, name in INTENT_PATTERNS.items() if matchers[name].search(norm)}
+            labels |= {EVENT_INTENTS[e] for e in events.get(i, ()) if e in EVENT_INTENTS}
+            examples.add(text, labels, WEAK_WEIGHT, 'weak')
+
+
+# ============================================================
+# ОБУЧЕНИЕ
+# ============================================================
+
+def train(items: List[Dict], bits: int, epochs: int, lr: float, l2: float, seed: int = 13) -> IntentModel:
+    """Логистическая регрессия one-vs-rest, AdaGrad по признакам, L2 только по тронутым весам"""
+    width = len(INTENTS)
+    rows = [(feature_buckets(item['text'], bits), item['labels'], item['weight']) for item in items]
+    rows = [row for row in rows if row[0]]
+    weights, squares = {}, {}
+    bias, bias_squares = [0.0] * width, [1e-8] * width
+    rng = random.Random(seed)
+
+    for _ in range(epochs):
+        rng.shuffle(rows)
+        for buckets, labels, weight in rows:
+            scale = 1.0 / math.sqrt(len(buckets))
+            vectors = [weights.setdefault(b, [0.0] * width) for b in buckets]
+            accumulators = [squares.setdefault(b, [1e-8] * width) for b in buckets]
+            for k, intent in enumerate(INTENTS):
+                z = bias[k] + scale * sum(v[k] for v in vectors)
+                gradient = (sigmoid(z) - (intent in labels)) * weight
+                if abs(gradient) < 1e-4:
+                    continue
+                bias_squares[k] += gradient * gradient
+                bias[k] -= lr * gradient / math.sqrt(bias_squares[k])
+                g = gradient * scale
+                for v, acc in zip(vectors, accumulators):
+                    step = g + l2 * v[k]
+                    acc[k] += step * step
+                    v[k] -= lr * step / math.sqrt(acc[k])
+
+    compact = {b: tuple(round(w, 4) for w in v) for b, v in weights.items()
+               if max(abs(w) for w in v) >= WEIGHT_PRUNE}
+    return IntentModel(INTENTS, compact, bias, bits=bits)
+
+
+def tune_thresholds(model: IntentModel, items: List[Dict]) -> Dict[str, float]:
+    """Порог на намерение — лучший F1 на отложенной части; нет положительных примеров — по умолчанию"""
+    scores = [(model.scores(item['text']), item['labels']) for item in items]
+    thresholds = {}
+    for intent in INTENTS:
+        if not any(intent in labels for _, labels in scores):
+            continue
+        best = max(THRESHOLD_GRID, key=lambda t: (f1(*confusion(scores, intent, t)), t))
+        thresholds[intent] = best
+    return thresholds
+
+
+def confusion(scores, intent: str, threshold: float):
+    tp = fp = fn = 0
+    for s, labels in scores:
+        hit, expected = s[intent] >= threshold, intent in labels
+        tp += hit and expected
+        fp += hit and not expected
+        fn += expected and not hit
+    return tp, fp, fn
+
+
+def f1(tp: int, fp: int, fn: int) -> float:
+    return 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+
+
+def precision_recall(tp: int, fp: int, fn: int) -> str:
+    p = tp / (tp + fp) if tp + fp else 1.0
+    r = tp / (tp + fn) if tp + fn else 1.0
+    return f"{p:.2f}/{r:.2f}"
+
+
+# ============================================================
+# ОТЧЁТ
+# ============================================================
+
+def print_report(model: IntentModel, matchers: dict, test: List[Dict], size: int, train_seconds: float):
+    print(f"\n{'=' * 60}")
+    print("🧠 МОДЕЛЬ НАМЕРЕНИЙ")
+    print(f"{'=' * 60}")
+    print(f"Признаков: {len(model.weights)}, файл: {size / 1024:.1f} КБ, обучение: {train_seconds:.1f} с")
+
+    gold = [item for item in test if item['source'] == 'gold']
+    for label, items in (("Отложенные (все)", test), ("Отложенные размеченные вручную", gold)):
+        if not items:
+            continue
+        scores = [(model.scores(item['text']), item['labels']) for item in items]
+        print(f"\n{label}: {len(items)}")
+        print(f"   {'Намерение':<12} {'порог':>6} {'модель p/r':>11} {'паттерны p/r':>13}")
+        for intent in INTENTS:
+            name = INTENT_PATTERNS[intent]
+            pattern_scores = [({intent: float(matchers[name].search(normalize_text(item['text'])) is not None)},
+                               item['labels']) for item in items]
+            threshold = model.thresholds[intent]
+            print(f"   {intent:<12} {threshold:>6.2f} {precision_recall(*confusion(scores, intent, threshold)):>11} "
+                  f"{precision_recall(*confusion(pattern_scores, intent, 0.5)):>13}")
+
+    texts = [item['text'] for item in test[:2000]] or ['скиньте варианты']
+    started = time.perf_counter()
+    for text in texts:
+        model._scores(text)
+    print(f"\n⏱️ {(time.perf_counter() - started) / len(texts) * 1e6:.0f} мкс на сообщение (без кэша)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обучение классификатора намерений клиента')
+    parser.add_argument('inputs', nargs='*', help='Папки/файлы с диалогами (txt, rtf, Telegram JSON)')
+    parser.add_argument('--db', nargs='+', default=[], help='Базы ботов (sofia_hybrid.db, sofia_conversations.db)')
+    parser.add_argument('--labelled', default=str(ROOT_DIR / 'patterns_labelled.jsonl'), help='Ручная разметка')
+    parser.add_argument('--patterns', default=str(ROOT_DIR / 'sofia_hybrid.py'), help='Списки для слабой разметки')
+    parser.add_argument('--managers', nargs='+', default=DEFAULT_MANAGER_NAMES, help='Имена менеджеров')
+    parser.add_argument('--events', action='store_true',
+                        help='Добавить метки по событиям диалога (извинение, отправка, отказ) — шумнее')
+    parser.add_argument('--output', '-o', default=str(ROOT_DIR / 'intent_model.bin'), help='Файл модели')
+    parser.add_argument('--bits', type=int, default=HASH_BITS, help='Размер хэш-пространства признаков (2^bits)')
+    parser.add_argument('--epochs', type=int, default=8)
+    parser.add_argument('--lr', type=float, default=0.5)
+    parser.add_argument('--l2', type=float, default=1e-4)
+    parser.add_argument('--holdout', type=float, default=0.2, help='Доля примеров для подбора порогов и отчёта')
+    args = parser.parse_args()
+
+    matchers = compile_patterns(load_hybrid_patterns(Path(args.patterns).read_text(encoding='utf-8')))
+    examples = Examples()
+    sources = [iter_file_dialogs(args.inputs, args.managers)] if args.inputs else []
+    sources += [iter_db_dialogs(db) for db in args.db]
+    for dialogs in sources:
+        load_dialogs(dialogs, matchers, examples, args.events)
+    for db in args.db:
+        load_feedback(db, examples)
+    if Path(args.labelled).exists():
+        load_gold(args.labelled, examples)
+
+    if not examples.items:
+        print("❌ Нет примеров")
+        return
+    print(f"📥 Примеров: {len(examples.items)} ({', '.join(f'{k}: {v}' for k, v in examples.by_source.items())})")
+    for intent in INTENTS:
+        print(f"   {intent:<12} {sum(intent in item['labels'] for item in examples.items.values())}")
+
+    train_items, test_items = examples.split(args.holdout)
+    started = time.time()
+    model = train(train_items, args.bits, args.epochs, args.lr, args.l2)
+    model.thresholds.update(tune_thresholds(model, test_items))
+    print_report(model, matchers, test_items, len(model.to_bytes()), time.time() - started)
+
+    # Итоговая модель — на всех примерах, с подобранными порогами
+    final = train(train_items + test_items, args.bits, args.epochs, args.lr, args.l2)
+    final.thresholds = dict(model.thresholds)
+    final.meta = {
+        "trained_at": time.strftime('%Y-%m-%d %H:%M'),
+        "examples": len(examples.items),
+        "sources": examples.by_source,
+    }
+    size = final.save(args.output)
+    print(f"\n💾 {args.output}: {size / 1024:.1f} КБ, версия {final.version}")
+
+
+if __name__ == '__main__':
+    main()
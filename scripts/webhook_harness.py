@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный стенд для webhook-режима ботов (webhook.py) — без Telegram и без OpenAI
+- Шлёт POST'ами синтетические апдейты (сообщения клиентов) с секретным токеном, как это делает Telegram
+- Мерит подтверждение апдейта (ack): p50/p95/макс и апдейтов в секунду при -c параллельных соединениях
+- Проверяет, что апдейт с чужим секретом отклоняется (403), и читает /health
+- --bot: поднимает бота целиком — фейковый Bot API (запоминает sendMessage), LLM-заглушку (llm_stub.py),
+  бот в режиме webhook во временной папке (--workers N — за роутером shard_supervisor.py) —
+  и мерит задержку от апдейта до ответа клиенту
+  (у bot_server.py в неё входит антифлуд ANTIFLOOD_DELAY = 3 с)
+
+Использование:
+    # Уже запущенный бот (BOT_MODE=webhook WEBHOOK_SECRET=... python bot_server_hybrid.py)
+    python webhook_harness.py --url http://127.0.0.1:8082/hybrid --secret ... -n 2000 -c 20
+    # Офлайн: бот поднимается сам
+    python webhook_harness.py --bot ../bot_server_hybrid.py -n 300 -c 10 --chats 50 --concurrent-updates 8
+    # То же за роутером шардов (shard_supervisor.py), 4 процесса
+    python webhook_harness.py --bot ../bot_server_hybrid.py -n 300 -c 10 --chats 50 --workers 4
+"""
+
+import argparse
+import http.client
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / "scripts"))
+
+import llm_stub
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+TEST_TOKEN = "123456:HARNESS"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "София", "username": "sofia_harness_bot"}
+# Реплики клиентов — без приветствий (на них bot_server отвечает шаблоном, без модели)
+CLIENT_TEXTS = [
+    "Интересует квартира в Сочи",
+    "Бюджет до 12 млн",
+    "А ипотека есть?",
+    "Для себя, хотим у моря",
+    "Какие сроки сдачи?",
+    "Можно в рассрочку?",
+    "Рассматриваем Анапу или Геленджик",
+    "Скиньте варианты",
+]
+CHAT_BASE = 900000000
+QUIET_S = 4
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Апдейт Telegram с текстовым сообщением клиента"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"Клиент{chat_id % 1000}", "language_code": "ru"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+# ============================================================
+# ФЕЙКОВЫЙ BOT API
+# ============================================================
+
+class FakeBotApi:
+    """Bot API в фоновом потоке: getMe/sendMessage/... отвечают успехом, ответы клиентам запоминаются"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.sent = []  # (время, chat_id, текст)
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def _result(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == "getMe":
+                return BOT_USER
+            if method in ("sendMessage", "editMessageText"):
+                chat_id = int(params.get("chat_id", 0))
+                self.message_id += 1
+                self.sent.append((time.perf_counter(), chat_id, params.get("text", "")))
+                return {"message_id": self.message_id, "date": int(time.time()), "text": params.get("text", ""),
+                        "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+            if method == "getUpdates":
+                return []
+            return True
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "json" in self.headers.get("Content-Type", ""):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+                data = json.dumps({"ok": True, "result": api._result(self.path.rsplit("/", 1)[-1], params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+        return Handler
+
+    def replies_after(self, chat_id: int, started: float) -> list:
+        with self.lock:
+            return [at for at, chat, _ in self.sent if chat == chat_id and at >= started]
+
+
+# ============================================================
+# НАГРУЗКА
+# ============================================================
+
+def request(conn, method: str, path: str, body: bytes = None, secret: str = None) -> tuple:
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers[SECRET_HEADER] = secret
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def check_health(base: str) -> dict:
+    parts = urlsplit(base)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+    try:
+        status, body = request(conn, "GET", "/health")
+        return {"status": status, **json.loads(body)}
+    finally:
+        conn.close()
+
+
+def wait_health(base: str, timeout: float, process=None) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if check_health(base)["status"] == 200:
+                return True
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def run_load(url: str, secret: str, total: int, concurrency: int, chats: int) -> dict:
+    """
+    total апдейтов по chats чатам, concurrency соединений (keep-alive).
+    Апдейты одного чата идут по порядку из одного соединения — как и у Telegram, порядок в чате сохраняется.
+    """
+    parts = urlsplit(url)
+    jobs = [[] for _ in range(concurrency)]
+    for i in range(total):
+        chat_id = CHAT_BASE + i % chats
+        jobs[chat_id % concurrency].append(make_update(i + 1, chat_id, CLIENT_TEXTS[i // chats % len(CLIENT_TEXTS)]))
+    last_post = {}
+
+    def worker(updates: list) -> tuple:
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        latencies, errors = [], 0
+        for update in updates:
+            body = json.dumps(update, ensure_ascii=False).encode("utf-8")
+            started = time.perf_counter()
+            status, _ = request(conn, "POST", parts.path, body, secret)
+            latencies.append((time.perf_counter() - started) * 1000)
+            last_post[update["message"]["chat"]["id"]] = started
+            errors += status != 200
+        conn.close()
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(worker, [job for job in jobs if job]))
+    elapsed = time.perf_counter() - started
+    latencies = [ms for chunk, _ in results for ms in chunk]
+    return {"latencies": latencies, "errors": sum(e for _, e in results), "elapsed": elapsed, "last_post": last_post}
+
+
+def check_rejects(url: str, secret: str) -> tuple:
+    """Чужой секрет и мусор вместо JSON: (статус, статус)"""
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+    try:
+        forged, _ = request(conn, "POST", parts.path, json.dumps(make_update(0, CHAT_BASE, "x")).encode(),
+                            secret + "x")
+        garbage, _ = request(conn, "POST", parts.path, b"{not json", secret)
+        return forged, garbage
+    finally:
+        conn.close()
+
+
+def start_bot(script: str, workdir: str, port: int, secret: str, api: FakeBotApi, llm_url: str,
+              concurrent_updates: int, workers: int = 0):
+    env = dict(os.environ,
+               BOT_MODE="webhook", WEBHOOK_PORT=str(port), WEBHOOK_PATH="/hook", WEBHOOK_SECRET=secret,
+               WEBHOOK_URL="", CONCURRENT_UPDATES=str(concurrent_updates),
+               TELEGRAM_BOT_TOKEN=TEST_TOKEN, TELEGRAM_API_URL=api.base_url,
+               OPENAI_API_KEY="sk-harness", OPENAI_BASE_URL=llm_url,
+               DB_PATH=os.path.join(workdir, "bot.db"), BACKUP_DIR=os.path.join(workdir, "backups"),
+               EXAMPLES_INDEX_PATH=os.path.join(workdir, "examples_index.jsonl"), PYTHONUNBUFFERED="1")
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    command = [sys.executable, str(Path(script).resolve())]
+    if workers:
+        # Бот за роутером шардов: тот же webhook снаружи, N процессов внутри
+        command = [sys.executable, str(ROOT_DIR / "shard_supervisor.py"), command[1], "--workers", str(workers),
+                   "--base-port", str(port + 1)]
+    return subprocess.Popen(command, cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def report_ack(result: dict, total: int):
+    latencies = result["latencies"]
+    print(f"📨 Апдейтов: {total} за {result['elapsed']:.2f} с ({total / result['elapsed']:.0f}/с), "
+          f"ошибок: {result['errors']}")
+    print(f"   Подтверждение: p50 {percentile(latencies, 0.5):.1f} мс, p95 {percentile(latencies, 0.95):.1f} мс, "
+          f"макс {max(latencies):.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный стенд webhook-режима')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='Webhook запущенного бота (http://127.0.0.1:8082/hybrid)')
+    target.add_argument('--bot', help='Скрипт бота: поднять офлайн (bot_server.py / bot_server_hybrid.py)')
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''), help='Секрет (для --url)')
+    parser.add_argument('-n', type=int, default=500, help='Сколько апдейтов')
+    parser.add_argument('-c', type=int, default=10, help='Параллельных соединений')
+    parser.add_argument('--chats', type=int, default=50, help='Сколько разных чатов')
+    parser.add_argument('--port', type=int, default=8099, help='Порт webhook бота (для --bot)')
+    parser.add_argument('--concurrent-updates', type=int, default=8, help='CONCURRENT_UPDATES бота (для --bot)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Поднять бота через shard_supervisor.py с N процессами (для --bot)')
+    parser.add_argument('--wait', type=float, default=60, help='Сколько ждать ответов бота, с (для --bot)')
+    args = parser.parse_args()
+
+    process = api = llm = None
+    if args.bot:
+        workdir = tempfile.mkdtemp(prefix="webhook_harness_")
+        secret = secrets.token_urlsafe(16)
+        api = FakeBotApi()
+        llm = llm_stub.serve(port=0)
+        llm_url = f"http://127.0.0.1:{llm.server_address[1]}/v1"
+        url = f"http://127.0.0.1:{args.port}/hook"
+        process = start_bot(args.bot, workdir, args.port, secret, api, llm_url, args.concurrent_updates,
+                            args.workers)
+        print(f"🧪 {Path(args.bot).name}: webhook {url}, Bot API {api.base_url}, LLM {llm_url}, папка {workdir}")
+    else:
+        url, secret = args.url, args.secret
+    base = "{0.scheme}://{0.netloc}".format(urlsplit(url))
+
+    try:
+        if not wait_health(base, 30, process):
+            print(f"❌ Бот не поднялся (нет ответа {base}/health)")
+            if process is not None:
+                print(open(os.path.join(workdir, "bot.log"), encoding="utf-8").read()[-3000:])
+            return
+
+        forged, garbage = check_rejects(url, secret)
+        print(f"🔒 Чужой секрет → {forged} {'✅' if forged == 403 else '❌'}, не JSON → {garbage} "
+              f"{'✅' if garbage == 400 else '❌'}")
+
+        result = run_load(url, secret, args.n, args.c, args.chats)
+        report_ack(result, args.n)
+
+        if api is not None:
+            # Чат отвечен, когда бот замолчал: ответов нет QUIET_S (дольше антифлуда bot_server.py).
+            # Задержка чата — от последнего апдейта до последнего ответа в нём.
+            deadline = time.time() + args.wait
+            while time.time() < deadline:
+                with api.lock:
+                    last_sent = api.sent[-1][0] if api.sent else 0.0
+                if api.sent and time.perf_counter() - last_sent > QUIET_S:
+                    break
+                time.sleep(0.1)
+            delays = []
+            for chat_id, posted in result["last_post"].items():
+                replies = api.replies_after(chat_id, posted)
+                if replies:
+                    delays.append((replies[-1] - posted) * 1000)
+            print(f"💬 Ответов клиентам: {len(api.sent)} (чатов, отвеченных после последнего сообщения: "
+                  f"{len(delays)}/{len(result['last_post'])})")
+            if delays:
+                print(f"   До ответа: p50 {percentile(delays, 0.5):.0f} мс, p95 {percentile(delays, 0.95):.0f} мс, "
+                      f"макс {max(delays):.0f} мс")
+            print(f"   Вызовы Bot API: {json.dumps(api.calls, ensure_ascii=False)}")
+
+        health = check_health(base)
+        print(f"❤️ /health: {json.dumps(health, ensure_ascii=False)}")
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if api is not None:
+            api.server.shutdown()
+        if llm is not None:
+            llm.shutdown()
+
+
+if __name__ == '__main__':
+    main()
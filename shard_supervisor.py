@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Горизонтальное масштабирование бота: N процессов-воркеров, у каждого свой шард chat_id
+- Воркер — обычный bot_server.py / bot_server_hybrid.py в режиме webhook (webhook.py) на 127.0.0.1
+- Роутер принимает webhook от Telegram (тот же секрет, путь и /health) и по consistent hash от chat_id
+  пересылает апдейт своему воркеру. Всё состояние чата (антифлуд, waiting_for_comment, кэши) живёт
+  в одном процессе, порядок апдейтов чата сохраняется: у воркера одно соединение и одна очередь
+- Детекторы, скоринг и ожидание LLM идут в N процессах, то есть на всех ядрах
+- Упавший воркер перезапускается; апдейты его шарда ждут до FORWARD_TIMEOUT, потом 503 (Telegram повторит)
+
+Использование:
+    WEBHOOK_SECRET=... WEBHOOK_URL=https://bot.example.com python shard_supervisor.py bot_server_hybrid.py --workers 4
+    # Нагрузка офлайн: python scripts/webhook_harness.py --bot bot_server_hybrid.py --workers 4
+"""
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import signal
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from webhook import HEALTH_PATH, SECRET_HEADER, read_head, serve_http, webhook_config
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Порт и путь роутера по умолчанию — как у самого бота в режиме webhook
+BOT_DEFAULTS = {"bot_server.py": (8081, "/sofia"), "bot_server_hybrid.py": (8082, "/hybrid")}
+VNODES = 64               # точек на шард в кольце: шарды ровнее, при смене N переезжает ~1/N чатов
+FORWARD_TIMEOUT = 30      # секунд ждём воркер (перезапуск) прежде чем ответить Telegram 503
+RETRY_DELAY = 0.5
+PIPELINE = 64             # сколько апдейтов отправлять по соединению, не дожидаясь ответов
+CONNECTIONS = 8           # соединений роутер → воркер; чат всегда в одном и том же
+RESTART_DELAY = 2
+STOP_TIMEOUT = 10
+HEALTH_TIMEOUT = 2
+# Где у апдейта чат: chat → message.chat (callback_query) → from / user (inline, опросы)
+CHAT_KEYS = ("chat", "message", "from", "user")
+
+
+def log(message):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}", flush=True)
+
+
+def chat_hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash: chat_id → шард. Не зависит от процесса и запуска (blake2b, а не hash())."""
+
+    def __init__(self, shards: int, vnodes: int = VNODES):
+        points = sorted((chat_hash(f"shard-{shard}-{i}"), shard) for shard in range(shards) for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, chat_id) -> int:
+        return self.shards[bisect.bisect(self.points, chat_hash(chat_id)) % len(self.points)]
+
+
+def update_chat_id(data: dict):
+    """chat_id из сырого апдейта (без разбора в объекты PTB); None — апдейт без чата и пользователя"""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for chat_key in CHAT_KEYS:
+            chat = value.get(chat_key)
+            if chat_key == "message" and isinstance(chat, dict):
+                chat = chat.get("chat")
+            if isinstance(chat, dict) and "id" in chat:
+                return chat["id"]
+    return None
+
+
+class Worker:
+    """Процесс бота одного шарда: запуск и перезапуск, пересылка апдейтов (очередь на соединение)"""
+
+    def __init__(self, index: int, script: str, port: int, env: dict):
+        self.index = index
+        self.script = script
+        self.port = port
+        self.env = env
+        self.secret = env["WEBHOOK_SECRET"]
+        self.path = env["WEBHOOK_PATH"]
+        self.process = None
+        self.restarts = 0
+        self.queues = [asyncio.Queue() for _ in range(CONNECTIONS)]
+        self.stats = {"forwarded": 0, "failed": 0}
+
+    async def supervise(self, stopping: asyncio.Event):
+        while not stopping.is_set():
+            self.process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=self.env)
+            log(f"🧩 Шард {self.index}: pid {self.process.pid}, порт {self.port}")
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            self.restarts += 1
+            log(f"💥 Шард {self.index}: процесс завершился (код {code}), перезапуск через {RESTART_DELAY} с")
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.process.kill()
+
+    async def forward(self, body: bytes, chat_id) -> int:
+        """Апдейт → воркер; статус ответа воркера (503 — воркер недоступен)"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queues[chat_hash(chat_id) % CONNECTIONS].put((body, future))
+        return await future
+
+    async def forwarder(self, queue: asyncio.Queue):
+        """
+        Очередь → воркер по своему keep-alive соединению. Накопившиеся апдейты уходят пачкой
+        (HTTP pipelining), ответы читаются по порядку: воркер разбирает запросы соединения по очереди,
+        а чат всегда идёт через одну очередь — апдейты чата попадают в update_queue воркера в том порядке,
+        в каком пришли в роутер. Несколько соединений — чтобы воркер принимал апдейты разных чатов параллельно.
+        """
+        reader = writer = None
+        head = (f"POST {self.path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                f"{SECRET_HEADER}: {self.secret}\r\n")
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty() and len(batch) < PIPELINE:
+                batch.append(queue.get_nowait())
+            deadline = time.monotonic() + FORWARD_TIMEOUT
+            while batch and time.monotonic() < deadline:
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                    writer.write(b"".join(f"{head}Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+                                          for body, _ in batch))
+                    await writer.drain()
+                    while batch:
+                        parts, headers = await asyncio.wait_for(read_head(reader), FORWARD_TIMEOUT)
+                        if parts is None:
+                            raise ConnectionError("соединение закрыто")
+                        await reader.readexactly(int(headers.get("content-length") or 0))
+                        self._done(batch.pop(0)[1], int(parts[1]))
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                    # Воркер перезапускается или закрыл простаивающее соединение — переподключаемся
+                    # и досылаем неподтверждённый хвост пачки
+                    if writer is not None:
+                        writer.close()
+                    reader = writer = None
+                    await asyncio.sleep(RETRY_DELAY)
+            for _, future in batch:
+                self._done(future, 503)
+
+    def _done(self, future, status: int):
+        self.stats["forwarded" if status == 200 else "failed"] += 1
+        future.set_result(status)
+
+    async def health(self) -> dict:
+        info = {"shard": self.index, "pid": self.process.pid if self.process else None, "port": self.port,
+                "restarts": self.restarts, "pending": sum(queue.qsize() for queue in self.queues), **self.stats}
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", self.port), HEALTH_TIMEOUT)
+            try:
+                writer.write(f"GET {HEALTH_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+                await writer.drain()
+                parts, headers = await asyncio.wait_for(read_head(reader), HEALTH_TIMEOUT)
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                info = {**json.loads(body), **info, "ok": parts[1] == "200"}
+            finally:
+                writer.close()
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, TypeError, ValueError):
+            info["ok"] = False
+        return info
+
+
+class ShardRouter:
+    """Публичный webhook: проверка секрета Telegram → шард по chat_id → воркер; /health — по всем шардам"""
+
+    def __init__(self, workers: list, config: dict):
+        self.workers = workers
+        self.config = config
+        self.ring = HashRing(len(workers))
+        self.server = None
+        self.started_at = time.time()
+        self.stats = {"received": 0, "rejected": 0, "invalid": 0, "unavailable": 0}
+
+    async def start(self):
+        self.server = await asyncio.start_server(lambda reader, writer: serve_http(reader, writer, self._route),
+                                                 self.config["listen"], self.config["port"])
+        log(f"🌐 Роутер: http://{self.config['listen']}:{self.config['port']}{self.config['path']} "
+            f"→ {len(self.workers)} шард(ов)")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def health(self) -> dict:
+        workers = await asyncio.gather(*(worker.health() for worker in self.workers))
+        return {
+            "ok": all(worker["ok"] for worker in workers),
+            "mode": "sharded",
+            "uptime_s": round(time.time() - self.started_at),
+            **self.stats,
+            "workers": workers,
+        }
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        if path == HEALTH_PATH:
+            health = await self.health()
+            return (200 if health["ok"] else 503), health
+        if path != self.config["path"]:
+            return 404, {"ok": False}
+        if method != "POST":
+            return 405, {"ok": False}
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.config["secret"].encode()):
+            self.stats["rejected"] += 1
+            return 403, {"ok": False}
+        try:
+            data = json.loads(body)
+            chat_id = update_chat_id(data) if isinstance(data, dict) else None
+        except ValueError:
+            self.stats["invalid"] += 1
+            return 400, {"ok": False}
+        # Апдейты без чата (редкие служебные) — всегда в шард 0
+        worker = self.workers[self.ring.shard_for(chat_id) if chat_id is not None else 0]
+        status = await worker.forward(body, chat_id)
+        if status == 200:
+            self.stats["received"] += 1
+        elif status == 503:
+            self.stats["unavailable"] += 1
+        return status, {"ok": status == 200}
+
+
+def worker_env(config: dict, index: int, count: int, port: int, secret: str) -> dict:
+    """Окружение воркера: webhook только на localhost, внутренний секрет, свой файл индекса примеров"""
+    examples_path = os.getenv("EXAMPLES_INDEX_PATH", os.path.join(BASE_DIR, "examples_index.jsonl"))
+    return dict(os.environ,
+                BOT_MODE="webhook", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port),
+                WEBHOOK_PATH=config["path"], WEBHOOK_SECRET=secret, WEBHOOK_URL="",
+                SHARD_INDEX=str(index), SHARD_COUNT=str(count),
+                # Индекс дописывается при оценках — у каждого процесса свой файл (все дочитывают общую базу)
+                EXAMPLES_INDEX_PATH=f"{examples_path}.{index}")
+
+
+async def wait_ready(workers: list, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(health["ok"] for health in await asyncio.gather(*(w.health() for w in workers))):
+            return True
+        await asyncio.sleep(RETRY_DELAY)
+    return False
+
+
+async def set_webhook(config: dict):
+    from telegram import Bot, Update
+    kwargs = {"base_url": config["api_url"]} if config["api_url"] else {}
+    async with Bot(os.getenv("TELEGRAM_BOT_TOKEN"), **kwargs) as bot:
+        await bot.set_webhook(url=config["url"] + config["path"], secret_token=config["secret"],
+                              allowed_updates=Update.ALL_TYPES, drop_pending_updates=config["drop_pending"],
+                              max_connections=max(40, config["concurrent_updates"]))
+    log(f"🔗 setWebhook: {config['url']}{config['path']}")
+
+
+async def run(script: str, count: int, base_port: int = None):
+    config = webhook_config(*BOT_DEFAULTS.get(Path(script).name, (8080, "/webhook")))
+    if not config["secret"]:
+        config["secret"] = secrets.token_urlsafe(32)
+        if not config["url"]:
+            log("⚠️ Роутер: нет ни WEBHOOK_SECRET, ни WEBHOOK_URL — апдейты будут отклоняться")
+    if base_port is None:
+        base_port = int(os.getenv("SHARD_BASE_PORT", str(10000 + config["port"] % 1000 * 100)))
+    internal_secret = secrets.token_urlsafe(32)
+    workers = [Worker(i, script, base_port + i, worker_env(config, i, count, base_port + i, internal_secret))
+               for i in range(count)]
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    log(f"🚀 Супервизор: {Path(script).name} × {count}")
+    supervisors = [asyncio.create_task(worker.supervise(stopping)) for worker in workers]
+    forwarders = [asyncio.create_task(worker.forwarder(queue)) for worker in workers for queue in worker.queues]
+    router = ShardRouter(workers, config)
+    await router.start()
+    try:
+        if await wait_ready(workers, FORWARD_TIMEOUT * 2):
+            log("✅ Все шарды готовы")
+            if config["url"]:
+                await set_webhook(config)
+        else:
+            log("⚠️ Не все шарды ответили на /health — апдейты их чатов ждут перезапуска")
+        await stopping.wait()
+    finally:
+        log("🛑 Остановка шардов...")
+        await router.stop()
+        await asyncio.gather(*(worker.stop() for worker in workers))
+        for task in supervisors + forwarders:
+            task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Супервизор шардов бота: роутер webhook + N воркеров')
+    parser.add_argument('script', help='Скрипт бота (bot_server.py / bot_server_hybrid.py)')
+    parser.add_argument('--workers', type=int, default=int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1))),
+                        help='Сколько процессов (по умолчанию — по числу ядер)')
+    parser.add_argument('--base-port', type=int, help='Порт первого воркера (дальше подряд)')
+    args = parser.parse_args()
+    asyncio.run(run(str(Path(args.script).resolve()), max(1, args.workers), args.base_port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# slots.py — что уже известно о клиенте: цель, локация, бюджет, оплата, сроки
+# Раньше модель каждый ход перечитывала всю историю, чтобы понять, на каком шаге лестницы
+# вопросов она находится, а decide_action об этом не знал вовсе.
+# Теперь слоты обновляются по одному сообщению клиента за ход (регулярки собраны при импорте,
+# локации с синонимами — из справочника price_catalog.json), состояние хранится по чату,
+# а в промпт идёт одна строка-сводка.
+
+import re
+
+from price_catalog import current_catalog
+from text_normalize import normalize_text
+
+SLOT_NAMES = ("goal", "location", "budget", "payment", "timing")
+SLOT_LABELS = {"goal": "цель", "location": "локация", "budget": "бюджет", "payment": "оплата", "timing": "сроки"}
+
+# Ответ "не знаю" на вопрос о слоте — тоже ответ (правило 7 промпта): второй раз не спрашиваем
+UNKNOWN = "не знает"
+UNKNOWN_RE = re.compile(r" (?:не знаю|незнаю|без разницы|все равно|неважно|не важно|любой|любая|пока не решил|хз) ")
+
+# Значение слота → признаки в нормализованном тексте (с пробелом — начало слова)
+GOAL_MARKERS = {
+    "инвестиция: аренда": (" сдава", " сдат", " аренд", " посуточ", " арендн"),
+    "инвестиция: капитализация": (" капитализ", " перепрод", " рост цен", " вырастет"),
+    "инвестиция": (" инвест", " вложит", " вложен", " сохранить деньги", " доход"),
+    "для себя": (" для себя", " для семьи", " жить", " переезд", " переехать", " для отдыха", " отдыхать",
+                 " для родител", " для детей", " на пенсии"),
+}
+PAYMENT_MARKERS = {
+    "ипотека": (" ипотек", " в кредит", " семейн ипотек", " льготн"),
+    "рассрочка": (" рассрочк", " в рассрочку", " частями"),
+    "100%": (" наличн", " налом", " сразу всю сумму", " полная оплата", " полной оплат", " собственн средств",
+             " своими деньгами", " свои деньги", " кэш", " сразу оплат"),
+}
+TIMING_MARKERS = {
+    "в ближайший месяц": (" срочно", " в ближайш", " в этом месяце", " на этой неделе", " сейчас готов", " прямо сейчас",
+                          " как можно скорее", " в течение месяца"),
+    "в этом году": (" в этом году", " до конца года", " к лету", " летом", " весной", " осенью", " к осени",
+                    " через пару месяцев", " через полгода", " через несколько месяцев"),
+    "изучает": (" пока изуча", " присматрива", " не спешу", " не скоро", " пока смотрю", " просто смотрю",
+                " в следующем году", " через год"),
+}
+
+# Какой слот спрашивала София последним вопросом — для ответов без явных слов ("до 15", "не знаю")
+ASK_MARKERS = {
+    "goal": (" для себя", " инвестиц", " под аренду", " на капитализацию", " цель"),
+    "location": (" локаци", " сочи", " крым", " анап", " алта", " где смотрите", " регион"),
+    "payment": (" ипотек", " рассрочк", " формат оплаты", " как планируете"),
+    "budget": (" бюджет", " сумм", " платеж", " первому взносу", " первоначальн", " взнос"),
+    "timing": (" по срокам", " когда планируете", " сроки", " в ближайший месяц"),
+}
+
+# Суммы: "10 млн", "9,5 млн", "от 10 до 15", "10-15 млн", "до 15", "12 000 000", "15 лямов", "800 тыс".
+# Число без единицы — миллионы, только если София спрашивала про бюджет: "до 19 часов", "с 14 до 16",
+# "не больше 15 минут" — про время звонка, не про деньги. Цифра, приклеенная к слову ("м2"), — не число
+NUMBER = r"(?<![\w.,])(\d+(?:[.,]\d+)?)(?![.,:]?\d)"
+UNIT = r"\s*(млрд|млн|миллион\w*|лям\w*|тыс\w*|т\.?р|к\b)?"
+# Число, за которым идут время, площадь, комнаты и т.п., — не сумма
+NOT_MEASURE = (r"(?!\s*(?:мин|час|ч\b|сек|утра|вечера|дн|ден|недел|мес|год|лет|числ|метр|м2|м²|кв|сот|га\b|"
+               r"спал|комн|этаж|чел|%))")
+RANGE_RE = re.compile(rf"(?:от\s*)?{NUMBER}{UNIT}{NOT_MEASURE}\s*(?:-|–|—|до)\s*{NUMBER}{UNIT}{NOT_MEASURE}")
+UPTO_RE = re.compile(rf"(?:до|не больше|не более|максимум|в пределах)\s*{NUMBER}{UNIT}{NOT_MEASURE}")
+FROM_RE = re.compile(rf"(?:от|не меньше|не менее|минимум)\s*{NUMBER}{UNIT}{NOT_MEASURE}")
+AMOUNT_RE = re.compile(rf"{NUMBER}{UNIT}{NOT_MEASURE}")
+RUBLES_RE = re.compile(r"\b\d{1,3}(?:[  ]\d{3}){2,}\b|\b\d{7,10}\b")
+MONTHLY_RE = re.compile(r"в месяц|ежемесячн|/мес|платеж|платёж|взнос")
+FULL_PAYMENT_RE = re.compile(r"100\s*%")
+IN_PERIOD_RE = re.compile(r"через\s*(\d+)\s*(недел|мес|год|лет)")
+BUDGET_MAX_MLN = 500
+
+
+def empty_slots() -> dict:
+    return {name: None for name in SLOT_NAMES}
+
+
+def to_millions(number: str, unit: str, bare_is_mln: bool):
+    """Число + единица → миллионы; без единицы — только если ясно, что речь о бюджете"""
+    value = float(number.replace(",", "."))
+    unit = (unit or "").lower()
+    if unit.startswith("млрд"):
+        value *= 1000
+    elif unit.startswith(("тыс", "т", "к")):
+        value /= 1000
+    elif not unit and not bare_is_mln:
+        return None
+    return round(value, 2) if 0 < value <= BUDGET_MAX_MLN else None
+
+
+def extract_budget(text: str, asked_budget: bool = False):
+    """Бюджет в миллионах: {"min": .., "max": ..}; платёж в месяц и первый взнос не бюджет"""
+    low = text.lower()
+    if MONTHLY_RE.search(low):
+        return None
+    m = RUBLES_RE.search(low)
+    if m:
+        value = int(re.sub(r"\D", "", m.group())) / 1e6
+        return {"min": None, "max": round(value, 2)} if 0 < value <= BUDGET_MAX_MLN else None
+    m = RANGE_RE.search(low)
+    if m:
+        unit = m.group(4) or m.group(2)
+        low_value = to_millions(m.group(1), m.group(2) or unit, asked_budget)
+        high_value = to_millions(m.group(3), unit, asked_budget)
+        if low_value and high_value and low_value < high_value:
+            return {"min": low_value, "max": high_value}
+    m = UPTO_RE.search(low)
+    if m:
+        value = to_millions(m.group(1), m.group(2), asked_budget)
+        if value:
+            return {"min": None, "max": value}
+    m = FROM_RE.search(low)
+    if m:
+        value = to_millions(m.group(1), m.group(2), asked_budget)
+        if value:
+            return {"min": value, "max": None}
+    for m in AMOUNT_RE.finditer(low):
+        value = to_millions(m.group(1), m.group(2), asked_budget)
+        if value:
+            return {"min": None, "max": value}
+    return None
+
+
+def extract_timing(text: str, norm: str):
+    timing = _first_marker(norm, TIMING_MARKERS)
+    m = IN_PERIOD_RE.search(text.lower())
+    if m:
+        count, unit = int(m.group(1)), m.group(2)
+        months = count / 4 if unit == "недел" else count if unit == "мес" else count * 12
+        timing = "в ближайший месяц" if months <= 1 else "в этом году" if months <= 12 else "изучает"
+    return timing
+
+
+def _first_marker(norm: str, markers: dict):
+    for value, phrases in markers.items():
+        if any(p in norm for p in phrases):
+            return value
+    return None
+
+
+def asked_slot(bot_text: str):
+    """Слот, о котором спрашивал последний вопрос бота (None — вопроса не было)"""
+    if not bot_text or "?" not in bot_text:
+        return None
+    question = normalize_text(bot_text[bot_text.rfind(".", 0, bot_text.rfind("?")) + 1:], False)
+    return _first_marker(question, ASK_MARKERS)
+
+
+def extract_from_message(text: str, asked: str = None) -> dict:
+    """Слоты, которые видны в одном сообщении клиента"""
+    norm = normalize_text(text, False)
+    found = {}
+    goal = _first_marker(norm, GOAL_MARKERS)
+    if goal:
+        found["goal"] = goal
+    locations = current_catalog().find_regions(norm)
+    if locations:
+        found["location"] = locations
+    # Число без единицы — бюджет, если про него спрашивали или клиент сам назвал ("бюджет до 15")
+    budget = extract_budget(text, asked == "budget" or " бюджет" in norm)
+    if budget:
+        found["budget"] = budget
+    payment = _first_marker(norm, PAYMENT_MARKERS) or ("100%" if FULL_PAYMENT_RE.search(text) else None)
+    if payment:
+        found["payment"] = payment
+    timing = extract_timing(text, norm)
+    if timing:
+        found["timing"] = timing
+    if asked and asked not in found and UNKNOWN_RE.search(norm):
+        found[asked] = UNKNOWN
+    return found
+
+
+def update_slots(slots: dict, user_text: str, bot_text: str = None) -> dict:
+    """Новое состояние после одного сообщения клиента; bot_text — предыдущая реплика бота"""
+    updated = dict(slots or empty_slots())
+    for name, value in extract_from_message(user_text, asked_slot(bot_text)).items():
+        if value == UNKNOWN and updated.get(name) not in (None, UNKNOWN):
+            continue  # "не знаю" не затирает уже известное
+        updated[name] = value
+    return updated
+
+
+def slots_from_history(history: list) -> dict:
+    """Полный проход — для чатов без сохранённого состояния"""
+    slots = empty_slots()
+    bot_text = None
+    for msg in history:
+        if msg.get("role") == "user":
+            slots = update_slots(slots, msg.get("content", ""), bot_text)
+        elif msg.get("role") == "assistant":
+            bot_text = msg.get("content", "")
+    return slots
+
+
+def is_known(slots: dict, name: str) -> bool:
+    return bool(slots) and slots.get(name) is not None
+
+
+def format_budget(budget: dict) -> str:
+    low, high = budget.get("min"), budget.get("max")
+    number = lambda v: f"{v:g}"
+    if low and high:
+        return f"{number(low)}–{number(high)} млн"
+    return f"до {number(high)} млн" if high else f"от {number(low)} млн"
+
+
+def format_slot(name: str, value) -> str:
+    if value is None:
+        return "?"
+    if name == "location" and isinstance(value, list):
+        return ", ".join(value)
+    if name == "budget" and isinstance(value, dict):
+        return format_budget(value)
+    return str(value)
+
+
+def slot_summary(slots: dict) -> str:
+    """Одна строка для промпта: "цель: для себя; локация: Сочи; бюджет: до 15 млн; оплата: ?; сроки: ?" """
+    slots = slots or empty_slots()
+    return "; ".join(f"{SLOT_LABELS[name]}: {format_slot(name, slots.get(name))}" for name in SLOT_NAMES)
+
+
+def missing_slots(slots: dict) -> str:
+    """Что ещё не выяснено — для инструкций правил ("бюджет, сроки")"""
+    missing = [SLOT_LABELS[name] for name in SLOT_NAMES if not is_known(slots, name)]
+    return ", ".join(missing) if missing else "всё известно"
@@ -8,10 +8,21 @@ import sqlite3
 import json
 import os
 import shutil
+import hashlib
+import html
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from openai import OpenAI
 import requests
 
+from prompt_patch import (
+    PatchError, apply_edits, extract_edits, make_diff, section_names, stamp_header, validate_prompt_source
+)
+from fts_search import find_chat_ids
+
 # ══════════════════════════════════════════════════════════════
 # НАСТРОЙКИ
 # ══════════════════════════════════════════════════════════════
@@ -32,6 +43,35 @@ MIN_FEEDBACK_COUNT = 1
 # Модель для анализа
 ANALYZER_MODEL = "gpt-5.2"
 
+# Режим анализа: single — один большой запрос, mapreduce — чанки + сводка,
+# auto — mapreduce только если вход не влезает в MAX_SINGLE_TOKENS
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "auto")
+MAX_SINGLE_TOKENS = 60000   # Порог для одного запроса (с запасом до окна модели)
+CHUNK_TOKENS = 15000        # Размер одного чанка диалогов+оценок
+ANALYZER_WORKERS = 4        # Параллельных запросов к API
+CHUNK_RETRIES = 2           # Повторы упавшего чанка
+CHARS_PER_TOKEN = 3         # Грубая оценка: кириллица плотнее латиницы
+
+# Правки промпта: не больше стольких операций за запуск
+MAX_PROMPT_EDITS = 8
+
+# Как доставить новый промпт в бот: hot (бот перечитывает файл сам) | restart (systemctl)
+BOT_RELOAD_MODE = os.environ.get("BOT_RELOAD_MODE", "hot")
+
+# Регрессия перед деплоем: прогон кандидата на сохранённых диалогах (scripts/replay_prompt.py).
+# REPLAY_CASSETTE — кассета с ответами модели; без неё гейт выключен.
+REPLAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts", "replay_prompt.py")
+REPLAY_CASSETTE = os.environ.get("REPLAY_CASSETTE")
+REPLAY_DB = os.environ.get("REPLAY_DB", DB_PATH)
+REPLAY_DIALOGS = int(os.environ.get("REPLAY_DIALOGS", "50"))
+# Ответы кассеты привязаны к промпту: ответов кандидата в ней ещё нет, их пишем с модели (1).
+# 0 — строго офлайн: промахи кассеты не дают пройти гейт ("кандидат не проверен")
+REPLAY_RECORD = os.environ.get("REPLAY_RECORD", "1") == "1"
+
+# Анализ по теме: только диалоги, где встречается запрос (полнотекстовый индекс fts_search.py),
+# например ANALYZER_FOCUS="рассрочка" — разобрать, как София отвечает про рассрочку
+ANALYZER_FOCUS = os.environ.get("ANALYZER_FOCUS", "")
+
 # ══════════════════════════════════════════════════════════════
 # ИНИЦИАЛИЗАЦИЯ
 # ══════════════════════════════════════════════════════════════
@@ -40,12 +80,16 @@ ANALYZER_MODEL = "gpt-5.2"
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
-# Уникальный ID запуска
-RUN_ID = datetime.now().strftime("%Y%m%d_%H%M%S")
+# Уникальный ID запуска.
+# Чтобы продолжить упавший запуск: ANALYZER_RUN_ID=20251229_220000 python sofia_analyzer.py
+# (готовые чанки берутся из кэша RUN_DIR/chunks)
+RUN_ID = os.environ.get("ANALYZER_RUN_ID") or datetime.now().strftime("%Y%m%d_%H%M%S")
 RUN_DIR = os.path.join(LOGS_DIR, RUN_ID)
+CHUNKS_DIR = os.path.join(RUN_DIR, "chunks")
 os.makedirs(RUN_DIR, exist_ok=True)
 
 client = None
+_log_lock = threading.Lock()
 
 
 def init_openai():
@@ -61,11 +105,12 @@ def log(message, also_print=True):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     line = f"[{timestamp}] {message}"
     
-    if also_print:
-        print(line)
-    
-    with open(os.path.join(RUN_DIR, "run.log"), "a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    with _log_lock:
+        if also_print:
+            print(line)
+        
+        with open(os.path.join(RUN_DIR, "run.log"), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
 
 
 def save_to_file(filename, content):
@@ -99,6 +144,27 @@ def send_telegram(message, parse_mode="HTML"):
         log(f"❌ Telegram exception: {e}")
 
 
+def escape_clip(text, limit, tail=False):
+    """
+    html.escape, потом обрезка до limit символов уже экранированного текста (кавычки и < при экранировании
+    длиннее) — не посреди сущности (&quot;). tail=True — оставляем конец (итог отчёта внизу).
+    """
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    if tail:
+        cut = escaped[len(escaped) - limit + 4:]
+        semi = cut.find(";", 0, 6)
+        if semi != -1 and "&" not in cut[:semi]:
+            cut = cut[semi + 1:]
+        return "...\n" + cut
+    cut = escaped[:limit - 4]
+    amp = cut.rfind("&", len(cut) - 6)
+    if amp != -1 and ";" not in cut[amp:]:
+        cut = cut[:amp]
+    return cut + "\n..."
+
+
 def send_telegram_file(filepath, caption=""):
     """Отправка файла в Telegram"""
     try:
@@ -147,22 +213,26 @@ def get_new_data():
     
     last_time = get_last_analysis_time()
     
+    # Старые базы (до миграции бота) ещё без ссылок на id сообщений
+    c.execute('PRAGMA table_info(feedback_v2)')
+    range_columns = "msg_from_id, msg_to_id" if "msg_from_id" in {row[1] for row in c.fetchall()} else "NULL, NULL"
+    
     if last_time:
         log(f"📅 Последний анализ: {last_time}")
         log(f"📥 Берём данные ПОСЛЕ {last_time}")
         
         # Сообщения после последнего анализа
         c.execute('''
-            SELECT chat_id, user_name, role, content, timestamp 
+            SELECT chat_id, user_name, role, content, timestamp, id 
             FROM messages 
             WHERE timestamp > ?
-            ORDER BY chat_id, timestamp
+            ORDER BY chat_id, timestamp, id
         ''', (last_time,))
         messages = c.fetchall()
         
         # Feedback после последнего анализа
-        c.execute('''
-            SELECT expert_name, rating, comment, context, timestamp 
+        c.execute(f'''
+            SELECT expert_name, rating, comment, context, timestamp, chat_id, {range_columns} 
             FROM feedback_v2 
             WHERE timestamp > ?
             ORDER BY timestamp
@@ -173,36 +243,85 @@ def get_new_data():
         
         # Все сообщения
         c.execute('''
-            SELECT chat_id, user_name, role, content, timestamp 
+            SELECT chat_id, user_name, role, content, timestamp, id 
             FROM messages 
-            ORDER BY chat_id, timestamp
+            ORDER BY chat_id, timestamp, id
         ''')
         messages = c.fetchall()
         
         # Все feedback
-        c.execute('''
-            SELECT expert_name, rating, comment, context, timestamp 
+        c.execute(f'''
+            SELECT expert_name, rating, comment, context, timestamp, chat_id, {range_columns} 
             FROM feedback_v2 
             ORDER BY timestamp
         ''')
         feedback = c.fetchall()
     
+    feedback = resolve_feedback(c, messages, feedback)
     conn.close()
     
+    if ANALYZER_FOCUS:
+        chat_ids = find_chat_ids(DB_PATH, ANALYZER_FOCUS)
+        messages = [m for m in messages if m[0] in chat_ids]
+        feedback = [f for f in feedback if f[5] in chat_ids]
+        log(f"🔎 Фокус «{ANALYZER_FOCUS}»: диалогов {len(chat_ids)}")
+    
     log(f"📊 Загружено: {len(messages)} сообщений, {len(feedback)} оценок")
     return messages, feedback
 
 
+def resolve_feedback(c, messages, feedback):
+    """
+    Приводим оценки к виду (expert, rating, comment, context, timestamp, chat_id, from_id, to_id),
+    где context — список сообщений.
+    Новые записи хранят только диапазон id — контекст берём из загруженных сообщений или базы.
+    Старые записи хранят JSON-копию — находим те же сообщения в диалогах и проставляем id,
+    чтобы в промпте сослаться на них, а не повторять текст.
+    """
+    by_id = {m[5]: m for m in messages}
+    by_chat = {}
+    for m in messages:
+        by_chat.setdefault(m[0], []).append(m)
+    
+    resolved = []
+    for expert, rating, comment, context, timestamp, chat_id, from_id, to_id in feedback:
+        ctx = []
+        if from_id is not None and not context:
+            ids = range(from_id, to_id + 1)
+            loaded = [by_id[i] for i in ids if i in by_id and by_id[i][0] == chat_id]
+            if loaded and loaded[0][5] == from_id and loaded[-1][5] == to_id:
+                ctx = [{"role": m[2], "content": m[3], "time": m[4]} for m in loaded]
+            else:
+                c.execute('SELECT role, content, timestamp FROM messages WHERE chat_id = ? AND id BETWEEN ? AND ? ORDER BY id',
+                          (chat_id, from_id, to_id))
+                ctx = [{"role": r[0], "content": r[1], "time": r[2]} for r in c.fetchall()]
+        else:
+            try:
+                ctx = json.loads(context) if context else []
+            except ValueError:
+                ctx = []
+            wanted = [(m.get("role"), m.get("content")) for m in ctx]
+            history = by_chat.get(chat_id, [])
+            for start in range(len(history) - len(wanted) + 1) if wanted else ():
+                window = history[start:start + len(wanted)]
+                if [(h[2], h[3]) for h in window] == wanted:
+                    from_id, to_id = window[0][5], window[-1][5]
+                    break
+        resolved.append((expert, rating, comment, ctx, timestamp, chat_id, from_id, to_id))
+    return resolved
+
+
 def format_dialogs(messages):
-    """Форматируем диалоги"""
+    """Форматируем диалоги (у каждой реплики — #id, на них ссылаются оценки)"""
     if not messages:
         return "Нет диалогов."
     
     dialogs = {}
-    for chat_id, user_name, role, content, timestamp in messages:
+    for chat_id, user_name, role, content, timestamp, msg_id in messages:
         if chat_id not in dialogs:
             dialogs[chat_id] = {"user": user_name or "Unknown", "messages": []}
         dialogs[chat_id]["messages"].append({
+            "id": msg_id,
             "role": role,
             "content": content,
             "time": timestamp
@@ -215,20 +334,24 @@ def format_dialogs(messages):
         result.append('='*50)
         for m in data["messages"]:
             role = "🤖 СОФИЯ" if m["role"] == "assistant" else "👤 КЛИЕНТ"
-            result.append(f"[{m['time']}] {role}:")
+            result.append(f"#{m['id']} [{m['time']}] {role}:")
             result.append(f"   {m['content']}")
             result.append("")
     
     return "\n".join(result)
 
 
-def format_feedback(feedback):
-    """Форматируем оценки"""
+def format_feedback(feedback, shown_ids=None):
+    """
+    Форматируем оценки.
+    Если реплики контекста уже есть в ДИАЛОГАХ (shown_ids) — ссылаемся на #id вместо повтора текста.
+    """
     if not feedback:
         return "Нет оценок экспертов."
     
+    shown_ids = shown_ids or set()
     result = []
-    for expert, rating, comment, context, timestamp in feedback:
+    for expert, rating, comment, ctx, timestamp, chat_id, from_id, to_id in feedback:
         emoji = "✅ GOOD" if rating == "good" else "❌ BAD"
         result.append(f"\n{'─'*50}")
         result.append(f"{emoji} | Эксперт: {expert} | {timestamp}")
@@ -238,21 +361,48 @@ def format_feedback(feedback):
             result.append(f"💬 КОММЕНТАРИЙ: {comment}")
         
         # Контекст диалога
-        try:
-            ctx = json.loads(context)
+        if from_id is not None and from_id in shown_ids and to_id in shown_ids:
+            result.append(f"📝 Контекст: chat_id {chat_id}, реплики #{from_id}–#{to_id} (см. ДИАЛОГИ)")
+        elif ctx:
             result.append("\n📝 Контекст диалога:")
             for m in ctx:
-                role = "София" if m["role"] == "assistant" else "Клиент"
-                content = m["content"][:150] + "..." if len(m["content"]) > 150 else m["content"]
+                role = "София" if m.get("role") == "assistant" else "Клиент"
+                content = m.get("content") or ""
+                content = content[:150] + "..." if len(content) > 150 else content
                 result.append(f"   {role}: {content}")
-        except:
-            pass
         
         result.append("")
     
     return "\n".join(result)
 
 
+def get_feedback_storage_stats():
+    """Сколько байт занимает контекст оценок в базе и сколько бы занимали JSON-копии"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('PRAGMA table_info(feedback_v2)')
+    if "msg_from_id" not in {row[1] for row in c.fetchall()}:
+        conn.close()
+        return None
+    
+    c.execute('SELECT chat_id, context, msg_from_id, msg_to_id FROM feedback_v2')
+    rows = c.fetchall()
+    stored, as_copies, referenced = 0, 0, 0
+    for chat_id, context, from_id, to_id in rows:
+        stored += len((context or "").encode("utf-8"))
+        if from_id is not None and not context:
+            referenced += 1
+            stored += 16  # два INTEGER
+            c.execute('SELECT role, content, timestamp FROM messages WHERE chat_id = ? AND id BETWEEN ? AND ? ORDER BY id',
+                      (chat_id, from_id, to_id))
+            ctx = [{"role": r[0], "content": r[1], "time": r[2]} for r in c.fetchall()]
+            as_copies += len(json.dumps(ctx, ensure_ascii=False).encode("utf-8"))
+        else:
+            as_copies += len((context or "").encode("utf-8"))
+    conn.close()
+    return {"rows": len(rows), "referenced": referenced, "stored": stored, "as_copies": as_copies}
+
+
 def get_current_prompt():
     """Читаем текущий промпт"""
     with open(PROMPT_PATH, "r", encoding="utf-8") as f:
@@ -263,31 +413,11 @@ def get_current_prompt():
 # АНАЛИЗ GPT
 # ══════════════════════════════════════════════════════════════
 
-def build_analysis_prompt(dialogs_text, feedback_text, current_prompt):
-    """Собираем промпт для анализа"""
+def build_task_block(current_prompt):
+    """Общая часть задания: что проанализировать и в каком формате ответить"""
+    sections = "\n".join(f"   - {name}" for name in section_names(current_prompt))
     
-    return f"""Ты — эксперт по продажам недвижимости и промпт-инженер.
-
-Твоя задача: проанализировать диалоги AI-продажника "София" и предложить улучшения в промпт.
-
-══════════════════════════════════════════════════════════════
-ДИАЛОГИ
-══════════════════════════════════════════════════════════════
-{dialogs_text}
-
-══════════════════════════════════════════════════════════════
-ОЦЕНКИ ЭКСПЕРТОВ (менеджеров по продажам)
-══════════════════════════════════════════════════════════════
-{feedback_text}
-
-══════════════════════════════════════════════════════════════
-ТЕКУЩИЙ ПРОМПТ СОФИИ
-══════════════════════════════════════════════════════════════
-```python
-{current_prompt}
-```
-
-══════════════════════════════════════════════════════════════
+    return f"""══════════════════════════════════════════════════════════════
 ТВОЯ ЗАДАЧА
 ══════════════════════════════════════════════════════════════
 
@@ -302,16 +432,23 @@ def build_analysis_prompt(dialogs_text, feedback_text, current_prompt):
    - В какую секцию промпта
    - Пример как это должно работать
 
-5. **НОВЫЙ ПРОМПТ**: Выдай ПОЛНЫЙ обновлённый файл sofia_prompt.py
-   - Добавь в начало комментарий: # Обновлено: {datetime.now().strftime("%Y-%m-%d")} автоанализом
-   - Сохрани ВСЮ структуру и функции
-   - Внеси ТОЛЬКО необходимые улучшения для исправления BAD кейсов
-   - НЕ удаляй то что работает (GOOD)
+5. **ПРАВКИ ПРОМПТА**: НЕ переписывай файл целиком. Выдай JSON со списком правок (не больше {MAX_PROMPT_EDITS}).
+   Секции (поле "section" — точное имя из списка):
+{sections}
+
+   Операции:
+   - {{"op": "add", "section": "...", "after": "<фрагмент строки, после которой вставить; можно опустить — в конец секции>", "text": "<новые строки>", "why": "<какую BAD проблему решает>"}}
+   - {{"op": "replace", "section": "...", "old": "<уникальный фрагмент заменяемой строки>", "new": "<новая строка>", "why": "..."}}
+   - {{"op": "delete", "section": "...", "old": "<уникальный фрагмент удаляемой строки>", "why": "..."}}
+   - {{"op": "add_section", "after_section": "...", "title": "<ЗАГОЛОВОК ЗАГЛАВНЫМИ>", "text": "<строки секции>", "why": "..."}}
+
+   Фрагменты "old"/"after" копируй дословно из текущего промпта, они должны встречаться в секции один раз.
+   Строки с подстановками в фигурных скобках ({{client_name}}, {{PRICE_CATALOG}} и т.п.) не трогай.
 
 ВАЖНО: 
 - Минимальные точечные изменения
 - Каждое изменение должно решать конкретную проблему из BAD
-- Сохрани весь рабочий код
+- НЕ удаляй то что работает (GOOD)
 
 ══════════════════════════════════════════════════════════════
 ФОРМАТ ОТВЕТА
@@ -329,13 +466,40 @@ def build_analysis_prompt(dialogs_text, feedback_text, current_prompt):
 ## 💡 РЕШЕНИЯ
 (конкретные изменения)
 
-## 📝 НОВЫЙ ПРОМПТ
-```python
-(полный код файла sofia_prompt.py)
+## 📝 ПРАВКИ ПРОМПТА
+```json
+{{"edits": [ ... ]}}
 ```
 """
 
 
+def build_analysis_prompt(dialogs_text, feedback_text, current_prompt):
+    """Собираем промпт для анализа"""
+    
+    return f"""Ты — эксперт по продажам недвижимости и промпт-инженер.
+
+Твоя задача: проанализировать диалоги AI-продажника "София" и предложить улучшения в промпт.
+
+══════════════════════════════════════════════════════════════
+ДИАЛОГИ
+══════════════════════════════════════════════════════════════
+{dialogs_text}
+
+══════════════════════════════════════════════════════════════
+ОЦЕНКИ ЭКСПЕРТОВ (менеджеров по продажам)
+══════════════════════════════════════════════════════════════
+{feedback_text}
+
+══════════════════════════════════════════════════════════════
+ТЕКУЩИЙ ПРОМПТ СОФИИ
+══════════════════════════════════════════════════════════════
+```python
+{current_prompt}
+```
+
+{build_task_block(current_prompt)}"""
+
+
 def call_gpt_analysis(analysis_prompt):
     """Отправляем на анализ"""
     log(f"🧠 Отправляем в {ANALYZER_MODEL}...")
@@ -357,29 +521,274 @@ def call_gpt_analysis(analysis_prompt):
         return None
 
 
+# ══════════════════════════════════════════════════════════════
+# MAP-REDUCE (большие объёмы)
+# ══════════════════════════════════════════════════════════════
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов"""
+    return len(text) // CHARS_PER_TOKEN
+
+
+def build_units(messages, feedback):
+    """
+    Режем данные на неделимые куски: диалог чата + оценки по этому чату.
+    Диалог длиннее CHUNK_TOKENS режется по сообщениям.
+    """
+    by_chat = {}
+    for m in messages:
+        by_chat.setdefault(m[0], {"messages": [], "feedback": []})["messages"].append(m)
+    for fb in feedback:
+        by_chat.setdefault(fb[5], {"messages": [], "feedback": []})["feedback"].append(fb)
+    
+    units = []
+    for chat_id, data in by_chat.items():
+        parts = [[]]
+        size = 0
+        for m in data["messages"]:
+            m_size = estimate_tokens(m[3] or "") + 20
+            if parts[-1] and size + m_size > CHUNK_TOKENS:
+                parts.append([])
+                size = 0
+            parts[-1].append(m)
+            size += m_size
+        
+        # Оценку кладём в ту часть, где лежат её реплики — тогда хватит ссылки на #id
+        part_ids = [{m[5] for m in part} for part in parts]
+        part_feedback = [[] for _ in parts]
+        for fb in data["feedback"]:
+            target = next((i for i, ids in enumerate(part_ids) if fb[7] in ids), 0)
+            part_feedback[target].append(fb)
+        
+        for part, ids, fbs in zip(parts, part_ids, part_feedback):
+            units.append({
+                "chat_id": chat_id,
+                "dialogs_text": format_dialogs(part) if part else "",
+                "feedback_text": format_feedback(fbs, ids) if fbs else "",
+                "feedback_count": len(fbs),
+            })
+    return units
+
+
+def pack_chunks(units):
+    """Жадно упаковываем куски в чанки не больше CHUNK_TOKENS"""
+    chunks = []
+    current, size = [], 0
+    for unit in units:
+        unit_size = estimate_tokens(unit["dialogs_text"]) + estimate_tokens(unit["feedback_text"])
+        if current and size + unit_size > CHUNK_TOKENS:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(unit)
+        size += unit_size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_chunk_prompt(chunk, index, total):
+    """Map-шаг: промпт для анализа одной части данных (без текущего промпта)"""
+    dialogs_text = "\n".join(u["dialogs_text"] for u in chunk if u["dialogs_text"]) or "Нет диалогов."
+    feedback_text = "\n".join(u["feedback_text"] for u in chunk if u["feedback_text"]) or "Нет оценок экспертов."
+    
+    return f"""Ты — эксперт по продажам недвижимости.
+
+Перед тобой часть {index} из {total} данных по AI-продажнику "София".
+Другие части анализируются отдельно, потом выводы будут объединены.
+
+══════════════════════════════════════════════════════════════
+ДИАЛОГИ
+══════════════════════════════════════════════════════════════
+{dialogs_text}
+
+══════════════════════════════════════════════════════════════
+ОЦЕНКИ ЭКСПЕРТОВ (менеджеров по продажам)
+══════════════════════════════════════════════════════════════
+{feedback_text}
+
+══════════════════════════════════════════════════════════════
+ТВОЯ ЗАДАЧА
+══════════════════════════════════════════════════════════════
+
+Выпиши только факты из ЭТОЙ части, коротко:
+
+## ✅ ЧТО РАБОТАЕТ
+(паттерны из GOOD оценок, с chat_id)
+
+## ❌ ПРОБЛЕМЫ
+(ошибки Софии из BAD оценок и диалогов, с дословными цитатами экспертов и chat_id)
+
+## 💡 ИДЕИ ПРАВОК
+(какое правило/фразу добавить в промпт и почему)
+
+Не переписывай промпт. Не больше 40 строк.
+"""
+
+
+def build_merge_prompt(findings):
+    """Промежуточная свёртка, если выводов слишком много для reduce"""
+    joined = "\n\n".join(findings)
+    return f"""Ниже выводы анализа нескольких частей диалогов AI-продажника "София".
+Объедини их: убери повторы, сохрани цитаты экспертов и chat_id, частые проблемы — выше.
+Используй те же разделы: ## ✅ ЧТО РАБОТАЕТ, ## ❌ ПРОБЛЕМЫ, ## 💡 ИДЕИ ПРАВОК. Не больше 60 строк.
+
+{joined}
+"""
+
+
+def build_reduce_prompt(findings, feedback, current_prompt):
+    """Reduce-шаг: сводим выводы частей и просим правки промпта"""
+    good = sum(1 for fb in feedback if fb[1] == "good")
+    bad = sum(1 for fb in feedback if fb[1] == "bad")
+    total = good + bad
+    rate = (good / total * 100) if total else 0
+    findings_text = "\n\n".join(f"─── Часть {i} ───\n{text}" for i, text in enumerate(findings, 1))
+    
+    return f"""Ты — эксперт по продажам недвижимости и промпт-инженер.
+
+Твоя задача: по выводам анализа диалогов AI-продажника "София" предложить улучшения в промпт.
+Диалоги были слишком большими для одного запроса, поэтому их проанализировали по частям.
+
+══════════════════════════════════════════════════════════════
+СТАТИСТИКА ОЦЕНОК (посчитано кодом)
+══════════════════════════════════════════════════════════════
+GOOD: {good}, BAD: {bad}, успех: {rate:.0f}%
+
+══════════════════════════════════════════════════════════════
+ВЫВОДЫ ПО ЧАСТЯМ
+══════════════════════════════════════════════════════════════
+{findings_text}
+
+══════════════════════════════════════════════════════════════
+ТЕКУЩИЙ ПРОМПТ СОФИИ
+══════════════════════════════════════════════════════════════
+```python
+{current_prompt}
+```
+
+{build_task_block(current_prompt)}"""
+
+
+def call_cached(name, prompt):
+    """
+    Запрос к модели с кэшем в RUN_DIR/chunks.
+    Кэш привязан к хэшу входа — если данные поменялись, чанк пересчитается.
+    """
+    os.makedirs(CHUNKS_DIR, exist_ok=True)
+    cache_path = os.path.join(CHUNKS_DIR, f"{name}.json")
+    prompt_hash = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+    
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("hash") == prompt_hash and cached.get("result"):
+                log(f"♻️ {name}: взят из кэша")
+                return cached["result"]
+        except (OSError, ValueError):
+            pass
+    
+    with open(os.path.join(CHUNKS_DIR, f"{name}_input.txt"), "w", encoding="utf-8") as f:
+        f.write(prompt)
+    
+    result = None
+    for attempt in range(1 + CHUNK_RETRIES):
+        result = call_gpt_analysis(prompt)
+        if result:
+            break
+        log(f"⚠️ {name}: попытка {attempt + 1} не удалась")
+    
+    if result:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"hash": prompt_hash, "result": result}, f, ensure_ascii=False)
+    return result
+
+
+def map_prompts(prompts, prefix):
+    """Параллельно прогоняем промпты через пул (ANALYZER_WORKERS), порядок сохраняется"""
+    names = [f"{prefix}_{i:03d}" for i in range(1, len(prompts) + 1)]
+    with ThreadPoolExecutor(max_workers=ANALYZER_WORKERS) as pool:
+        results = list(pool.map(call_cached, names, prompts))
+    
+    failed = [name for name, r in zip(names, results) if not r]
+    if failed:
+        raise RuntimeError(
+            f"Не обработаны чанки: {', '.join(failed)}. "
+            f"Перезапусти с ANALYZER_RUN_ID={RUN_ID} — готовые чанки возьмутся из кэша"
+        )
+    return results
+
+
+def run_map_reduce(messages, feedback, current_prompt):
+    """Map: анализ чанков параллельно → (свёртка) → Reduce: правки промпта"""
+    chunks = pack_chunks(build_units(messages, feedback))
+    log(f"🧩 Map-reduce: {len(chunks)} чанков по ≤{CHUNK_TOKENS} токенов, воркеров: {ANALYZER_WORKERS}")
+    
+    prompts = [build_chunk_prompt(chunk, i, len(chunks)) for i, chunk in enumerate(chunks, 1)]
+    findings = map_prompts(prompts, "chunk")
+    
+    # Если выводов много — сворачиваем их группами, пока не влезут в один запрос
+    level = 1
+    while len(findings) > 1 and estimate_tokens("\n\n".join(findings)) > MAX_SINGLE_TOKENS // 2:
+        groups, group, size = [], [], 0
+        for text in findings:
+            if group and size + estimate_tokens(text) > CHUNK_TOKENS:
+                groups.append(group)
+                group, size = [], 0
+            group.append(text)
+            size += estimate_tokens(text)
+        groups.append(group)
+        if len(groups) == len(findings):
+            # Каждый вывод больше CHUNK_TOKENS — дальше сворачивать нечего
+            break
+        log(f"🧩 Свёртка уровня {level}: {len(findings)} → {len(groups)}")
+        findings = map_prompts([build_merge_prompt(g) for g in groups], f"merge{level}")
+        level += 1
+    
+    save_to_file("04_chunk_findings.txt", "\n\n".join(findings))
+    reduce_prompt = build_reduce_prompt(findings, feedback, current_prompt)
+    save_to_file("04_gpt_input.txt", reduce_prompt)
+    log(f"   Reduce: {len(reduce_prompt)} символов (~{estimate_tokens(reduce_prompt)} токенов)")
+    return call_cached("reduce", reduce_prompt)
+
+
 # ══════════════════════════════════════════════════════════════
 # ОБРАБОТКА РЕЗУЛЬТАТА
 # ══════════════════════════════════════════════════════════════
 
-def extract_new_prompt(analysis_result):
-    """Извлекаем новый промпт из ответа"""
+def build_new_prompt(analysis_result, current_prompt):
+    """
+    Достаём правки из ответа и применяем их к текущему промпту.
+    Возвращает (новый промпт, правки, ошибка).
+    """
     if not analysis_result:
-        return None
+        return None, None, "Пустой ответ"
     
-    import re
+    edits = extract_edits(analysis_result)
+    if edits is None:
+        log("⚠️ Не удалось извлечь правки из ответа")
+        return None, None, "Нет JSON с правками"
     
-    # Ищем код между ```python и ```
-    matches = re.findall(r'```python\n(.*?)```', analysis_result, re.DOTALL)
-    
-    if matches:
-        # Ищем тот который содержит нужные функции
-        for match in reversed(matches):
-            if "def get_system_prompt" in match and "def get_time_context" in match:
-                log(f"✅ Найден валидный промпт: {len(match)} символов")
-                return match
+    log(f"✅ Найдено правок: {len(edits)}")
+    try:
+        new_prompt = apply_edits(current_prompt, edits, MAX_PROMPT_EDITS)
+    except PatchError as e:
+        log(f"❌ Правки не применились: {e}")
+        return None, edits, str(e)
     
-    log("⚠️ Не удалось извлечь промпт из ответа")
-    return None
+    new_prompt = stamp_header(new_prompt, f"{datetime.now().strftime('%Y-%m-%d')} автоанализом (правок: {len(edits)})")
+    return new_prompt, edits, None
+
+
+def format_edits(edits):
+    """Список правок с причинами — для Telegram"""
+    lines = []
+    for n, edit in enumerate(edits, 1):
+        where = edit.get("section") or edit.get("title") or "?"
+        lines.append(f"{n}. {edit.get('op')} → {where}")
+        if edit.get("why"):
+            lines.append(f"   {edit['why']}")
+    return "\n".join(lines)
 
 
 def extract_analysis_summary(analysis_result):
@@ -387,8 +796,8 @@ def extract_analysis_summary(analysis_result):
     if not analysis_result:
         return "Анализ не выполнен"
     
-    # Берём всё до "## 📝 НОВЫЙ ПРОМПТ"
-    parts = analysis_result.split("## 📝 НОВЫЙ ПРОМПТ")
+    # Берём всё до "## 📝 ПРАВКИ ПРОМПТА"
+    parts = analysis_result.split("## 📝 ПРАВКИ ПРОМПТА")
     if len(parts) > 1:
         return parts[0].strip()
     
@@ -397,20 +806,30 @@ def extract_analysis_summary(analysis_result):
 
 
 def validate_prompt(new_prompt):
-    """Проверяем валидность Python"""
-    try:
-        compile(new_prompt, '<string>', 'exec')
-        
-        if "def get_system_prompt" not in new_prompt:
-            return False, "Нет функции get_system_prompt"
-        if "def get_time_context" not in new_prompt:
-            return False, "Нет функции get_time_context"
-        if "COMPANY" not in new_prompt:
-            return False, "Нет переменной COMPANY"
-            
-        return True, "OK"
-    except SyntaxError as e:
-        return False, f"Синтаксическая ошибка: {e}"
+    """Проверяем что файл компилируется, загружается и собирает промпт"""
+    return validate_prompt_source(new_prompt)
+
+
+def replay_gate(prompt_file):
+    """Прогон кандидата через replay_prompt.py. Возвращает (прошёл, хвост отчёта)."""
+    if not REPLAY_CASSETTE:
+        log("⏭️ Регрессия пропущена (REPLAY_CASSETTE не задан)")
+        return True, ""
+    
+    report_path = os.path.join(RUN_DIR, "07_replay.json")
+    cmd = [
+        sys.executable, REPLAY_SCRIPT,
+        "--db", REPLAY_DB, "--prompt", prompt_file,
+        "--cassette", REPLAY_CASSETTE, "-n", str(REPLAY_DIALOGS),
+        "--report", report_path,
+    ]
+    if REPLAY_RECORD:
+        cmd.append("--record")
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    output = (result.stdout + result.stderr).strip()
+    save_to_file("07_replay.txt", output)
+    log(f"🧪 Регрессия: код {result.returncode}")
+    return result.returncode == 0, output[-1500:]
 
 
 def backup_current_prompt():
@@ -431,14 +850,24 @@ def backup_current_prompt():
 
 
 def apply_new_prompt(new_prompt):
-    """Применяем новый промпт"""
-    with open(PROMPT_PATH, "w", encoding="utf-8") as f:
+    """Применяем новый промпт (атомарно — бот следит за файлом и не должен увидеть его наполовину)"""
+    tmp_path = PROMPT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         f.write(new_prompt)
+    os.replace(tmp_path, PROMPT_PATH)
     log("✅ Новый промпт записан")
 
 
 def restart_bot():
-    """Перезапуск бота"""
+    """
+    Доставка промпта в бот.
+    hot — бот сам перечитывает sofia_prompt.py (hot_reload), рестарт не нужен;
+    restart — старое поведение через systemctl.
+    """
+    if BOT_RELOAD_MODE == "hot":
+        log("🔁 Бот подхватит промпт сам (горячая перезагрузка)")
+        return True
+    
     log("🔄 Перезапускаем sofia-bot...")
     result = os.system("systemctl restart sofia-bot")
     if result == 0:
@@ -480,9 +909,21 @@ def main():
         # 3. Форматирование
         log("\n[3/8] Форматирование данных...")
         dialogs_text = format_dialogs(messages)
-        feedback_text = format_feedback(feedback)
+        feedback_text = format_feedback(feedback, {m[5] for m in messages})
         current_prompt = get_current_prompt()
         
+        # Сколько сэкономила дедупликация: контекст оценок ссылками на #id вместо повтора
+        full_feedback_text = format_feedback(feedback)
+        saved_tokens = estimate_tokens(full_feedback_text) - estimate_tokens(feedback_text)
+        dedup_line = f"Оценки в промпте: ~{estimate_tokens(full_feedback_text)} → ~{estimate_tokens(feedback_text)} токенов (−{saved_tokens})"
+        log(f"📉 {dedup_line}")
+        storage = get_feedback_storage_stats()
+        if storage:
+            storage_line = (f"Контекст оценок в базе: {storage['stored']} байт вместо {storage['as_copies']} "
+                            f"(ссылками: {storage['referenced']}/{storage['rows']})")
+            log(f"📉 {storage_line}")
+            dedup_line += f"\n• {storage_line}"
+        
         # Сохраняем входные данные
         save_to_file("01_dialogs.txt", dialogs_text)
         save_to_file("02_feedback.txt", feedback_text)
@@ -491,12 +932,21 @@ def main():
         # 4. Сборка промпта для GPT
         log("\n[4/8] Сборка промпта для анализа...")
         analysis_prompt = build_analysis_prompt(dialogs_text, feedback_text, current_prompt)
-        save_to_file("04_gpt_input.txt", analysis_prompt)
-        log(f"   Размер: {len(analysis_prompt)} символов (~{len(analysis_prompt)//4} токенов)")
+        prompt_tokens = estimate_tokens(analysis_prompt)
+        log(f"   Размер: {len(analysis_prompt)} символов (~{prompt_tokens} токенов)")
+        
+        use_map_reduce = ANALYSIS_MODE == "mapreduce" or (
+            ANALYSIS_MODE == "auto" and prompt_tokens > MAX_SINGLE_TOKENS
+        )
         
         # 5. Отправка в GPT
-        log("\n[5/8] Отправка в GPT-5.1...")
-        analysis_result = call_gpt_analysis(analysis_prompt)
+        if use_map_reduce:
+            log(f"\n[5/8] Map-reduce анализ в {ANALYZER_MODEL}...")
+            analysis_result = run_map_reduce(messages, feedback, current_prompt)
+        else:
+            save_to_file("04_gpt_input.txt", analysis_prompt)
+            log(f"\n[5/8] Отправка в {ANALYZER_MODEL}...")
+            analysis_result = call_gpt_analysis(analysis_prompt)
         
         if not analysis_result:
             send_telegram("❌ <b>Ошибка</b>: GPT не вернул ответ")
@@ -505,17 +955,22 @@ def main():
         save_to_file("05_gpt_output.txt", analysis_result)
         
         # 6. Извлечение нового промпта
-        log("\n[6/8] Извлечение нового промпта...")
-        new_prompt = extract_new_prompt(analysis_result)
+        log("\n[6/8] Применение правок к промпту...")
+        new_prompt, edits, patch_error = build_new_prompt(analysis_result, current_prompt)
         analysis_summary = extract_analysis_summary(analysis_result)
         
+        if edits is not None:
+            save_to_file("06_edits.json", json.dumps(edits, ensure_ascii=False, indent=2))
+        
         if not new_prompt:
-            log("⚠️ Промпт не извлечён — сохраняем анализ для ручного просмотра")
-            send_telegram(f"⚠️ <b>Анализ завершён, но промпт не извлечён</b>\n\nСмотри логи: {RUN_DIR}")
+            log("⚠️ Промпт не обновлён — сохраняем анализ для ручного просмотра")
+            send_telegram(f"⚠️ <b>Анализ завершён, но правки не применены</b>\n\nПричина: {html.escape(patch_error)}\n\nСмотри логи: {RUN_DIR}")
             send_telegram_file(os.path.join(RUN_DIR, "05_gpt_output.txt"), "Ответ GPT")
             return
         
         save_to_file("06_new_prompt.py", new_prompt)
+        prompt_diff = make_diff(current_prompt, new_prompt)
+        save_to_file("06_prompt.diff", prompt_diff)
         
         # 7. Валидация
         log("\n[7/8] Валидация нового промпта...")
@@ -523,12 +978,19 @@ def main():
         
         if not valid:
             log(f"❌ Промпт невалидный: {error}")
-            send_telegram(f"❌ <b>Промпт невалидный</b>\n\nОшибка: {error}\n\nСмотри логи: {RUN_DIR}")
-            send_telegram_file(os.path.join(RUN_DIR, "06_new_prompt.py"), "Невалидный промпт")
+            send_telegram(f"❌ <b>Промпт невалидный</b>\n\nОшибка: {html.escape(error)}\n\nСмотри логи: {RUN_DIR}")
+            send_telegram_file(os.path.join(RUN_DIR, "06_prompt.diff"), "Невалидные правки")
             return
         
         log("✅ Промпт валидный")
         
+        passed, replay_output = replay_gate(os.path.join(RUN_DIR, "06_new_prompt.py"))
+        if not passed:
+            log("❌ Кандидат не прошёл регрессию — промпт не применён")
+            send_telegram(f"❌ <b>Кандидат не прошёл регрессию</b>\n\n<pre>{escape_clip(replay_output, 3000, tail=True)}</pre>\n\nСмотри логи: {RUN_DIR}")
+            send_telegram_file(os.path.join(RUN_DIR, "06_prompt.diff"), "Отклонённые правки")
+            return
+        
         # 8. Применение
         log("\n[8/8] Применение изменений...")
         backup_path = backup_current_prompt()
@@ -547,11 +1009,13 @@ def main():
 • Диалогов: {len(set(m[0] for m in messages))}
 • Сообщений: {len(messages)}
 • Оценок: {len(feedback)}
+• Режим: {'map-reduce' if use_map_reduce else 'один запрос'}
+• {dedup_line}
 
 💾 <b>Файлы:</b>
 • Бэкап: создан
-• Новый промпт: применён
-• Бот: {'✅ перезапущен' if bot_restarted else '⚠️ требует ручного перезапуска'}
+• Правки промпта: {len(edits)} применено
+• Бот: {('✅ подхватит без рестарта' if BOT_RELOAD_MODE == 'hot' else '✅ перезапущен') if bot_restarted else '⚠️ требует ручного перезапуска'}
 
 📁 <b>Логи:</b> {RUN_DIR}
 
@@ -559,10 +1023,13 @@ def main():
 {analysis_summary[:1500]}..."""
         
         send_telegram(final_message)
+        # Diff режем сами (после экранирования), чтобы не оборвать <pre> на лимите Telegram
+        edits_message = f"📝 <b>Правки промпта</b>\n\n{escape_clip(format_edits(edits), 1500)}\n\n"
+        send_telegram(f"{edits_message}<pre>{escape_clip(prompt_diff, 3500 - len(edits_message))}</pre>")
         
         # Отправляем файлы
         send_telegram_file(os.path.join(RUN_DIR, "05_gpt_output.txt"), "📄 Полный ответ GPT")
-        send_telegram_file(os.path.join(RUN_DIR, "06_new_prompt.py"), "📄 Новый промпт")
+        send_telegram_file(os.path.join(RUN_DIR, "06_prompt.diff"), "📄 Diff промпта")
         
     except Exception as e:
         error_msg = f"❌ <b>КРИТИЧЕСКАЯ ОШИБКА</b>\n\n{type(e).__name__}: {e}"
@@ -6,6 +6,13 @@ from openai import OpenAI
 import re
 import os
 
+from hot_reload import HYBRID_PATTERN_NAMES, compile_patterns, parse_fuzzy_names
+from decision_rules import RuleSet, load_rules_file
+from intent_model import INTENT_PATTERNS, IntentModel, parse_thresholds
+from price_catalog import current_catalog, pinned_catalog
+from slots import SLOT_NAMES, is_known, missing_slots, slot_summary, slots_from_history, update_slots
+from text_normalize import normalize_text
+
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 MODEL_MODE = os.getenv("MODEL_MODE", "gpt-5.2")
@@ -32,8 +39,71 @@ MODEL_CONFIGS = {
     }
 }
 
-def get_model_config():
-    return MODEL_CONFIGS.get(MODEL_MODE, MODEL_CONFIGS["gpt-5.2"])
+def get_model_config(mode: str = None):
+    return MODEL_CONFIGS.get(mode or MODEL_MODE, MODEL_CONFIGS["gpt-5.2"])
+
+# Списки с нечётким поиском (опечатки): FUZZY_PATTERNS=SEND,CALL_REJECT или all; пусто — только точный
+FUZZY_PATTERNS = parse_fuzzy_names(os.getenv("FUZZY_PATTERNS", ""))
+
+# Классификатор намерений (scripts/train_intents.py): patterns — только списки, model — только модель,
+# both — срабатывает любой из двух. Пороги из файла модели можно переопределить: INTENT_THRESHOLDS=irritated=0.6
+INTENT_MODE = os.getenv("INTENT_MODE", "patterns")
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_model.bin"))
+
+
+def load_intent_model():
+    if INTENT_MODE == "patterns":
+        return None
+    if not os.path.exists(INTENT_MODEL_PATH):
+        print(f"⚠️ INTENT_MODE={INTENT_MODE}, но нет {INTENT_MODEL_PATH} — работают только паттерны")
+        return None
+    model = IntentModel.load(INTENT_MODEL_PATH)
+    model.thresholds.update(parse_thresholds(os.getenv("INTENT_THRESHOLDS", "")))
+    return model
+
+
+_INTENT_MODEL = load_intent_model()
+
+# Сколько последних сообщений истории отдавать модели, когда есть сводка слотов (0 — всю историю):
+# известное о клиенте уже в сводке, перечитывать весь диалог не нужно
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "12"))
+
+# Правила decide_action (decision_rules.py): подменяются на лету, как промпт и паттерны
+DECISION_RULES_PATH = os.getenv(
+    "DECISION_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "decision_rules.json"))
+_RULES = load_rules_file(DECISION_RULES_PATH)
+
+# Версии промпта и паттернов для debug_logs (выставляет горячая перезагрузка в боте)
+PROMPT_VERSION = None
+PATTERNS_VERSION = None
+# Функция промпта + версия — подменяются вместе в set_prompt (ход берёт их одной выборкой в turn_snapshot)
+_PROMPT_STATE = (get_system_prompt, None)
+
+
+def set_prompt(module, version: str = None):
+    """Подмена промпта на лету — вызывается между ходами"""
+    global get_system_prompt, PROMPT_VERSION, _PROMPT_STATE
+    _PROMPT_STATE = (module.get_system_prompt, version)
+    get_system_prompt = module.get_system_prompt
+    PROMPT_VERSION = version
+
+
+def set_rules(rules: RuleSet, version: str = None):
+    """Подмена правил decide_action на лету — вызывается между ходами"""
+    global _RULES
+    _RULES = rules
+
+
+def set_patterns(patterns: dict, version: str = None):
+    """
+    Подмена списков паттернов на лету — вызывается между ходами.
+    Матчеры собираются до подмены и ставятся вместе с версией одним присваиванием.
+    """
+    global PATTERNS_VERSION, _PATTERN_STATE
+    matchers = compile_patterns(patterns, FUZZY_PATTERNS)
+    globals().update(patterns)
+    _PATTERN_STATE = (matchers, version)
+    PATTERNS_VERSION = version
 
 SYSTEM_PROMPT = """
 Ты — София, менеджер отдела продаж Oazis Estate (курортная недвижимость в России).
@@ -49,15 +119,6 @@ SYSTEM_PROMPT = """
 — Цены диапазоном: "6–12 млн", не "от 6 млн"
 — Не называй конкретные ЖК до выяснения бюджета
 
-СПРАВОЧНИК ЦЕН:
-— Сочи комфорт: 6–12 млн
-— Сочи бизнес: 12–25 млн
-— Анапа: 9–15 млн
-— Крым: 9.5–18 млн
-— Красная Поляна: 19–35 млн
-— Алтай: 14.5–22 млн
-— Ипотека: от 8% годовых
-
 ЦЕЛЬ РАЗГОВОРА:
 — Квалификация: цель покупки, локация, бюджет, способ оплаты
 — Главная цель: назначить созвон/видеопрезентацию на 15 минут
@@ -102,31 +163,59 @@ CALL_AGREE_PATTERNS = [
 ]
 
 
-def is_send_request(text: str) -> bool:
-    text_lower = text.lower()
-    return any(p in text_lower for p in SEND_PATTERNS)
+# Скомпилированные списки (regex-дерево на список) + версия — подменяются вместе в set_patterns
+_PATTERN_STATE = (compile_patterns({name: globals()[name] for name in HYBRID_PATTERN_NAMES}, FUZZY_PATTERNS), None)
+
+
+def _matches(name: str, text: str, matchers: dict = None) -> bool:
+    # normalize_text кэширует форму сообщения: история прогоняется через детекторы каждый ход
+    return (matchers or _PATTERN_STATE[0])[name].search(normalize_text(text)) is not None
+
+
+def _detects(intent: str, text: str, matchers: dict = None) -> bool:
+    """Намерение по спискам паттернов и/или модели — по INTENT_MODE. matchers — снимок хода (None — текущие)"""
+    model = _INTENT_MODEL
+    if model is None:
+        return _matches(INTENT_PATTERNS[intent], text, matchers)
+    by_model = intent in model.predict(text)
+    if INTENT_MODE == "model":
+        return by_model
+    return by_model or _matches(INTENT_PATTERNS[intent], text, matchers)
 
 
-def is_call_rejection(text: str) -> bool:
-    text_lower = text.lower()
-    return any(p in text_lower for p in CALL_REJECT_PATTERNS)
+def intent_debug(text: str) -> dict:
+    """Для debug_logs: режим, версия модели, пороги и вероятности по сообщению"""
+    model = _INTENT_MODEL
+    if model is None:
+        return {"mode": "patterns"}
+    return {
+        "mode": INTENT_MODE,
+        "model": model.version,
+        "thresholds": model.thresholds,
+        "scores": {intent: round(p, 3) for intent, p in model.scores(text).items()},
+    }
+
+
+def is_send_request(text: str, matchers: dict = None) -> bool:
+    return _detects("send", text, matchers)
+
 
+def is_call_rejection(text: str, matchers: dict = None) -> bool:
+    return _detects("call_reject", text, matchers)
 
-def is_call_agreement(text: str) -> bool:
-    text_lower = text.lower()
-    has_agree = any(p in text_lower for p in CALL_AGREE_PATTERNS)
-    has_reject = any(p in text_lower for p in CALL_REJECT_PATTERNS)
+
+def is_call_agreement(text: str, matchers: dict = None) -> bool:
+    has_agree = _detects("call_agree", text, matchers)
+    has_reject = _detects("call_reject", text, matchers)
     return has_agree and not has_reject
 
 
-def is_neutral_answer(text: str) -> bool:
-    text_lower = text.lower()
-    return any(p in text_lower for p in NEUTRAL_PATTERNS)
+def is_neutral_answer(text: str, matchers: dict = None) -> bool:
+    return _detects("neutral", text, matchers)
 
 
-def is_irritated(text: str) -> bool:
-    text_lower = text.lower()
-    return any(p in text_lower for p in IRRITATED_PATTERNS)
+def is_irritated(text: str, matchers: dict = None) -> bool:
+    return _detects("irritated", text, matchers)
 
 
 def has_question(text: str) -> bool:
@@ -142,7 +231,7 @@ def remove_question(text: str) -> str:
         return sentences[0].replace("?", ".") if sentences else text
 
 
-def analyze_history(history: list) -> dict:
+def analyze_history(history: list, matchers: dict = None) -> dict:
     stats = {
         "total_messages": len(history),
         "user_messages": 0,
@@ -163,16 +252,16 @@ def analyze_history(history: list) -> dict:
         
         if role == "user":
             stats["user_messages"] += 1
-            if is_send_request(content):
+            if is_send_request(content, matchers):
                 stats["send_requests"] += 1
                 stats["last_send_request_index"] = i
-            if is_call_rejection(content):
+            if is_call_rejection(content, matchers):
                 stats["call_rejections"] += 1
-            if is_call_agreement(content):
+            if is_call_agreement(content, matchers):
                 stats["call_agreements"] += 1
-            if is_neutral_answer(content):
+            if is_neutral_answer(content, matchers):
                 stats["neutral_answers"] += 1
-            if is_irritated(content):
+            if is_irritated(content, matchers):
                 stats["irritation_detected"] = True
         elif role == "assistant":
             stats["bot_messages"] += 1
@@ -187,116 +276,77 @@ def analyze_history(history: list) -> dict:
     return stats
 
 
-MAX_MESSAGES = 14
-MAX_QUESTIONS_AFTER_SEND = 1
-MAX_CALL_REJECTIONS = 2
-MAX_NEUTRAL_ANSWERS = 3
+def decision_features(stats: dict, last_message: str, slots: dict = None, matchers: dict = None) -> dict:
+    """Признаки для условий правил (decision_rules.RULE_FEATURES): счётчики истории, текущее сообщение, слоты"""
+    features = dict(stats)
+    features.update(
+        current_send=is_send_request(last_message, matchers),
+        current_irritated=is_irritated(last_message, matchers),
+        current_rejection=is_call_rejection(last_message, matchers),
+        current_agreement=is_call_agreement(last_message, matchers),
+        current_neutral=is_neutral_answer(last_message, matchers),
+    )
+    features["total_rejections"] = stats["call_rejections"] + features["current_rejection"]
+    features["total_neutral"] = stats["neutral_answers"] + features["current_neutral"]
+    for name in SLOT_NAMES:
+        features[f"known_{name}"] = is_known(slots, name)
+    features["qualified"] = features["known_goal"] and features["known_location"] and features["known_payment"]
+    features["missing_slots"] = missing_slots(slots)
+    features["slot_summary"] = slot_summary(slots)
+    return features
+
+
+def decide_action(stats: dict, last_message: str, rules: RuleSet = None, slots: dict = None,
+                  matchers: dict = None) -> dict:
+    """Первое сработавшее правило из decision_rules.json; в "trace" — какое и из какой версии"""
+    return (rules or _RULES).decide(decision_features(stats, last_message, slots, matchers))
+
+
+def turn_snapshot(model_mode: str = None) -> dict:
+    """
+    Всё, что горячая перезагрузка и /model меняют на лету, — одной выборкой в начале хода.
+    Ход может идти в отдельном потоке (CONCURRENT_UPDATES > 1), и подмена между ходами
+    приходит посреди него: решение, промпт, справочник и debug_logs должны видеть одни версии.
+    """
+    prompt, prompt_version = _PROMPT_STATE
+    matchers, patterns_version = _PATTERN_STATE
+    mode = model_mode or MODEL_MODE
+    return {
+        "prompt": prompt,
+        "prompt_version": prompt_version,
+        "matchers": matchers,
+        "patterns_version": patterns_version,
+        "rules": _RULES,
+        "catalog": current_catalog(),
+        "model_mode": mode,
+        "config": get_model_config(mode),
+    }
 
 
-def decide_action(stats: dict, last_message: str) -> dict:
-    current_is_send = is_send_request(last_message)
-    current_is_irritated = is_irritated(last_message)
-    current_is_rejection = is_call_rejection(last_message)
-    current_is_agreement = is_call_agreement(last_message)
-    current_is_neutral = is_neutral_answer(last_message)
-    
-    if current_is_agreement:
-        return {
-            "action": "CONFIRM_CALL",
-            "allow_questions": True,
-            "reason": "call_agreed",
-            "instruction": "Клиент согласился на созвон! Подтверди время. Можешь спросить: 'Решение сами принимаете или с кем-то?'"
-        }
-    
-    if current_is_irritated or stats["irritation_detected"]:
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "irritated",
-            "instruction": "Клиент раздражён. Извинись коротко и скажи что пришлёшь 2-3 варианта. БЕЗ ВОПРОСОВ. Никаких."
-        }
-    
-    if stats["send_requests"] >= 2 or (stats["send_requests"] >= 1 and current_is_send):
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "multiple_send_requests",
-            "instruction": "Клиент уже несколько раз просил скинуть. Хватит. Скажи что пришлёшь 2-3 варианта. БЕЗ ВОПРОСОВ."
-        }
-    
-    if stats["questions_after_last_send"] >= MAX_QUESTIONS_AFTER_SEND and current_is_send:
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "asked_after_send",
-            "instruction": "Клиент просил скинуть, мы задали вопрос, он снова просит. Хватит. Скажи что пришлёшь. БЕЗ ВОПРОСОВ."
-        }
-    
-    if stats["total_messages"] >= MAX_MESSAGES:
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "too_long",
-            "instruction": "Диалог слишком длинный. Заканчиваем. Скажи что пришлёшь варианты. БЕЗ ЛИШНИХ ВОПРОСОВ."
-        }
-    
-    total_rejections = stats["call_rejections"] + (1 if current_is_rejection else 0)
-    if total_rejections >= MAX_CALL_REJECTIONS:
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "call_rejected_twice",
-            "instruction": "Клиент уже отказывался от созвона. Не настаивай. Скажи что пришлёшь 2-3 варианта. БЕЗ ВОПРОСОВ."
-        }
-    
-    total_neutral = stats["neutral_answers"] + (1 if current_is_neutral else 0)
-    if total_neutral >= MAX_NEUTRAL_ANSWERS:
-        return {
-            "action": "SEND_MATERIALS",
-            "allow_questions": False,
-            "reason": "too_many_neutral",
-            "instruction": "Клиент много раз отвечал 'без разницы'. Хватит спрашивать. Скажи что пришлёшь варианты. БЕЗ ВОПРОСОВ."
-        }
-    
-    if current_is_send and stats["questions_after_last_send"] == 0:
-        return {
-            "action": "QUALIFY_THEN_SEND",
-            "allow_questions": True,
-            "reason": "first_send_request",
-            "instruction": "Клиент просит скинуть. Подтверди что пришлёшь. Можешь задать ОДИН уточняющий вопрос."
-        }
-    
-    if current_is_rejection and total_rejections == 1:
-        return {
-            "action": "CONTINUE",
-            "allow_questions": True,
-            "reason": "first_call_rejection",
-            "instruction": "Клиент отказался от созвона. Спокойно продолжай квалификацию. Спроси про бюджет если не знаем."
-        }
-    
-    if stats["call_offered"]:
-        return {
-            "action": "CONTINUE",
-            "allow_questions": True,
-            "reason": "normal_after_call_offer",
-            "instruction": "Продолжай квалификацию. Узнай что не выяснено: бюджет, способ оплаты, сроки. Один вопрос."
-        }
-    else:
-        return {
-            "action": "QUALIFY_OR_CALL",
-            "allow_questions": True,
-            "reason": "normal",
-            "instruction": "Если знаем цель+локацию+способ оплаты — предложи созвон на 15 минут. Если нет — задай следующий вопрос."
-        }
+def current_slots(history: list, user_message: str, slots: dict = None) -> dict:
+    """
+    Слоты после текущего сообщения. slots — сохранённое состояние чата до него:
+    обрабатывается одно новое сообщение; без состояния — один проход по истории.
+    """
+    if slots is None:
+        slots = slots_from_history(history)
+    last_bot = next((m.get("content", "") for m in reversed(history) if m.get("role") == "assistant"), None)
+    return update_slots(slots, user_message, last_bot)
 
 
-def generate_response(history: list, last_message: str, action: dict, client_name: str = "Клиент") -> str:
-    config = get_model_config()
+def generate_raw_response(history: list, last_message: str, action: dict, client_name: str = "Клиент",
+                          slots: dict = None, turn: dict = None) -> str:
+    """Ответ модели как есть — до страховки по вопросам. turn — снимок хода (turn_snapshot)"""
+    turn = turn or turn_snapshot()
+    config = turn["config"]
     
     question_instruction = "ВАЖНО: НЕ задавай вопросов. Никаких. Ни одного знака '?'." if not action['allow_questions'] else "Можешь задать один вопрос в конце."
+    known = f"ИЗВЕСТНО О КЛИЕНТЕ: {slot_summary(slots)}\n" if slots else ""
+    if slots and HISTORY_WINDOW:
+        history = history[-HISTORY_WINDOW:]
     
     task_prompt = f"""
-ЗАДАЧА: {action['instruction']}
+{known}ЗАДАЧА: {action['instruction']}
 
 {question_instruction}
 
@@ -312,7 +362,7 @@ def generate_response(history: list, last_message: str, action: dict, client_nam
         
         request_params = {
             "model": config["model"],
-            "instructions": get_system_prompt(client_name),
+            "instructions": turn["prompt"](client_name, slots),
             "input": messages,
             "text": {"verbosity": "low"},
         }
@@ -330,7 +380,8 @@ def generate_response(history: list, last_message: str, action: dict, client_nam
         dialog_lines.append(f"Клиент: {last_message}")
         dialog_text = "\n".join(dialog_lines)
         
-        prompt = f"{SYSTEM_PROMPT}\n\nИМЯ КЛИЕНТА: {client_name}\n\nДИАЛОГ:\n{dialog_text}\n\n{task_prompt}"
+        # Справочник цен (price_catalog.json) — только строки под слоты клиента
+        prompt = f"{SYSTEM_PROMPT}\nСПРАВОЧНИК ЦЕН:\n{turn['catalog'].render(slots)}\n\nИМЯ КЛИЕНТА: {client_name}\n\nДИАЛОГ:\n{dialog_text}\n\n{task_prompt}"
         
         response = client.chat.completions.create(
             model=config["model"],
@@ -342,7 +393,11 @@ def generate_response(history: list, last_message: str, action: dict, client_nam
     
     text = re.sub(r'^["\']|["\']$', '', text)
     text = re.sub(r'^София:\s*', '', text)
-    
+    return text
+
+
+def enforce_question_rule(text: str, action: dict) -> str:
+    """Страховка: вырезаем вопросы, если решение их запрещает"""
     if not action["allow_questions"] and has_question(text):
         text = remove_question(text)
         if not text.strip():
@@ -351,21 +406,44 @@ def generate_response(history: list, last_message: str, action: dict, client_nam
     return text
 
 
-def process_message(history: list, user_message: str, client_name: str = "Клиент") -> tuple[str, dict]:
-    stats = analyze_history(history)
-    action = decide_action(stats, user_message)
-    response = generate_response(history, user_message, action, client_name)
+def generate_response(history: list, last_message: str, action: dict, client_name: str = "Клиент",
+                      slots: dict = None) -> str:
+    text = generate_raw_response(history, last_message, action, client_name, slots)
+    return enforce_question_rule(text, action)
+
+
+def process_message(history: list, user_message: str, client_name: str = "Клиент",
+                    slots: dict = None, model_mode: str = None) -> tuple[str, dict]:
+    """
+    slots — сохранённые слоты чата до этого сообщения (None — собрать по истории); новые — в debug["slots"].
+    model_mode — модель чата (бот передаёт свою настройку; None — MODEL_MODE).
+    """
+    turn = turn_snapshot(model_mode)
+    # Справочник закреплён за ходом: его читают и слоты (регионы), и промпт
+    with pinned_catalog(turn["catalog"]):
+        stats = analyze_history(history, turn["matchers"])
+        slots = current_slots(history, user_message, slots)
+        action = decide_action(stats, user_message, turn["rules"], slots, turn["matchers"])
+        raw_response = generate_raw_response(history, user_message, action, client_name, slots, turn)
+    response = enforce_question_rule(raw_response, action)
     
-    config = get_model_config()
+    config = turn["config"]
     debug = {
         "stats": stats,
         "action": action["action"],
         "reason": action["reason"],
         "allow_questions": action["allow_questions"],
         "response_has_question": has_question(response),
-        "model_mode": MODEL_MODE,
+        "raw_question_count": raw_response.count("?"),
+        "question_stripped": raw_response != response,
+        "model_mode": turn["model_mode"],
         "model": config["model"],
-        "reasoning": config.get("reasoning") is not None
+        "reasoning": config.get("reasoning") is not None,
+        "prompt_version": turn["prompt_version"],
+        "patterns_version": turn["patterns_version"],
+        "intents": intent_debug(user_message),
+        "rule": action["trace"],
+        "slots": slots
     }
     
     return response, debug
@@ -1,9 +1,11 @@
-# sofia_prompt.py — v4.1
-# Обновлено: 2025-12-28
-# Изменения: правки по рекомендациям OpenAI (каналы, справочник цен, антислив)
+# sofia_prompt.py — v4.2
+# Обновлено: 2026-10-19
+# Изменения: цены вынесены в price_catalog.json, в промпт — только строки под слоты клиента
 
 from datetime import datetime
 
+from price_catalog import catalog_prompt
+
 COMPANY = "Oazis Estate"
 BOT_NAME = "София"
 
@@ -17,25 +19,13 @@ def get_time_context():
         return {"period": "вечер", "mood": "чуть более расслабленная, но на связи"}
 
 
+# Цены — в price_catalog.json: в промпт попадают только строки под локацию и бюджет клиента
 PRICE_CATALOG = """
-СПРАВОЧНИК ЦЕН (используй только эти данные, не выдумывай):
-
-МОРЕ:
-— Сочи комфорт: 6–12 млн
-— Сочи бизнес: 12–25 млн
-— Анапа: 9–15 млн
-— Крым: 9.5–18 млн
-
-ГОРЫ:
-— Красная Поляна: 19–35 млн
-— Алтай (Белокуриха): 14.5–22 млн
-
-Ипотека: от 8% годовых
-Рассрочка: есть на ряд объектов
+СПРАВОЧНИК ЦЕН (используй только эти данные, не выдумывай; пока нет локации и бюджета — только сводка):
 """
 
 
-def get_system_prompt(client_name: str) -> str:
+def get_system_prompt(client_name: str, slots: dict = None) -> str:
     time_ctx = get_time_context()
 
     return f"""Ты — София, живой ассистент отдела продаж компании {COMPANY} (курортная недвижимость и инвестиционные проекты в России).
@@ -146,7 +136,7 @@ def get_system_prompt(client_name: str) -> str:
 — Одно подтверждение, без вопросов в конце.
 — Не продолжай диалог пока клиент сам не напишет.
 
-{PRICE_CATALOG}
+{PRICE_CATALOG}{catalog_prompt(slots)}
 
 ИМЯ КЛИЕНТА: {client_name}
 Первое сообщение уже отправлено:
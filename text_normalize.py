@@ -0,0 +1,108 @@
+# text_normalize.py — нормализация русского текста для детекторов и маркеров
+# Текст и паттерны приводятся к одному виду, поэтому в списках паттернов не нужны
+# варианты "всё/все", "да,/да", "ооочень", латинские двойники букв.
+# Нормализованная форма считается один раз на сообщение (кэш), паттерны — при сборке матчера.
+
+import os
+import re
+from functools import lru_cache
+
+# Лёгкий стемминг (отрезание окончаний) — по умолчанию выключен: ловит больше форм, но и больше лишнего
+STEM = os.getenv("NORMALIZE_STEM", "0") == "1"
+
+# Латиница, похожая на кириллицу. Меняем только внутри кириллических слов ("пpивет", "cкиньте"),
+# чтобы не портить whatsapp, zoom и т.п.
+CONFUSABLES = str.maketrans("aceopxykmthb", "асеорхукмтнв")
+CYRILLIC = frozenset("абвгдежзийклмнопрстуфхцчшщъыьэюя")
+LATIN_RUN_RE = re.compile(r"[a-z]+")
+MIXED_SCRIPT_RE = re.compile(r"[а-я][a-z]|[a-z][а-я]")  # стык алфавитов внутри слова — редкость, проверяем сначала
+PUNCT_RE = re.compile(r"[^\w\s]")
+# Буква 3+ раз подряд → одна ("дааааа", "ооочень"); двойные ("сообщение") не трогаем
+REPEAT_RE = re.compile(r"([а-яa-z])\1\1+")
+SPACES_RE = re.compile(r"  +")
+OTHER_SPACES = ("\t", "\r", "\xa0")  # → пробел; переводы строк остаются
+
+# Окончания для стемминга: длинные первыми, основа не короче STEM_MIN_LENGTH
+ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ать", "ять", "еть", "ить",
+    "ешь", "ете", "ишь", "ите", "ая", "яя", "ое", "ее", "ые", "ие", "ой", "ей", "ий", "ый", "ом", "ем",
+    "ам", "ям", "ах", "ях", "ов", "ев", "ть", "ти", "те", "ют", "ут", "ат", "ят", "ла", "ли", "ло",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+REFLEXIVE = ("ся", "сь")
+STEM_MIN_LENGTH = 3
+
+
+def stem_word(word: str) -> str:
+    for suffix in REFLEXIVE:
+        if word.endswith(suffix) and len(word) - len(suffix) >= STEM_MIN_LENGTH:
+            word = word[:-len(suffix)]
+            break
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= STEM_MIN_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def _unconfuse(m) -> str:
+    text, start, end = m.string, m.start(), m.end()
+    if (start and text[start - 1] in CYRILLIC) or (end < len(text) and text[end] in CYRILLIC):
+        return m.group().translate(CONFUSABLES)
+    return m.group()
+
+
+def _fold(text: str) -> str:
+    """Всё, кроме стемминга: переводы строк сохраняются, пробелы внутри строки схлопнуты"""
+    text = PUNCT_RE.sub(" ", text.lower().replace("ё", "е")).replace("_", " ")
+    text = REPEAT_RE.sub(r"\1", text)
+    if MIXED_SCRIPT_RE.search(text):
+        text = LATIN_RUN_RE.sub(_unconfuse, text)
+    for space in OTHER_SPACES:  # replace по каждому — быстрее translate на кириллице
+        text = text.replace(space, " ")
+    return SPACES_RE.sub(" ", text)
+
+
+def _stem_line(line: str) -> str:
+    return " ".join(stem_word(w) for w in line.split())
+
+
+@lru_cache(maxsize=16384)
+def normalize_text(text: str, stem: bool = STEM) -> str:
+    """
+    Сообщение → нормализованная форма: нижний регистр, ё→е, латинские двойники → кириллица,
+    пунктуация → пробел, "дааааа" → "да", (опционально) основы слов.
+    Слова через один пробел, по краям — пробел: паттерн "да " ловит и "да," и "да" в конце.
+    """
+    line = _fold(text.replace("\n", " ")).strip(" ")
+    if stem:
+        line = _stem_line(line)
+    return f" {line} "
+
+
+def normalize_lines(texts, stem: bool = STEM) -> str:
+    """
+    Много сообщений разом (пакетная обработка: каждое встречается один раз, кэш не нужен).
+    Каждое — отдельной строкой в той же форме, что normalize_text: фраза не склеится из двух сообщений.
+    Быстрее, чем normalize_text по одному: regex-проходы идут по всему блоку.
+    """
+    block = _fold("\n".join(t.replace("\n", " ") for t in texts)).strip(" ")
+    if stem:
+        return "\n".join(f" {_stem_line(line)} " for line in block.split("\n"))
+    block = block.replace(" \n", "\n").replace("\n ", "\n").replace("\n", " \n ")
+    return f" {block} "
+
+
+def normalize_pattern(pattern: str, stem: bool = STEM) -> str:
+    """
+    Паттерн → та же форма, что у текста. Пунктуация/пробел на краю паттерна
+    становится пробелом-границей ("да," → "да "), иначе край остаётся открытым ("звон" → "звонок").
+    Пустая строка — паттерн из одной пунктуации.
+    """
+    core = _fold(pattern.replace("\n", " ")).strip(" ")
+    if stem:
+        core = _stem_line(core)
+    if not core:
+        return ""
+    lead = " " if not pattern[:1].isalnum() else ""
+    trail = " " if not pattern[-1:].isalnum() else ""
+    return lead + core + trail
@@ -0,0 +1,262 @@
+# webhook.py — приём апдейтов Telegram через webhook вместо long polling (оба бота)
+# При polling один цикл getUpdates забирает апдейты пачками, и между сообщением клиента и обработчиком
+# есть задержка. В режиме webhook Telegram сам присылает каждый апдейт POST-запросом
+# на наш адрес за reverse proxy.
+# Здесь: HTTP-сервер на asyncio (в цикле событий бота, без лишних зависимостей), проверка
+# секретного токена, /health для мониторинга и обработка апдейтов параллельно,
+# но по порядку внутри одного чата.
+
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+HEALTH_PATH = "/health"
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1 << 20            # апдейт Telegram — единицы КБ
+KEEPALIVE_TIMEOUT = 75        # секунд ждём следующий запрос в том же соединении
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+def webhook_config(default_port: int, default_path: str) -> dict:
+    """
+    Настройки из окружения. У каждого бота свои порт и путь по умолчанию — оба могут жить за одним прокси.
+    BOT_MODE=webhook включает режим; WEBHOOK_URL — публичный адрес (https://bot.example.com), по нему
+    бот сам вызывает setWebhook; без него webhook регистрируют вручную (или это локальный стенд).
+    """
+    return {
+        "mode": os.getenv("BOT_MODE", "polling"),
+        "url": os.getenv("WEBHOOK_URL", "").rstrip("/"),
+        "listen": os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+        "port": int(os.getenv("WEBHOOK_PORT", str(default_port))),
+        "path": os.getenv("WEBHOOK_PATH", default_path),
+        "secret": os.getenv("WEBHOOK_SECRET", ""),
+        # Сколько апдейтов обрабатывать одновременно (1 — по одному, как при polling)
+        "concurrent_updates": int(os.getenv("CONCURRENT_UPDATES", "1")),
+        # Свой адрес Bot API (локальный стенд, scripts/webhook_harness.py): http://127.0.0.1:8999/bot
+        "api_url": os.getenv("TELEGRAM_API_URL", ""),
+        # Сбросить апдейты, накопившиеся пока бот лежал (по умолчанию нет: это сообщения клиентов)
+        "drop_pending": os.getenv("WEBHOOK_DROP_PENDING", "0") == "1",
+        # Номер шарда, когда бот — воркер shard_supervisor.py ("" — один процесс на все чаты)
+        "shard": os.getenv("SHARD_INDEX", ""),
+    }
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов, но внутри одного чата — строго по очереди:
+    история, слоты и антифлуд чата не должны видеть два хода одновременно.
+    Сначала очередь чата, потом слот (семафор max_concurrent_updates): апдейты, ждущие своего чата,
+    слотов не держат — клиент, приславший пачку сообщений посреди долгого хода, не останавливает остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # chat_id → [lock, сколько апдейтов чата ждут или в работе]
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._locks)
+
+    async def process_update(self, update, coroutine):
+        # BaseUpdateProcessor.process_update берёт слот и зовёт do_process_update — замок чата должен быть до него
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def configure_builder(builder, config: dict):
+    """ApplicationBuilder под настройки: параллельность по чатам и свой адрес Bot API"""
+    if config["concurrent_updates"] > 1:
+        builder = builder.concurrent_updates(ChatOrderedProcessor(config["concurrent_updates"]))
+    if config["api_url"]:
+        builder = builder.base_url(config["api_url"])
+    return builder
+
+
+async def write_response(writer, status: int, payload: dict, keep_alive: bool):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+    )
+    await writer.drain()
+
+
+async def read_head(reader) -> tuple:
+    """Стартовая строка и заголовки (имена — в нижнем регистре); (None, None) — соединение закрыто"""
+    line = await reader.readline()
+    if not line:
+        return None, None
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return line.decode("latin-1").split(), headers
+
+
+async def serve_http(reader, writer, route):
+    """
+    Одно HTTP-соединение: запросы по очереди (keep-alive — Telegram держит соединения открытыми).
+    route(method, path, headers, body) → (статус, JSON-ответ). Общий для WebhookServer и роутера шардов.
+    """
+    try:
+        while True:
+            parts, headers = await asyncio.wait_for(read_head(reader), KEEPALIVE_TIMEOUT)
+            if parts is None:
+                break
+            if len(parts) != 3:
+                await write_response(writer, 400, {"ok": False}, False)
+                break
+            length = int(headers.get("content-length") or 0)
+            if length > MAX_BODY:
+                await write_response(writer, 413, {"ok": False}, False)
+                break
+            body = await reader.readexactly(length) if length else b""
+            status, payload = await route(parts[0], parts[1].split("?")[0], headers, body)
+            keep_alive = headers.get("connection", "").lower() != "close"
+            await write_response(writer, status, payload, keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+class WebhookServer:
+    """
+    POST {path} — апдейт от Telegram (проверка секрета → update_queue приложения);
+    GET /health — состояние для мониторинга и прокси.
+    """
+
+    def __init__(self, app, config: dict, logger=print):
+        self.app = app
+        self.config = config
+        self.logger = logger
+        self.secret = config["secret"]
+        self.server = None
+        self.started_at = time.time()
+        self.stats = {"received": 0, "rejected": 0, "invalid": 0, "last_update_at": None}
+
+    async def start(self):
+        self.server = await asyncio.start_server(lambda reader, writer: serve_http(reader, writer, self._route),
+                                                 self.config["listen"], self.config["port"])
+        self.started_at = time.time()
+        shard = f", шард {self.config['shard']}" if self.config["shard"] else ""
+        self.logger(f"🌐 Webhook: http://{self.config['listen']}:{self.config['port']}{self.config['path']} "
+                    f"(health: {HEALTH_PATH}, параллельно: {self.config['concurrent_updates']}{shard})")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def health(self) -> dict:
+        processor = self.app.update_processor
+        return {
+            "ok": self.app.running,
+            "mode": "webhook",
+            "shard": self.config["shard"],
+            "uptime_s": round(time.time() - self.started_at),
+            "queue": self.app.update_queue.qsize(),
+            "active_chats": getattr(processor, "active_chats", None),
+            "concurrent_updates": processor.max_concurrent_updates,
+            **self.stats,
+        }
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        if path == HEALTH_PATH:
+            health = self.health()
+            return (200 if health["ok"] else 503), health
+        if path != self.config["path"]:
+            return 404, {"ok": False}
+        if method != "POST":
+            return 405, {"ok": False}
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            self.stats["rejected"] += 1
+            return 403, {"ok": False}
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.stats["invalid"] += 1
+            self.logger(f"⚠️ Webhook: апдейт не разобран: {e}")
+            return 400, {"ok": False}
+        await self.app.update_queue.put(update)
+        self.stats["received"] += 1
+        self.stats["last_update_at"] = time.time()
+        return 200, {"ok": True}
+
+
+async def start_webhook(app, config: dict, logger=print) -> WebhookServer:
+    """
+    Поднять сервер для уже запущенного приложения (app.start()) и зарегистрировать webhook.
+    Без WEBHOOK_SECRET секрет генерируется на запуск — тогда webhook должен ставить сам бот (WEBHOOK_URL).
+    """
+    if not config["secret"]:
+        config = dict(config, secret=secrets.token_urlsafe(32))
+        if not config["url"]:
+            logger("⚠️ Webhook: нет ни WEBHOOK_SECRET, ни WEBHOOK_URL — апдейты будут отклоняться")
+    server = WebhookServer(app, config, logger)
+    await server.start()
+    if config["url"]:
+        await app.bot.set_webhook(url=config["url"] + config["path"], secret_token=config["secret"],
+                                  allowed_updates=Update.ALL_TYPES, drop_pending_updates=config["drop_pending"],
+                                  max_connections=max(40, config["concurrent_updates"]))
+        logger(f"🔗 setWebhook: {config['url']}{config['path']}")
+    return server
+
+
+async def run_webhook(app, config: dict, logger=print):
+    """Полный цикл приложения в режиме webhook (замена app.run_polling()): до SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = await start_webhook(app, config, logger)
+    try:
+        await stop.wait()
+    finally:
+        logger("🛑 Остановка webhook...")
+        await server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)